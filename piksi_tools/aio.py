@@ -0,0 +1,618 @@
+# Copyright (C) 2019 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+asyncio clients for Piksi file I/O and settings.
+
+`AsyncLink` reads and writes SBP over a pair of asyncio streams, so one
+event loop can talk to many TCP-connected receivers without a thread per
+device:
+
+    async with await AsyncLink.open_tcp('192.168.0.222', 55555) as link:
+        data = await AsyncFileIO(link).read(b'/persistent/config.ini')
+        async with AsyncSettings(link) as settings:
+            await settings.write('solution', 'soln_freq', '10')
+
+Any other stream pair, e.g. from asyncio.open_unix_connection or
+serial_asyncio.open_serial_connection, can be wrapped as well.
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+import random
+import struct
+import warnings
+from collections import OrderedDict
+
+from sbp.file_io import (SBP_MSG_FILEIO_CONFIG_RESP, SBP_MSG_FILEIO_READ_DIR_RESP,
+                         SBP_MSG_FILEIO_READ_RESP, SBP_MSG_FILEIO_WRITE_RESP,
+                         MsgFileioConfigReq, MsgFileioReadDirReq,
+                         MsgFileioRemove)
+from sbp.msg import SBP, SBP_PREAMBLE, crc16
+from sbp.piksi import MsgReset
+from sbp.settings import (SBP_MSG_SETTINGS_READ_BY_INDEX_DONE,
+                          SBP_MSG_SETTINGS_READ_BY_INDEX_RESP,
+                          SBP_MSG_SETTINGS_READ_RESP,
+                          SBP_MSG_SETTINGS_WRITE_RESP,
+                          MsgSettingsReadByIndexReq, MsgSettingsReadReq,
+                          MsgSettingsSave, MsgSettingsWrite)
+from sbp.table import dispatch
+
+from piksi_tools.fileio import (CONFIG_REQ_RETRY_MS, CONFIG_REQ_TIMEOUT_MS,
+                                MAXIMUM_RETRIES, SBP_FILEIO_BATCH_SIZE,
+                                SBP_FILEIO_WINDOW_SIZE, CongestionWindow,
+                                FileIO, RttEstimator, TransferStats,
+                                _DirListing, _ReadTransfer, _TreeListing,
+                                _readdir_requests, _transfer_name,
+                                source_view)
+from piksi_tools.settings import (DEFAULT_READ_RETRIES, DEFAULT_TIMEOUT_SECS,
+                                  DEFAULT_WRITE_RETRIES, KEY_ENCODING,
+                                  SETTINGS_WRITE_OK, SETTINGS_WRITE_REJECTED,
+                                  SETTINGS_WRITE_UNKNOWN, VALUE_ENCODING)
+from piksi_tools.utils import FRAME_CRC, MSG_HEADER, Time
+
+FRAME_BUFFER_SIZE = 16 * 1024
+
+
+class AsyncLink(object):
+    """
+    SBP link over asyncio streams.  Received messages are dispatched to
+    callbacks on the event loop, and calling the link frames messages onto
+    the stream without blocking, like `Handler`.
+
+    Fields
+    ----------
+    closed : asyncio.Event
+      Set once the stream ends or the link is closed, at which point the
+      close callbacks are called so that anything waiting for a response
+      fails straight away
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._callbacks = {}
+        self._close_callbacks = []
+        self._buffer = bytearray(FRAME_BUFFER_SIZE)
+        self._receiver = None
+        self.closed = asyncio.Event()
+
+    @classmethod
+    async def open_tcp(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def start(self):
+        if self._receiver is None:
+            self._receiver = asyncio.ensure_future(self._receive_loop())
+
+    async def close(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+            try:
+                await self._receiver
+            except asyncio.CancelledError:
+                pass
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except (OSError, ConnectionError):
+            pass
+        self._set_closed()
+
+    def _set_closed(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        for callback in list(self._close_callbacks):
+            callback()
+
+    def add_close_callback(self, callback):
+        """Call `callback()` once the link closes."""
+        self._close_callbacks.append(callback)
+
+    def remove_close_callback(self, callback):
+        self._close_callbacks.remove(callback)
+
+    def add_callback(self, callback, msg_type=None):
+        """Call `callback(msg)` for each received message of `msg_type`, or all messages."""
+        self._callbacks.setdefault(msg_type, []).append(callback)
+
+    def remove_callback(self, callback, msg_type=None):
+        self._callbacks.get(msg_type, []).remove(callback)
+
+    def __call__(self, *msgs):
+        index = 0
+        for msg in msgs:
+            index += msg.into_buffer(self._buffer, index)
+        self._writer.write(bytes(self._buffer[:index]))
+
+    async def drain(self):
+        """Wait until the stream has room for more messages."""
+        await self._writer.drain()
+
+    async def wait(self, msg_type, timeout=None):
+        """
+        Wait for the next message of `msg_type`, returning None on timeout.
+
+        Raises
+        ------
+        ConnectionError
+            If the link is or gets closed first.
+        """
+        if self.closed.is_set():
+            raise ConnectionError('Link closed')
+        received = asyncio.get_event_loop().create_future()
+
+        def cb(msg):
+            if not received.done():
+                received.set_result(msg)
+
+        def closed_cb():
+            if not received.done():
+                received.set_exception(ConnectionError('Link closed'))
+
+        self.add_callback(cb, msg_type)
+        self.add_close_callback(closed_cb)
+        try:
+            return await asyncio.wait_for(received, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.remove_callback(cb, msg_type)
+            self.remove_close_callback(closed_cb)
+
+    async def _receive_loop(self):
+        read = self._reader.readexactly
+        try:
+            while True:
+                if (await read(1))[0] != SBP_PREAMBLE:
+                    continue
+                header = await read(MSG_HEADER.size)
+                msg_type, sender, length = MSG_HEADER.unpack(header)
+                payload = await read(length)
+                crc, = FRAME_CRC.unpack(await read(FRAME_CRC.size))
+                if crc != crc16(header + payload):
+                    continue
+                try:
+                    msg = dispatch(SBP(msg_type, sender, length, payload, crc))
+                except Exception as exc:
+                    # A well formed frame that doesn't parse, like `Framer`
+                    #   skip it rather than lose the link
+                    warnings.warn("SBP dispatch error: %s" % (exc,))
+                    continue
+                self._dispatch(msg)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._set_closed()
+
+    def _dispatch(self, msg):
+        for msg_type in (msg.msg_type, None):
+            for callback in list(self._callbacks.get(msg_type, ())):
+                try:
+                    callback(msg)
+                except Exception as exc:
+                    warnings.warn("SBP callback error: %s" % (exc,))
+
+
+class _AsyncPendingRequest(object):
+    __slots__ = ('message', 'time', 'tries', 'timer')
+
+    def __init__(self, message, time):
+        self.message = message
+        self.time = time
+        self.tries = 0
+        self.timer = None
+
+
+class AsyncSelectiveRepeater(object):
+    """
+    Event loop counterpart of `SelectiveRepeater`, with the same congestion
+    window, timeouts and retry limit.  Each outstanding request has its
+    own timer, which resends it when it expires.
+
+    Messages are handed to the stream as they're sent, which coalesces
+    them into large writes without explicit batching.
+    """
+
+    def __init__(self, link, msg_type, cb=None, skip_config=False, stats=None):
+        self._link = link
+        self._msg_type = msg_type
+        self._callback = cb
+        self._skip_config = skip_config
+        self._stats = stats if stats is not None else TransferStats()
+        self._pending = {}
+        self._window_limit = SBP_FILEIO_WINDOW_SIZE
+        self._batch_size = SBP_FILEIO_BATCH_SIZE
+        self._cwnd = CongestionWindow(SBP_FILEIO_WINDOW_SIZE)
+        self._rtt = RttEstimator()
+        self._waiter = None
+        self._error = None
+        self._total_retries = 0
+
+    async def __aenter__(self):
+        self._link.add_callback(self._request_cb, self._msg_type)
+        self._link.add_close_callback(self._closed_cb)
+        if self._link.closed.is_set():
+            self._closed_cb()
+        if not self._skip_config:
+            await self._configure()
+        return self
+
+    async def __aexit__(self, *args):
+        self._link.remove_callback(self._request_cb, self._msg_type)
+        self._link.remove_close_callback(self._closed_cb)
+        for pending_req in self._pending.values():
+            # The link may have failed before the request's timer was armed
+            if pending_req.timer is not None:
+                pending_req.timer.cancel()
+
+    async def _configure(self):
+        """
+        Fetch the window and batch sizes from the device, falling back to
+        the defaults if it doesn't answer.
+        """
+        seq = random.randint(0, 0xffffffff)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + CONFIG_REQ_TIMEOUT_MS / 1000.0
+        while loop.time() < deadline:
+            self._link(MsgFileioConfigReq(sequence=seq))
+            msg = await self._link.wait(SBP_MSG_FILEIO_CONFIG_RESP, CONFIG_REQ_RETRY_MS / 1000.0)
+            if msg is not None:
+                self._window_limit = msg.window_size
+                self._batch_size = msg.batch_size
+                self._cwnd = CongestionWindow(msg.window_size)
+                return
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def total_retries(self):
+        return self._total_retries
+
+    @property
+    def window_size(self):
+        """The current congestion window, in requests."""
+        return self._cwnd.window
+
+    @property
+    def batch_size(self):
+        return max(1, min(self._batch_size, self._cwnd.window))
+
+    def _window_available(self):
+        in_flight = len(self._pending)
+        if in_flight >= self._window_limit:
+            return False
+        return in_flight == 0 or in_flight + 1 <= self._cwnd.window
+
+    def _notify(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _wait_until(self, ready):
+        while True:
+            if self._error is not None:
+                raise self._error
+            if ready():
+                return
+            self._waiter = asyncio.get_event_loop().create_future()
+            await self._waiter
+
+    def _arm(self, pending_req, timeout):
+        pending_req.timer = asyncio.get_event_loop().call_later(
+            timeout.to_float(), self._expire, pending_req)
+
+    async def send(self, msg):
+        await self._wait_until(self._window_available)
+        time_now = Time.now()
+        pending_req = _AsyncPendingRequest(msg, time_now)
+        self._pending[msg.sequence] = pending_req
+        self._link(msg)
+        self._stats.on_send([msg], time_now, len(self._pending), self._cwnd.window)
+        self._arm(pending_req, self._rtt.timeout())
+        await self._link.drain()
+
+    async def flush(self):
+        """Wait for all pending requests to complete."""
+        await self._wait_until(lambda: not self._pending)
+
+    def _expire(self, pending_req):
+        if self._pending.get(pending_req.message.sequence) is not pending_req:
+            return
+        if pending_req.tries >= MAXIMUM_RETRIES:
+            self._error = Exception('Timed out')
+            self._notify()
+            return
+        self._cwnd.on_timeout(pending_req.time)
+        pending_req.tries += 1
+        pending_req.time = Time.now()
+        self._total_retries += 1
+        self._link(pending_req.message)
+        self._stats.on_retry(pending_req.message, pending_req.time)
+        self._arm(pending_req, self._rtt.timeout(pending_req.tries))
+
+    def _closed_cb(self):
+        self._error = ConnectionError('Link closed')
+        self._notify()
+
+    def _request_cb(self, msg):
+        self._stats.on_receive(msg)
+        pending_req = self._pending.pop(msg.sequence, None)
+        if pending_req is None:
+            return
+        pending_req.timer.cancel()
+        rtt = None
+        if pending_req.tries == 0:
+            rtt = (Time.now() - pending_req.time).to_float()
+            self._rtt.sample(rtt)
+            self._cwnd.on_ack()
+        if self._callback:
+            self._callback(pending_req.message, msg)
+        self._stats.on_complete(pending_req.message, msg, rtt)
+        self._notify()
+
+
+class AsyncFileIO(object):
+    """
+    Event loop counterpart of `FileIO`.
+    """
+
+    def __init__(self, link):
+        self.link = link
+        self._seq = random.randint(0, 0xffffffff)
+        # Telemetry of every transfer made so far, in order
+        self.transfer_stats = []
+
+    next_seq = FileIO.next_seq
+    # Requests are built the same way, only sending them differs
+    _write_requests = FileIO._write_requests
+
+    def _repeater(self, name, msg_type, cb=None, skip_config=True):
+        stats = TransferStats(name)
+        self.transfer_stats.append(stats)
+        return AsyncSelectiveRepeater(self.link, msg_type, cb, skip_config=skip_config, stats=stats)
+
+    async def read(self, filename, dest=None):
+        """
+        Read the contents of a file, see `FileIO.read`.
+
+        Chunks are written to `dest` from the event loop as they arrive,
+        so reading into a file on slow storage blocks the loop while each
+        chunk is written.
+        """
+        transfer = _ReadTransfer(filename, dest)
+        async with self._repeater(_transfer_name('read', filename), SBP_MSG_FILEIO_READ_RESP,
+                                  transfer.on_response) as sr:
+            while not transfer.mostly_done:
+                await sr.send(transfer.next_request(self.next_seq()))
+            await sr.flush()
+        return transfer.result()
+
+    async def readdir(self, dirname=b'.', recursive=False):
+        """
+        List the files in a directory, see `FileIO.readdir`.
+        """
+        if not recursive:
+            return (await self._readdir_many([dirname]))[0]
+        tree = _TreeListing(dirname)
+        while not tree.done:
+            tree.on_listings(await self._readdir_many(tree.dirnames()))
+        return tree.files
+
+    async def _readdir_many(self, dirnames):
+        listings = [_DirListing(dirname) for dirname in dirnames]
+        routes = {}
+
+        def cb(req, resp):
+            listing = routes.pop(req.sequence, None)
+            if listing is not None:
+                listing.on_response(req, resp)
+
+        async with self._repeater(_transfer_name('list', b', '.join(dirnames)),
+                                  SBP_MSG_FILEIO_READ_DIR_RESP, cb) as sr:
+            while True:
+                requests = _readdir_requests(listings)
+                if not requests:
+                    break
+                for listing, offset in requests:
+                    seq = self.next_seq()
+                    routes[seq] = listing
+                    await sr.send(MsgFileioReadDirReq(sequence=seq, offset=offset, dirname=listing.dirname))
+                await sr.flush()
+        return [listing.result() for listing in listings]
+
+    def remove(self, filename):
+        """
+        Delete a file.
+        """
+        self.link(MsgFileioRemove(filename=filename))
+
+    async def write(self, filename, data, offset=0, trunc=True, progress_cb=None):
+        """
+        Write to a file, see `FileIO.write`.
+        """
+        with source_view(data) as view:
+            if trunc and offset == 0:
+                self.remove(filename)
+            async with self._repeater(_transfer_name('write', filename), SBP_MSG_FILEIO_WRITE_RESP,
+                                      skip_config=False) as sr:
+                for msg, offset in self._write_requests(filename, view, offset):
+                    await sr.send(msg)
+                    if progress_cb is not None:
+                        progress_cb(offset, sr)
+                await sr.flush()
+
+
+class AsyncSettings(object):
+    """
+    Event loop counterpart of `Settings`.  Every request waits for its own
+    response instead of sleeping for the timeout, and writes are confirmed
+    by the device's write response.
+    """
+
+    def __init__(self, link, timeout=DEFAULT_TIMEOUT_SECS):
+        self.link = link
+        self.timeout = timeout
+        self._read_waiters = {}
+        self._write_waiters = {}
+        self._index_waiters = {}
+
+    async def __aenter__(self):
+        self.link.add_close_callback(self._closed_cb)
+        self.link.add_callback(self._read_cb, SBP_MSG_SETTINGS_READ_RESP)
+        self.link.add_callback(self._write_cb, SBP_MSG_SETTINGS_WRITE_RESP)
+        self.link.add_callback(self._index_cb, SBP_MSG_SETTINGS_READ_BY_INDEX_RESP)
+        self.link.add_callback(self._index_done_cb, SBP_MSG_SETTINGS_READ_BY_INDEX_DONE)
+        return self
+
+    async def __aexit__(self, *args):
+        self.link.remove_close_callback(self._closed_cb)
+        self.link.remove_callback(self._read_cb, SBP_MSG_SETTINGS_READ_RESP)
+        self.link.remove_callback(self._write_cb, SBP_MSG_SETTINGS_WRITE_RESP)
+        self.link.remove_callback(self._index_cb, SBP_MSG_SETTINGS_READ_BY_INDEX_RESP)
+        self.link.remove_callback(self._index_done_cb, SBP_MSG_SETTINGS_READ_BY_INDEX_DONE)
+
+    @staticmethod
+    def _resolve(waiters, key, result):
+        for future in waiters.pop(key, ()):
+            if not future.done():
+                future.set_result(result)
+
+    async def _request(self, waiters, key, msg, retries):
+        """
+        Send `msg` until a response for `key` arrives, up to `retries`
+        times, returning None if none does.
+        """
+        if self.link.closed.is_set():
+            raise ConnectionError('Link closed')
+        for _ in range(retries):
+            future = asyncio.get_event_loop().create_future()
+            waiters.setdefault(key, []).append(future)
+            self.link(msg)
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                if future in waiters.get(key, ()):
+                    waiters[key].remove(future)
+        return None
+
+    def _closed_cb(self):
+        for waiters in (self._read_waiters, self._write_waiters, self._index_waiters):
+            for futures in waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(ConnectionError('Link closed'))
+            waiters.clear()
+
+    def _read_cb(self, msg):
+        section, setting, value, *format_type = msg.payload.split(b'\0')[:4]
+        key = (section.decode(KEY_ENCODING), setting.decode(KEY_ENCODING))
+        self._resolve(self._read_waiters, key, (value.decode(VALUE_ENCODING) if format_type else None,))
+
+    def _write_cb(self, msg):
+        section, setting = msg.payload[1:].split(b'\0')[:2]
+        key = (section.decode(KEY_ENCODING), setting.decode(KEY_ENCODING))
+        self._resolve(self._write_waiters, key, msg.payload[0])
+
+    def _index_cb(self, msg):
+        index, = struct.unpack('<H', msg.payload[:2])
+        section, setting, value = msg.payload[2:].split(b'\0')[:3]
+        self._resolve(self._index_waiters, index, (section.decode(KEY_ENCODING),
+                                                   setting.decode(KEY_ENCODING),
+                                                   value.decode(VALUE_ENCODING)))
+
+    def _index_done_cb(self, msg):
+        for index in list(self._index_waiters):
+            self._resolve(self._index_waiters, index, False)
+
+    async def read(self, section, setting, retries=DEFAULT_READ_RETRIES):
+        """
+        Read one setting from the device.
+
+        Raises
+        ------
+        RuntimeError
+            If the setting couldn't be read, it may not exist.
+        """
+        msg = MsgSettingsReadReq(setting=b'%s\0%s\0' % (section.encode(KEY_ENCODING),
+                                                        setting.encode(KEY_ENCODING)))
+        reply = await self._request(self._read_waiters, (section, setting), msg, retries)
+        if reply is None:
+            raise RuntimeError(("Unable to read setting \"{}\" in section \"{}\" after {} attempts. "
+                                "Setting may not exist.".format(setting, section, retries)))
+        return reply[0]
+
+    async def write(self, section, setting, value, retries=DEFAULT_WRITE_RETRIES):
+        """
+        Write one setting, waiting for the device to accept it.
+
+        Raises
+        ------
+        RuntimeError
+            If the device rejected the value, doesn't have the setting or
+            didn't respond.
+        """
+        msg = MsgSettingsWrite(setting=b'%s\0%s\0%s\0' % (section.encode(KEY_ENCODING),
+                                                          setting.encode(KEY_ENCODING),
+                                                          value.encode(VALUE_ENCODING)))
+        status = await self._request(self._write_waiters, (section, setting), msg, retries)
+        if status == SETTINGS_WRITE_OK:
+            return
+        if status == SETTINGS_WRITE_REJECTED:
+            raise RuntimeError("Unable to write setting \"{}\" in section \"{}\" "
+                               "with value \"{}\": Setting value rejected.".format(setting, section, value))
+        if status == SETTINGS_WRITE_UNKNOWN:
+            raise RuntimeError("Unable to write setting \"{}\" in section \"{}\"."
+                               "Setting does not exist.".format(setting, section))
+        if status is not None:
+            raise RuntimeError("Unknown setting write status response")
+        raise RuntimeError("Unable to write setting \"{}\" in section \"{}\" "
+                           "with value \"{}\" after {} attempts.".format(setting, section, value, retries))
+
+    async def read_all(self, retries=DEFAULT_READ_RETRIES):
+        """
+        Read all settings from the device.
+
+        Returns
+        -------
+        out : OrderedDict(str, dict(str, str))
+            Setting values by section and name.
+        """
+        settings = OrderedDict()
+        index = 0
+        while True:
+            msg = MsgSettingsReadByIndexReq(index=index)
+            reply = await self._request(self._index_waiters, index, msg, retries)
+            if reply is None:
+                raise RuntimeError("Unable to read setting at index {} after {} attempts.".format(index, retries))
+            if reply is False:
+                return settings
+            section, setting, value = reply
+            settings.setdefault(section, {})[setting] = value
+            index += 1
+
+    def save(self):
+        """Save settings to flash"""
+        self.link(MsgSettingsSave())
+
+    def reset(self):
+        """Reset to default settings and reset device"""
+        self.link(MsgReset(flags=1))
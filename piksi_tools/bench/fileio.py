@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+File I/O throughput benchmark.
+
+Runs FileIO writes, reads and directory listings against an emulated
+device in a child process, sweeping the window and batch sizes the device
+advertises, the link's baud rate, loss and latency.  Host CPU time is
+measured for this process only, so it covers the tools and not the
+emulator.  The report is written as JSON:
+
+    $ python -m piksi_tools.bench.fileio --loss 0,0.01 --baud 115200,0 -o report.json
+
+Only writes negotiate the window and batch sizes with the device, reads
+and listings always use the host defaults.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import time
+
+from sbp.client import Framer, Handler
+
+from piksi_tools import __version__ as VERSION
+from piksi_tools.emulator import DeviceEmulator, EmulatorDriver
+from piksi_tools.fileio import STATS_RTT_BUCKETS_MS, FileIO
+
+OPERATIONS = ('write', 'read', 'readdir')
+BAUD_BITS_PER_BYTE = 10  # 8N1
+WRITE_FILENAME = b'bench/write.bin'
+READ_FILENAME = b'bench/read.bin'
+LIST_DIRNAME = b'bench/list'
+
+
+def parse_list(convert):
+    def parse(text):
+        return [convert(X) for X in text.split(',')]
+    return parse
+
+
+def get_args(args=None):
+    """
+    Get and parse arguments.
+    """
+    parser = argparse.ArgumentParser(description='File I/O benchmark version ' + VERSION)
+    parser.add_argument('--window', type=parse_list(int), default=[100],
+                        help='comma separated window sizes advertised by the device.')
+    parser.add_argument('--batch', type=parse_list(int), default=[1],
+                        help='comma separated batch sizes advertised by the device.')
+    parser.add_argument('--baud', type=parse_list(int), default=[0],
+                        help='comma separated link baud rates, 0 for unlimited.')
+    parser.add_argument('--loss', type=parse_list(float), default=[0.0],
+                        help='comma separated message loss probabilities.')
+    parser.add_argument('--latency', type=parse_list(float), default=[0.0],
+                        help='comma separated one way link delays in seconds.')
+    parser.add_argument('--ops', type=parse_list(str), default=list(OPERATIONS),
+                        help='comma separated operations to run, of %s.' % ', '.join(OPERATIONS))
+    parser.add_argument('--size', type=int, default=256 * 1024,
+                        help='bytes written and read per run.')
+    parser.add_argument('--files', type=int, default=500,
+                        help='entries in the directory listed per run.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each operation per parameter set.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the link randomness.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='file to write the JSON report to, stdout if not given.')
+    args = parser.parse_args(args)
+    unknown = set(args.ops) - set(OPERATIONS)
+    if unknown:
+        parser.error('unknown operations: %s' % ', '.join(sorted(unknown)))
+    return args
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def histogram_percentile(histogram, fraction):
+    """
+    Upper bound in ms of the bucket holding the given percentile of an RTT
+    histogram, None if it's empty or beyond the last bound.
+    """
+    total = sum(histogram)
+    if total == 0:
+        return None
+    count = 0
+    for bound, bucket in zip(STATS_RTT_BUCKETS_MS + (None,), histogram):
+        count += bucket
+        if count >= fraction * total:
+            return bound
+
+
+def serve_device(sock, device_args):
+    with DeviceEmulator(sock=sock, heartbeat_interval=None, **device_args) as device:
+        device.wait_closed()
+
+
+def run_operation(fio, op, data, files):
+    if op == 'write':
+        fio.write(WRITE_FILENAME, data)
+    elif op == 'read':
+        assert len(fio.read(READ_FILENAME)) == len(data)
+    else:
+        assert len(fio.readdir(LIST_DIRNAME)) == files
+
+
+def bench_operation(fio, op, data, files, repeat):
+    """
+    Run one operation `repeat` times, summarizing the transfers it made.
+    """
+    durations = []
+    cpu_s = 0.0
+    first_stats = len(fio.transfer_stats)
+    for _ in range(repeat):
+        cpu_start = time.process_time()
+        start = time.monotonic()
+        run_operation(fio, op, data, files)
+        durations.append(time.monotonic() - start)
+        cpu_s += time.process_time() - cpu_start
+    stats = fio.transfer_stats[first_stats:]
+    requests = sum(X.requests for X in stats)
+    retries = sum(X.retries for X in stats)
+    goodput_bytes = sum(X.goodput_bytes for X in stats)
+    raw_bytes = sum(X.raw_bytes for X in stats)
+    histogram = [sum(X) for X in zip(*[X.rtt_histogram for X in stats])]
+    elapsed = sum(durations)
+    return {
+        'op': op,
+        'runs': repeat,
+        'goodput_bytes_per_s': goodput_bytes / elapsed,
+        'raw_bytes_per_s': raw_bytes / elapsed,
+        'retry_ratio': float(retries) / requests if requests else 0.0,
+        'cpu_s_per_mb': cpu_s / (goodput_bytes / 1e6) if goodput_bytes else None,
+        'duration_s': {
+            'p50': percentile(durations, 0.5),
+            'p95': percentile(durations, 0.95),
+            'max': max(durations),
+        },
+        'rtt_ms_p50': histogram_percentile(histogram, 0.5),
+        'rtt_ms_p99': histogram_percentile(histogram, 0.99),
+        'window_blocked_s': sum(X.window_blocked_s for X in stats),
+    }
+
+
+def bench_parameters(args, window, batch, baud, loss, latency):
+    """
+    Benchmark every operation against a fresh emulated device.
+    """
+    data = os.urandom(args.size)
+    device_files = {READ_FILENAME: data}
+    for index in range(args.files):
+        device_files[LIST_DIRNAME + b'/log_%06d.sbp' % index] = b''
+    device_args = {
+        'files': device_files,
+        'window_size': window,
+        'batch_size': batch,
+        'bandwidth': baud / float(BAUD_BITS_PER_BYTE) if baud else None,
+        'loss': loss,
+        'latency': latency,
+        'seed': args.seed,
+    }
+    device_sock, host_sock = socket.socketpair()
+    device = multiprocessing.Process(target=serve_device, args=(device_sock, device_args))
+    device.daemon = True
+    device.start()
+    device_sock.close()
+    results = []
+    try:
+        with EmulatorDriver(host_sock) as driver:
+            with Handler(Framer(driver.read, driver.write)) as link:
+                fio = FileIO(link)
+                for op in args.ops:
+                    result = bench_operation(fio, op, data, args.files, args.repeat)
+                    result.update(window=window, batch=batch, baud=baud, loss=loss, latency=latency)
+                    results.append(result)
+    finally:
+        device.join()
+    return results
+
+
+def main(args=None):
+    args = get_args(args)
+    results = []
+    for window, batch, baud, loss, latency in itertools.product(
+            args.window, args.batch, args.baud, args.loss, args.latency):
+        sys.stderr.write("window %d batch %d baud %d loss %g latency %g\n" % (window, batch, baud, loss, latency))
+        results.extend(bench_parameters(args, window, batch, baud, loss, latency))
+    report = {
+        'piksi_tools_version': VERSION,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'size': args.size,
+            'files': args.files,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -23,18 +23,49 @@ images.
 """
 from __future__ import absolute_import, print_function
 
+import hashlib
+import json
+import mmap
+import os
 import random
+import re
 import sys
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from monotonic import monotonic
 
 from sbp.client import Framer, Handler
+from sbp.client.drivers.network_drivers import TCPDriver
+from sbp.flash import SBP_MSG_STM_UNIQUE_ID_RESP, MsgStmUniqueIdReq
 from sbp.logging import SBP_MSG_LOG, SBP_MSG_PRINT_DEP
-from sbp.piksi import SBP_MSG_COMMAND_RESP, MsgCommandReq, MsgReset
+from sbp.piksi import SBP_MSG_COMMAND_OUTPUT, SBP_MSG_COMMAND_RESP, MsgCommandReq, MsgReset
 
 from piksi_tools import serial_link
-from piksi_tools.fileio import FileIO
+from piksi_tools.fileio import FileIO, checkpoint_path, dump_transfer_stats, source_view
+from piksi_tools.settings import Settings
+from piksi_tools.utils import Time, mkdir_p, split_host_port
 from piksi_tools import __version__ as VERSION
 
+IMAGE_SET_FILENAME = b"upgrade.image_set.bin"
+UPGRADE_COMMAND = b"upgrade_tool upgrade.image_set.bin"
+UPGRADE_TIMEOUT_S = 300
+SHELL_COMMAND_TIMEOUT_CODE = -255
+COMMAND_PROGRESS_INTERVAL_S = 1.0
+
+UPGRADE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.piksi_tools')
+UPGRADE_CACHE_PATH = os.path.join(UPGRADE_CACHE_DIR, 'upgrade_cache.json')
+IDENTITY_TIMEOUT_S = 0.5
+IDENTITY_RETRIES = 3
+
+FLEET_DEFAULT_PORT = 55555
+FLEET_DEFAULT_JOBS = 8
+FLEET_DEFAULT_RETRIES = 2
+FLEET_PROGRESS_INTERVAL_S = 5.0
+FLEET_MAX_RECONNECT = 3
+FLEET_RETRY_DELAY_S = 2.0
+FLEET_MAX_RETRY_DELAY_S = 60.0
+
 
 def get_args():
     """
@@ -43,32 +74,613 @@ def get_args():
     parser = serial_link.base_cl_options()
     parser.description = 'Piksi Bootloader version ' + VERSION
     parser.add_argument("firmware", help="the image set file to write to flash.")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="keep a checkpoint next to the image set file and resume an interrupted transfer from it.")
+    parser.add_argument(
+        "--upgrade-timeout",
+        type=float,
+        default=UPGRADE_TIMEOUT_S,
+        help="seconds to wait for the device to commit the image set to flash.")
+    parser.add_argument(
+        "--stats-json",
+        default=None,
+        help="write telemetry of the image transfer to this JSON file.")
+    parser.add_argument(
+        "--fleet",
+        default=None,
+        help="upgrade every receiver listed in this file, one host[:port] per line, over TCP.")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=FLEET_DEFAULT_JOBS,
+        help="number of receivers upgraded at once in fleet mode.")
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=FLEET_DEFAULT_RETRIES,
+        help="times a failed receiver is retried in fleet mode, resuming the transfer.")
+    parser.add_argument(
+        "--checkpoint-dir",
+        default=UPGRADE_CACHE_DIR,
+        help="directory keeping the checkpoint of each receiver's transfer in fleet mode.")
+    parser.add_argument(
+        "--upgrade-cache",
+        default=UPGRADE_CACHE_PATH,
+        help="file recording the image set last flashed to each receiver, by unique ID.")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="upgrade even if the receiver is already running this image set.")
     return parser.parse_args()
 
 
-def shell_command(link, cmd, timeout=None, progress_cb=None):
-    ev = threading.Event()
-    seq = random.randint(0, 0xffffffff)
-    ret = {}
-    elapsed_intervals = 0
-
-    def resp_handler(msg, **kwargs):
-        if msg.sequence == seq:
-            ret['code'] = msg.code
-            ev.set()
-
-    link.add_callback(resp_handler, SBP_MSG_COMMAND_RESP)
-    link(MsgCommandReq(sequence=seq, command=cmd))
-    while (elapsed_intervals < timeout):
-        ev.wait(timeout)
-        if progress_cb:
-            progress_cb(float(elapsed_intervals) / float(timeout) * 100)
-        elapsed_intervals += 1
-    if len(ret.items()) == 0:
+class _PendingCommand(object):
+    __slots__ = ('done', 'code', 'output_cb')
+
+    def __init__(self, output_cb):
+        self.done = threading.Event()
+        self.code = None
+        self.output_cb = output_cb
+
+
+class CommandRunner(object):
+    """
+    Runs shell commands on the device.  Responses and output lines are
+    matched to their command by sequence number, so several commands may
+    run at once, and each one completes as soon as its response arrives.
+
+    Parameters
+    ----------
+    link : Handler
+        Link to the device.
+    log_cb : callable (optional)
+        Called with each MsgLog received while the runner is in use.
+    """
+
+    def __init__(self, link, log_cb=None):
+        self.link = link
+        self.log_cb = log_cb
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.link.add_callback(self._resp_cb, SBP_MSG_COMMAND_RESP)
+        self.link.add_callback(self._output_cb, SBP_MSG_COMMAND_OUTPUT)
+        if self.log_cb is not None:
+            self.link.add_callback(self.log_cb, SBP_MSG_LOG)
+        return self
+
+    def __exit__(self, *args):
+        self.link.remove_callback(self._resp_cb, SBP_MSG_COMMAND_RESP)
+        self.link.remove_callback(self._output_cb, SBP_MSG_COMMAND_OUTPUT)
+        if self.log_cb is not None:
+            self.link.remove_callback(self.log_cb, SBP_MSG_LOG)
+
+    def _resp_cb(self, msg, **metadata):
+        with self._lock:
+            pending = self._pending.get(msg.sequence)
+        if pending is not None:
+            pending.code = msg.code
+            pending.done.set()
+
+    def _output_cb(self, msg, **metadata):
+        with self._lock:
+            pending = self._pending.get(msg.sequence)
+        if pending is not None and pending.output_cb is not None:
+            pending.output_cb(msg.line)
+
+    def start(self, cmd, output_cb=None):
+        """
+        Send a command without waiting for it.
+
+        Parameters
+        ----------
+        cmd : bytes
+            Command line to run.
+        output_cb : callable (optional)
+            Called with each line of output of the command.
+
+        Returns
+        -------
+        out : int
+            Sequence number identifying the command.
+        """
+        with self._lock:
+            seq = random.randint(0, 0xffffffff)
+            while seq in self._pending:
+                seq = random.randint(0, 0xffffffff)
+            self._pending[seq] = _PendingCommand(output_cb)
+        self.link(MsgCommandReq(sequence=seq, command=cmd))
+        return seq
+
+    def wait(self, seq, timeout=None, progress_cb=None):
+        """
+        Wait for a command started with `start` to complete.
+
+        Parameters
+        ----------
+        seq : int
+            Sequence number of the command.
+        timeout : float (optional)
+            Seconds to wait for, forever if None.
+        progress_cb : callable (optional)
+            Called every COMMAND_PROGRESS_INTERVAL_S with the percentage
+            of the timeout elapsed so far, if there is a timeout.
+
+        Returns
+        -------
+        out : int
+            Exit code of the command, None if it timed out.
+        """
+        pending = self._pending[seq]
+        start = monotonic()
+        try:
+            while True:
+                wait_s = None
+                if timeout is not None:
+                    remaining = start + timeout - monotonic()
+                    wait_s = min(COMMAND_PROGRESS_INTERVAL_S, remaining) if progress_cb else remaining
+                if pending.done.wait(max(wait_s, 0) if wait_s is not None else None):
+                    return pending.code
+                if monotonic() - start >= timeout:
+                    return None
+                if progress_cb:
+                    progress_cb((monotonic() - start) / timeout * 100)
+        finally:
+            with self._lock:
+                del self._pending[seq]
+
+    def run(self, cmd, timeout=None, progress_cb=None, output_cb=None):
+        """
+        Run a command and wait for it, see `start` and `wait`.
+        """
+        return self.wait(self.start(cmd, output_cb), timeout, progress_cb)
+
+
+def shell_command(link, cmd, timeout=None, progress_cb=None, output_cb=None):
+    with CommandRunner(link) as runner:
+        code = runner.run(cmd, timeout, progress_cb, output_cb)
+    if code is None:
         print(("Shell command timeout: execution exceeded {0} "
                "seconds with no response.").format(timeout))
-        return -255
-    return ret['code']
+        return SHELL_COMMAND_TIMEOUT_CODE
+    return code
+
+
+def print_command_output(line):
+    print(line.decode('ascii', 'replace'))
+
+
+def image_fingerprint(image):
+    """SHA-256 hex digest of an image set given as a bytes-like object."""
+    return hashlib.sha256(image).hexdigest()
+
+
+def read_unique_id(link, timeout=IDENTITY_TIMEOUT_S, retries=IDENTITY_RETRIES):
+    """
+    Read the unique ID of the device.
+
+    Returns
+    -------
+    out : str
+        The ID in hex, None if the device didn't respond.
+    """
+    received = threading.Event()
+    unique_id = []
+
+    def cb(msg, **metadata):
+        unique_id.append(bytes(msg.payload).hex())
+        received.set()
+
+    link.add_callback(cb, SBP_MSG_STM_UNIQUE_ID_RESP)
+    try:
+        for _ in range(retries):
+            link(MsgStmUniqueIdReq())
+            if received.wait(timeout):
+                return unique_id[0]
+    finally:
+        link.remove_callback(cb, SBP_MSG_STM_UNIQUE_ID_RESP)
+    return None
+
+
+def read_firmware_version(link, timeout=IDENTITY_TIMEOUT_S, retries=IDENTITY_RETRIES):
+    """The firmware version the device reports, None if it can't be read."""
+    with Settings(link, timeout=timeout) as settings:
+        try:
+            return settings.read('system_info', 'firmware_version', retries)
+        except RuntimeError:
+            return None
+
+
+class UpgradeCache(object):
+    """
+    Record of the image set last flashed to each receiver, used to skip
+    upgrading receivers that already run it.  Along with the image
+    fingerprint, each entry keeps the firmware version the receiver
+    reported before it was flashed.  A receiver counts as current when its
+    entry has the same fingerprint and it now reports a different version,
+    so a receiver that fell back to its previous firmware is upgraded
+    again.  Reflashing the version a receiver already runs therefore never
+    counts as current.
+
+    Fields
+    ----------
+    path : str
+      Path of the cache file, only written once a receiver is recorded
+    entries : dict(str, dict)
+      Image fingerprint and the firmware version reported before the
+      upgrade, keyed by unique ID in hex
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f).get('devices', {})
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def is_current(self, unique_id, fingerprint, firmware_version):
+        """
+        Whether the receiver, reporting `firmware_version`, runs the image
+        set with `fingerprint`.
+        """
+        if unique_id is None:
+            return False
+        with self._lock:
+            entry = self.entries.get(unique_id)
+        if entry is None or entry['image_sha256'] != fingerprint or firmware_version is None:
+            return False
+        return firmware_version != entry['previous_version']
+
+    def record(self, unique_id, fingerprint, previous_version):
+        """
+        Record that the image set with `fingerprint` was flashed to a
+        receiver that reported `previous_version` beforehand.  Nothing is
+        recorded if either the receiver or its version is unknown.
+        """
+        if unique_id is None or previous_version is None:
+            return
+        with self._lock:
+            self.entries[unique_id] = {'image_sha256': fingerprint, 'previous_version': previous_version}
+            self._save()
+
+    def _save(self):
+        mkdir_p(os.path.dirname(os.path.abspath(self.path)))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'devices': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def check_current(link, cache, fingerprint):
+    """
+    Identify the device and look it up in the upgrade cache.
+
+    Returns
+    -------
+    out : (str, str, bool)
+        Unique ID and firmware version of the device, either None if it
+        didn't respond, and whether it already runs the image set.
+    """
+    unique_id = read_unique_id(link)
+    if unique_id is None:
+        return None, None, False
+    version = read_firmware_version(link)
+    return unique_id, version, cache.is_current(unique_id, fingerprint, version)
+
+
+def read_fleet(path):
+    """
+    Read the receivers to upgrade, one host[:port] per line, IPv6 hosts
+    given a port are written in brackets.  Blank lines and lines starting
+    with '#' are skipped.
+
+    Returns
+    -------
+    out : [(str, int)]
+        Host and port of each receiver.
+    """
+    hosts = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            host, port = split_host_port(line)
+            hosts.append((host, port or FLEET_DEFAULT_PORT))
+    return hosts
+
+
+def open_tcp_driver(host, port):
+    """Connection to a fleet receiver, giving up after a few reconnects."""
+    return TCPDriver(host, port, raise_initial_timeout=True, reconnect=True,
+                     max_reconnect=FLEET_MAX_RECONNECT)
+
+
+class DeviceUpgrade(object):
+    """
+    Progress and outcome of upgrading one receiver of a fleet.
+
+    Fields
+    ----------
+    host : str
+      Receiver address
+    port : int
+      Receiver TCP port
+    state : str
+      One of 'queued', 'transferring', 'flashing', 'done', 'skipped' or
+      'failed'
+    attempts : int
+      Attempts made so far
+    sent : int
+      Offset up to which the image has been acknowledged, counting the
+      bytes acknowledged in the current attempt from where it resumed
+    resumed_from : int
+      Offset the current attempt resumed the transfer from
+    error : str
+      Why the last attempt failed, None if it didn't
+    transfer_stats : [dict]
+      Telemetry of the transfers made, over all attempts
+    """
+
+    def __init__(self, host, port, size):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.state = 'queued'
+        self.attempts = 0
+        self.sent = 0
+        self.resumed_from = 0
+        self.error = None
+        self.transfer_stats = []
+        self._start = None
+        self._attempt_start = None
+        self._end = None
+
+    @property
+    def name(self):
+        return '%s:%d' % (self.host, self.port)
+
+    def start_attempt(self):
+        now = Time.now()
+        if self._start is None:
+            self._start = now
+        self._attempt_start = now
+        self.attempts += 1
+        self.state = 'transferring'
+        self.sent = 0
+        self.resumed_from = None
+        self.error = None
+
+    def on_progress(self, offset, repeater):
+        """
+        Progress callback of the image write.  The write reports the offset
+        it resumed from before sending anything, and the data acknowledged
+        since is counted by the repeater's telemetry.
+        """
+        if self.resumed_from is None:
+            self.resumed_from = offset
+        self.sent = self.resumed_from + repeater.stats.goodput_bytes
+
+    def retry_delay(self, delay):
+        """Seconds to wait before the next attempt, doubling each attempt."""
+        return min(delay * 2 ** (self.attempts - 1), FLEET_MAX_RETRY_DELAY_S)
+
+    def finish(self, state, error=None):
+        self.state = state
+        self.error = error
+        self._end = Time.now()
+
+    @property
+    def elapsed(self):
+        if self._start is None:
+            return 0.0
+        return ((self._end or Time.now()) - self._start).to_float()
+
+    def eta(self):
+        """Seconds until the transfer completes, None if unknown."""
+        if self.state != 'transferring' or self.resumed_from is None:
+            return None
+        rate = (self.sent - self.resumed_from) / max((Time.now() - self._attempt_start).to_float(), 1e-3)
+        if rate <= 0:
+            return None
+        return (self.size - self.sent) / rate
+
+
+class FleetUpgrade(object):
+    """
+    Upgrades many receivers with the same image set, a bounded number at
+    a time.  The image is memory-mapped once and shared read-only by every
+    transfer.  A receiver that fails is retried, resuming its transfer
+    from a per-receiver checkpoint.
+
+    Parameters
+    ----------
+    hosts : [(str, int)]
+        Host and port of each receiver.
+    firmware : str
+        Path of the image set file.
+    jobs : int (optional)
+        Number of receivers upgraded at once.
+    retries : int (optional)
+        Times a failed receiver is retried.
+    retry_delay : float (optional)
+        Seconds to wait before retrying a receiver, doubled on each retry.
+    checkpoint_dir : str (optional)
+        Directory keeping the checkpoints, transfers aren't resumed if it
+        can't be written to.
+    upgrade_timeout : float (optional)
+        Seconds to wait for a receiver to commit the image set to flash,
+        a receiver that takes longer is retried.
+    cache : UpgradeCache (optional)
+        Receivers it lists as current are skipped, and upgraded receivers
+        are recorded in it.
+    connect : callable (optional)
+        Returns a driver for a host and port.
+    out : file (optional)
+        Where progress and the summary are printed.
+    """
+
+    def __init__(self, hosts, firmware, jobs=FLEET_DEFAULT_JOBS, retries=FLEET_DEFAULT_RETRIES,
+                 retry_delay=FLEET_RETRY_DELAY_S, checkpoint_dir=UPGRADE_CACHE_DIR,
+                 upgrade_timeout=UPGRADE_TIMEOUT_S, cache=None, connect=open_tcp_driver, out=sys.stdout):
+        self.firmware = firmware
+        self.jobs = jobs
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.checkpoint_dir = checkpoint_dir
+        self.upgrade_timeout = upgrade_timeout
+        self.cache = cache
+        self.connect = connect
+        self.out = out
+        self.size = os.path.getsize(firmware)
+        self.devices = [DeviceUpgrade(host, port, self.size) for host, port in hosts]
+
+    def checkpoint_path(self, device):
+        if self.checkpoint_dir is None:
+            return None
+        name = '%s.%s_%d' % (os.path.basename(self.firmware), device.host, device.port)
+        return checkpoint_path(os.path.join(self.checkpoint_dir, re.sub(r'[^\w.-]', '_', name)))
+
+    def _prepare_checkpoint_dir(self):
+        if self.checkpoint_dir is None:
+            return
+        try:
+            mkdir_p(self.checkpoint_dir)
+        except OSError:
+            pass
+        if not os.access(self.checkpoint_dir, os.W_OK):
+            self.out.write("Can't write checkpoints to %s, failed transfers will start over\n" %
+                           self.checkpoint_dir)
+            self.checkpoint_dir = None
+
+    def run(self):
+        """
+        Upgrade every receiver, printing progress as it goes.
+
+        Returns
+        -------
+        out : bool
+            True if every receiver was upgraded or already current.
+        """
+        self._prepare_checkpoint_dir()
+        finished = threading.Event()
+        reporter = threading.Thread(target=self._report_progress, args=(finished,))
+        reporter.daemon = True
+        with open(self.firmware, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            image = memoryview(mapped)
+            fingerprint = None
+            if self.cache is not None:
+                fingerprint = image_fingerprint(image)
+            reporter.start()
+            try:
+                with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                    for _ in pool.map(lambda device: self._upgrade(device, image, fingerprint), self.devices):
+                        pass
+            finally:
+                finished.set()
+                reporter.join()
+                image.release()
+        self.print_summary()
+        return all(device.state in ('done', 'skipped') for device in self.devices)
+
+    def _upgrade(self, device, image, fingerprint):
+        checkpoint = self.checkpoint_path(device)
+        while device.attempts <= self.retries:
+            if device.attempts > 0:
+                time.sleep(device.retry_delay(self.retry_delay))
+            device.start_attempt()
+            try:
+                driver = self.connect(device.host, device.port)
+            except Exception as e:
+                device.finish('failed', 'connect: %s' % e)
+                continue
+            fio = None
+            try:
+                with Handler(Framer(driver.read, driver.write)) as link:
+                    if self.cache is not None:
+                        unique_id, version, current = check_current(link, self.cache, fingerprint)
+                        if current:
+                            device.finish('skipped')
+                            return
+                    fio = FileIO(link)
+                    fio.write(IMAGE_SET_FILENAME, image, progress_cb=device.on_progress, checkpoint=checkpoint)
+                    device.sent = device.size
+                    device.state = 'flashing'
+                    code = shell_command(link, UPGRADE_COMMAND, self.upgrade_timeout)
+                    if code == SHELL_COMMAND_TIMEOUT_CODE:
+                        raise RuntimeError('upgrade_tool timed out')
+                    if code != 0:
+                        # The device rejected the image, trying again won't help
+                        device.finish('failed', 'upgrade_tool code %d' % code)
+                        return
+                    if self.cache is not None:
+                        self.cache.record(unique_id, fingerprint, version)
+                    link(MsgReset(flags=0))
+                device.finish('done')
+                return
+            except Exception as e:
+                device.finish('failed', str(e) or type(e).__name__)
+            finally:
+                if fio is not None:
+                    device.transfer_stats.extend(stats.to_dict() for stats in fio.transfer_stats)
+                driver.close()
+
+    def _report_progress(self, finished):
+        while not finished.wait(FLEET_PROGRESS_INTERVAL_S):
+            self.print_progress()
+
+    def print_progress(self):
+        counts = dict.fromkeys(('queued', 'transferring', 'flashing', 'done', 'skipped', 'failed'), 0)
+        for device in self.devices:
+            counts[device.state] += 1
+        self.out.write("%d queued, %d transferring, %d flashing, %d done, %d skipped, %d failed\n" % (
+            counts['queued'], counts['transferring'], counts['flashing'], counts['done'], counts['skipped'],
+            counts['failed']))
+        for device in self.devices:
+            if device.state == 'transferring':
+                eta = device.eta()
+                self.out.write("  %-21s %3d%%  attempt %d  ETA %s\n" % (
+                    device.name, 100 * device.sent // max(self.size, 1), device.attempts,
+                    '%ds' % eta if eta is not None else '?'))
+            elif device.state == 'flashing':
+                self.out.write("  %-21s flashing\n" % device.name)
+        self.out.flush()
+
+    def print_summary(self):
+        self.out.write("\n%-21s %-7s %8s %9s  %s\n" % ('receiver', 'result', 'attempts', 'time (s)', 'error'))
+        for device in self.devices:
+            self.out.write("%-21s %-7s %8d %9.1f  %s\n" % (
+                device.name, device.state, device.attempts, device.elapsed, device.error or ''))
+        skipped = sum(device.state == 'skipped' for device in self.devices)
+        failed = sum(device.state not in ('done', 'skipped') for device in self.devices)
+        self.out.write("%d of %d receivers upgraded, %d already current\n" % (
+            len(self.devices) - failed - skipped, len(self.devices), skipped))
+        self.out.flush()
+
+    def dump_transfer_stats(self, path):
+        """Write the transfer telemetry of every receiver to `path` as JSON."""
+        with open(path, 'w') as f:
+            json.dump(dict((device.name, device.transfer_stats) for device in self.devices), f, indent=2)
+
+
+def main_fleet(args):
+    cache = None if args.force else UpgradeCache(args.upgrade_cache)
+    fleet = FleetUpgrade(read_fleet(args.fleet), args.firmware, jobs=args.jobs, retries=args.retries,
+                         checkpoint_dir=args.checkpoint_dir, upgrade_timeout=args.upgrade_timeout, cache=cache)
+    print('Upgrading %d receivers, %d at a time...' % (len(fleet.devices), args.jobs))
+    try:
+        ok = fleet.run()
+    finally:
+        if args.stats_json:
+            fleet.dump_transfer_stats(args.stats_json)
+    if not ok:
+        sys.exit(1)
 
 
 def main():
@@ -76,28 +688,48 @@ def main():
     Get configuration, get driver, and build handler and start it.
     """
     args = get_args()
+    if args.fleet:
+        return main_fleet(args)
     driver = serial_link.get_base_args_driver(args)
     # Driver with context
     # Handler with context
-    with Handler(Framer(driver.read, driver.write, verbose=args.verbose)) as link:
-        data = bytearray(open(args.firmware, 'rb').read())
+    with Handler(Framer(driver.read, driver.write, verbose=args.verbose)) as link, \
+            open(args.firmware, 'rb') as image:
+        image_len = os.fstat(image.fileno()).st_size
+        cache = None
+        if not args.force:
+            cache = UpgradeCache(args.upgrade_cache)
+            with source_view(image) as view:
+                fingerprint = image_fingerprint(view)
+            image.seek(0)
+            unique_id, version, current = check_current(link, cache, fingerprint)
+            if current:
+                print('Piksi is already running this image set, skipping the upgrade (use --force to upgrade).')
+                return
 
         def progress_cb(size, _):
             sys.stdout.write("\rProgress: %d%%    \r" %
-                             (100 * size / len(data)))
+                             (100 * size / image_len))
             sys.stdout.flush()
 
         print('Transferring image file...')
-        FileIO(link).write(
-            b"upgrade.image_set.bin", data, progress_cb=progress_cb)
+        checkpoint = checkpoint_path(args.firmware) if args.resume else None
+        fio = FileIO(link)
+        try:
+            fio.write(IMAGE_SET_FILENAME, image, progress_cb=progress_cb, checkpoint=checkpoint)
+        finally:
+            if args.stats_json:
+                dump_transfer_stats(fio, args.stats_json)
         print('Committing file to flash...')
         link.add_callback(serial_link.log_printer, SBP_MSG_LOG)
         link.add_callback(serial_link.printer, SBP_MSG_PRINT_DEP)
 
-        code = shell_command(link, b"upgrade_tool upgrade.image_set.bin", 300)
+        code = shell_command(link, UPGRADE_COMMAND, args.upgrade_timeout, output_cb=print_command_output)
         if code != 0:
             print('Failed to perform upgrade (code = %d)' % code)
             return
+        if cache is not None:
+            cache.record(unique_id, fingerprint, version)
         print('Resetting Piksi...')
         link(MsgReset(flags=0))
 
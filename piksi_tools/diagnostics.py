@@ -29,6 +29,7 @@ from sbp.settings import (
 from sbp.system import SBP_MSG_HEARTBEAT, MsgHeartbeat
 
 from . import serial_link
+from .settings import KEY_ENCODING, VALUE_ENCODING
 
 
 DIAGNOSTICS_FILENAME = "diagnostics.yaml"
@@ -111,7 +112,7 @@ class Diagnostics(object):
 
     def _handshake_callback(self, sbp_msg, **metadata):
         msg = MsgBootloaderHandshakeResp(sbp_msg)
-        self.diagnostics['versions']['bootloader'] = msg.version
+        self.diagnostics['versions']['bootloader'] = msg.version.decode('ascii')
         self.handshake_received = True
         self.link(MsgBootloaderJumpToApp(jump=0))
 
@@ -125,8 +126,10 @@ class Diagnostics(object):
         if not sbp_msg.payload:
             self.settings_received = True
         else:
-            section, setting, value, format_type = sbp_msg.payload[2:].split(
-                '\0')[:4]
+            section, setting, value = sbp_msg.payload[2:].split(b'\0')[:3]
+            section = section.decode(KEY_ENCODING)
+            setting = setting.decode(KEY_ENCODING)
+            value = value.decode(VALUE_ENCODING)
             if section not in self.diagnostics['settings']:
                 self.diagnostics['settings'][section] = {}
             self.diagnostics['settings'][section][setting] = value
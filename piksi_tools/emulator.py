@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+In-process Piksi emulator, for exercising the tools without hardware.
+
+The emulator answers file I/O, settings, heartbeat, unique ID, reset and
+command requests over a socket, through a link that can be made lossy,
+slow, jittery (which reorders messages) or bandwidth limited.  Its
+`driver` plugs in wherever a serial driver would:
+
+    with DeviceEmulator(loss=0.01, latency=0.005) as device:
+        with Handler(Framer(device.driver.read, device.driver.write)) as link:
+            FileIO(link).write(b'test.bin', data)
+
+Run as a module it serves one emulated device per TCP connection, so the
+command line tools can be pointed at it with `--tcp -p localhost:55555`.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import heapq
+import itertools
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from sbp.bootload import MsgBootloaderHandshakeResp
+from sbp.client import Framer
+from sbp.client.drivers.base_driver import BaseDriver
+from sbp.file_io import (SBP_MSG_FILEIO_CONFIG_REQ, SBP_MSG_FILEIO_READ_DIR_REQ,
+                         SBP_MSG_FILEIO_READ_REQ, SBP_MSG_FILEIO_REMOVE,
+                         SBP_MSG_FILEIO_WRITE_REQ, MsgFileioConfigResp,
+                         MsgFileioReadDirResp, MsgFileioReadResp,
+                         MsgFileioWriteResp)
+from sbp.flash import (SBP_MSG_STM_UNIQUE_ID_REQ, SBP_MSG_STM_UNIQUE_ID_RESP,
+                       MsgStmUniqueIdResp)
+from sbp.piksi import (SBP_MSG_COMMAND_REQ, SBP_MSG_RESET, MsgCommandOutput,
+                       MsgCommandResp)
+from sbp.settings import (SBP_MSG_SETTINGS_READ_BY_INDEX_REQ,
+                          SBP_MSG_SETTINGS_READ_REQ, SBP_MSG_SETTINGS_SAVE,
+                          SBP_MSG_SETTINGS_WRITE, MsgSettingsReadByIndexDone,
+                          MsgSettingsReadByIndexResp, MsgSettingsReadResp,
+                          MsgSettingsWriteResp)
+from sbp.system import MsgHeartbeat
+
+from piksi_tools import __version__ as VERSION
+from piksi_tools.settings import SETTINGS_WRITE_OK, SETTINGS_WRITE_UNKNOWN
+from piksi_tools.utils import FRAME_OVERHEAD_LEN
+
+MAX_PAYLOAD_SIZE = 255
+READ_DIR_RESP_CONTENTS_LEN = MAX_PAYLOAD_SIZE - 4
+HEARTBEAT_INTERVAL_S = 1.0
+DEFAULT_PORT = 55555
+
+DEFAULT_SETTINGS = OrderedDict([
+    ('system_info', OrderedDict([
+        ('firmware_version', 'v2.3.17'),
+        ('firmware_build_id', 'v2.3.17-emulated'),
+        ('hw_revision', 'piksi_multi'),
+        ('serial_number', '00000000'),
+    ])),
+    ('solution', OrderedDict([
+        ('soln_freq', '10'),
+        ('elevation_mask', '10'),
+    ])),
+    ('uart0', OrderedDict([
+        ('baudrate', '115200'),
+        ('enabled_sbp_messages', 'all'),
+    ])),
+])
+
+
+class LinkModel(object):
+    """
+    One direction of an emulated link.  Frames are serialized onto the
+    link at `bandwidth`, then take `latency` plus up to `jitter` seconds
+    to arrive, so frames given different delays overtake each other.
+
+    Fields
+    ----------
+    loss : float
+      Probability that a frame is dropped
+    latency : float
+      One way delay in seconds
+    jitter : float
+      Largest random extra delay in seconds
+    bandwidth : float
+      Bytes per second, None for unlimited
+    frames : int
+      Frames offered to the link
+    dropped : int
+      Frames the link dropped
+    """
+
+    def __init__(self, loss=0.0, latency=0.0, jitter=0.0, bandwidth=None, seed=None):
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.frames = 0
+        self.dropped = 0
+        self._rng = random.Random(seed)
+        self._free_at = 0.0
+
+    def schedule(self, length, now):
+        """
+        Time at which a frame of `length` bytes offered at `now` arrives,
+        or None if it's lost.
+        """
+        self.frames += 1
+        sent = now
+        if self.bandwidth:
+            sent = max(now, self._free_at) + length / float(self.bandwidth)
+            self._free_at = sent
+        if self._rng.random() < self.loss:
+            self.dropped += 1
+            return None
+        return sent + self.latency + self._rng.uniform(0, self.jitter)
+
+
+class EmulatorDriver(BaseDriver):
+    """
+    Host end of the socket to an emulated device.
+    """
+
+    def __init__(self, sock):
+        super(EmulatorDriver, self).__init__(sock)
+
+    def _read(self, size):
+        try:
+            data = self.handle.recv(size)
+        except (OSError, socket.error):
+            data = b''
+        if not data:
+            raise IOError("emulated device disconnected")
+        return data
+
+    def _write(self, s):
+        self.handle.sendall(bytes(s))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            self.handle.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self.handle.close()
+
+
+class DeviceEmulator(object):
+    """
+    Emulated Piksi answering requests on one end of a socket.
+
+    Fields
+    ----------
+    files : dict(bytes, bytearray)
+      Contents of the emulated file system, keyed by path without a
+      leading '/'.  Directories exist implicitly.
+    settings : OrderedDict(str, OrderedDict(str, str))
+      Setting values by section and name, in read-by-index order
+    unique_id : bytes
+      The 12 byte STM unique ID
+    driver : EmulatorDriver
+      Driver for the host end of the link, None when serving a socket
+      passed in by the caller
+    inbound : LinkModel
+      Host to device direction of the link
+    outbound : LinkModel
+      Device to host direction of the link
+    commands : list(bytes)
+      Commands received, in order
+    resets : int
+      Reset requests received
+    """
+
+    def __init__(self,
+                 files=None,
+                 settings=None,
+                 unique_id=bytes(bytearray(range(12))),
+                 sbp_version=(2, 7),
+                 loss=0.0,
+                 latency=0.0,
+                 jitter=0.0,
+                 bandwidth=None,
+                 window_size=100,
+                 batch_size=1,
+                 command_handler=None,
+                 command_duration=0.0,
+                 heartbeat_interval=HEARTBEAT_INTERVAL_S,
+                 seed=None,
+                 sock=None):
+        """
+        Parameters
+        ----------
+        files : dict(bytes, bytes) (optional)
+          Initial contents of the file system.
+        settings : dict(str, dict(str, str)) (optional)
+          Settings, defaults to DEFAULT_SETTINGS.
+        unique_id : bytes (optional)
+          STM unique ID to report.
+        sbp_version : (int, int) (optional)
+          SBP version advertised in the heartbeat.
+        loss, latency, jitter, bandwidth : (optional)
+          Link characteristics, applied to each direction, see LinkModel.
+        window_size, batch_size : int (optional)
+          Advertised in the file I/O config response.
+        command_handler : callable (optional)
+          Called with each command, returns its exit code or a tuple of the
+          exit code and the lines of output.  Commands succeed silently by
+          default.
+        command_duration : float (optional)
+          Seconds each command takes to run.
+        heartbeat_interval : float (optional)
+          Seconds between heartbeats, None to send none.
+        seed : int (optional)
+          Seed for the link randomness, for reproducible runs.
+        sock : socket (optional)
+          Serve this socket instead of creating a socket pair.
+        """
+        self.files = dict((self._path(name), bytearray(data)) for name, data in (files or {}).items())
+        self.settings = OrderedDict(
+            (section, OrderedDict(values)) for section, values in (settings or DEFAULT_SETTINGS).items())
+        self.unique_id = unique_id
+        self.sbp_version = sbp_version
+        # Each direction draws from its own generator, so the frames one
+        #   drops don't depend on how the two threads interleave.
+        self.inbound = LinkModel(loss, latency, jitter, bandwidth, seed)
+        self.outbound = LinkModel(loss, latency, jitter, bandwidth, None if seed is None else seed + 1)
+        self.window_size = window_size
+        self.batch_size = batch_size
+        self.command_handler = command_handler
+        self.command_duration = command_duration
+        self.heartbeat_interval = heartbeat_interval
+        self.commands = []
+        self.resets = 0
+
+        if sock is None:
+            sock, host_sock = socket.socketpair()
+            self.driver = EmulatorDriver(host_sock)
+        else:
+            self.driver = None
+        self._sock = sock
+        self._events = []
+        self._event_ids = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._listings = {}
+        self._handlers = {
+            SBP_MSG_FILEIO_CONFIG_REQ: self._fileio_config,
+            SBP_MSG_FILEIO_READ_REQ: self._fileio_read,
+            SBP_MSG_FILEIO_WRITE_REQ: self._fileio_write,
+            SBP_MSG_FILEIO_READ_DIR_REQ: self._fileio_read_dir,
+            SBP_MSG_FILEIO_REMOVE: self._fileio_remove,
+            SBP_MSG_SETTINGS_READ_REQ: self._settings_read,
+            SBP_MSG_SETTINGS_READ_BY_INDEX_REQ: self._settings_read_by_index,
+            SBP_MSG_SETTINGS_WRITE: self._settings_write,
+            SBP_MSG_SETTINGS_SAVE: lambda msg: [],
+            SBP_MSG_STM_UNIQUE_ID_REQ: self._unique_id,
+            # Before SBP 0.45 the ID was requested with an empty response
+            SBP_MSG_STM_UNIQUE_ID_RESP: self._unique_id,
+            SBP_MSG_COMMAND_REQ: self._command,
+            SBP_MSG_RESET: self._reset,
+        }
+        self._receiver = threading.Thread(target=self._receive_loop, name='emulator-rx')
+        self._receiver.daemon = True
+        self._scheduler = threading.Thread(target=self._schedule_loop, name='emulator-scheduler')
+        self._scheduler.daemon = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self.heartbeat_interval is not None:
+            self._push(time.monotonic(), 'heartbeat', None)
+        self._receiver.start()
+        self._scheduler.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self._sock.close()
+        if self.driver is not None:
+            self.driver.close()
+        for thread in (self._receiver, self._scheduler):
+            if thread.is_alive() and thread is not threading.current_thread():
+                thread.join()
+
+    def wait_closed(self):
+        """Block until the host end of the link goes away."""
+        self._receiver.join()
+
+    @staticmethod
+    def _path(name):
+        return bytes(name).rstrip(b'\0').strip(b'/')
+
+    def _push(self, when, kind, item):
+        with self._cond:
+            heapq.heappush(self._events, (when, next(self._event_ids), kind, item))
+            self._cond.notify()
+
+    def _read_device_socket(self, size):
+        try:
+            data = self._sock.recv(size)
+        except (OSError, socket.error):
+            data = b''
+        if not data:
+            raise IOError("host disconnected")
+        return data
+
+    def _receive_loop(self):
+        framer = Framer(self._read_device_socket, None, skip_metadata=True)
+        for msg, _ in framer:
+            now = time.monotonic()
+            with self._cond:
+                arrival = self.inbound.schedule(FRAME_OVERHEAD_LEN + msg.length, now)
+            if arrival is not None:
+                self._push(arrival, 'request', msg)
+
+    def _schedule_loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = time.monotonic()
+                    if self._events and self._events[0][0] <= now:
+                        break
+                    self._cond.wait(self._events[0][0] - now if self._events else None)
+                if self._stopped:
+                    return
+                _, _, kind, item = heapq.heappop(self._events)
+            try:
+                if kind == 'request':
+                    handler = self._handlers.get(item.msg_type)
+                    if handler is not None:
+                        self._respond(handler(item))
+                elif kind == 'heartbeat':
+                    major, minor = self.sbp_version
+                    self._respond([MsgHeartbeat(flags=(major << 16) | (minor << 8))])
+                    self._push(time.monotonic() + self.heartbeat_interval, 'heartbeat', None)
+                elif kind == 'delayed':
+                    self._respond(item)
+                else:
+                    self._sock.sendall(item)
+            except (OSError, socket.error):
+                return
+
+    def _respond(self, msgs, delay=0.0):
+        """Queue responses to arrive after the link's delays."""
+        now = time.monotonic()
+        if delay > 0:
+            self._push(now + delay, 'delayed', msgs)
+            return
+        for msg in msgs:
+            frame = msg.to_binary()
+            with self._cond:
+                arrival = self.outbound.schedule(len(frame), now)
+            if arrival is not None:
+                self._push(arrival, 'frame', frame)
+
+    def _fileio_config(self, msg):
+        sequence, = struct.unpack_from('<I', msg.payload)
+        return [MsgFileioConfigResp(sequence=sequence,
+                                    window_size=self.window_size,
+                                    batch_size=self.batch_size,
+                                    fileio_version=0)]
+
+    def _fileio_read(self, msg):
+        sequence, offset, chunk_size = struct.unpack_from('<IIB', msg.payload)
+        data = self.files.get(self._path(msg.payload[9:]), b'')
+        return [MsgFileioReadResp(sequence=sequence, contents=list(data[offset:offset + chunk_size]))]
+
+    def _fileio_write(self, msg):
+        sequence, offset = struct.unpack_from('<II', msg.payload)
+        name, data = bytes(msg.payload[8:]).split(b'\0', 1)
+        name = self._path(name)
+        if name not in self.files:
+            self.files[name] = bytearray()
+            self._listings.clear()
+        contents = self.files[name]
+        end = offset + len(data)
+        if len(contents) < end:
+            contents.extend(bytearray(end - len(contents)))
+        contents[offset:end] = data
+        return [MsgFileioWriteResp(sequence=sequence)]
+
+    def _listing(self, dirname):
+        if dirname not in self._listings:
+            prefix = dirname + b'/' if dirname not in (b'', b'.') else b''
+            names = set()
+            for path in self.files:
+                if path.startswith(prefix):
+                    name, sep, _ = path[len(prefix):].partition(b'/')
+                    names.add(name + sep)
+            self._listings[dirname] = sorted(names)
+        return self._listings[dirname]
+
+    def _fileio_read_dir(self, msg):
+        sequence, offset = struct.unpack_from('<II', msg.payload)
+        listing = self._listing(self._path(msg.payload[8:]))
+        contents = b''
+        for name in listing[offset:]:
+            if len(contents) + len(name) + 1 > READ_DIR_RESP_CONTENTS_LEN:
+                break
+            contents += name + b'\0'
+        return [MsgFileioReadDirResp(sequence=sequence, contents=contents)]
+
+    def _fileio_remove(self, msg):
+        if self.files.pop(self._path(msg.payload), None) is not None:
+            self._listings.clear()
+        return []
+
+    def _setting_by_name(self, payload):
+        section, name = bytes(payload).split(b'\0')[:2]
+        return section.decode('ascii'), name.decode('ascii')
+
+    def _settings_read(self, msg):
+        section, name = self._setting_by_name(msg.payload)
+        setting = b'%s\0%s\0' % (section.encode('ascii'), name.encode('ascii'))
+        value = self.settings.get(section, {}).get(name)
+        if value is not None:
+            setting += value.encode('ascii') + b'\0'
+        return [MsgSettingsReadResp(setting=setting)]
+
+    def _settings_read_by_index(self, msg):
+        index, = struct.unpack_from('<H', msg.payload)
+        settings = [(section, name, value)
+                    for section, values in self.settings.items()
+                    for name, value in values.items()]
+        if index >= len(settings):
+            return [MsgSettingsReadByIndexDone()]
+        setting = b''.join(X.encode('ascii') + b'\0' for X in settings[index])
+        return [MsgSettingsReadByIndexResp(index=index, setting=setting)]
+
+    def _settings_write(self, msg):
+        section, name, value = bytes(msg.payload).split(b'\0')[:3]
+        values = self.settings.get(section.decode('ascii'))
+        if values is None or name.decode('ascii') not in values:
+            status = SETTINGS_WRITE_UNKNOWN
+        else:
+            values[name.decode('ascii')] = value.decode('ascii')
+            status = SETTINGS_WRITE_OK
+        return [MsgSettingsWriteResp(status=status, setting=bytes(msg.payload))]
+
+    def _unique_id(self, msg):
+        if msg.msg_type == SBP_MSG_STM_UNIQUE_ID_RESP and len(msg.payload) > 0:
+            return []
+        return [MsgStmUniqueIdResp(stm_id=list(bytearray(self.unique_id)))]
+
+    def _command(self, msg):
+        sequence, = struct.unpack_from('<I', msg.payload)
+        command = bytes(msg.payload[4:]).rstrip(b'\0')
+        self.commands.append(command)
+        result = self.command_handler(command) if self.command_handler else 0
+        code, output = result if isinstance(result, tuple) else (result, [])
+        msgs = [MsgCommandOutput(sequence=sequence, line=line) for line in output]
+        msgs.append(MsgCommandResp(sequence=sequence, code=code))
+        self._respond(msgs, self.command_duration)
+        return []
+
+    def _reset(self, msg):
+        self.resets += 1
+        return [MsgBootloaderHandshakeResp(flags=0, version=b'v1.2')]
+
+
+def get_args():
+    """
+    Get and parse arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Piksi emulator version ' + VERSION,
+        epilog='Connections are served concurrently, each by its own emulated device '
+               'with its own files and settings.')
+    parser.add_argument('--host', default='localhost', help='address to listen on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='TCP port to listen on.')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability of dropping each message.')
+    parser.add_argument('--latency', type=float, default=0.0, help='one way link delay in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='largest random extra delay in seconds.')
+    parser.add_argument('--bandwidth', type=float, default=None, help='link bandwidth in bytes per second.')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the link randomness.')
+    return parser.parse_args()
+
+
+def serve_connection(conn, address, args):
+    """Emulate a device on an accepted connection until the host goes away."""
+    print("Connection from %s:%d" % address[:2])
+    with DeviceEmulator(loss=args.loss, latency=args.latency, jitter=args.jitter,
+                        bandwidth=args.bandwidth, seed=args.seed, sock=conn) as device:
+        device.wait_closed()
+    print("Connection from %s:%d closed" % address[:2])
+
+
+def main():
+    args = get_args()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((args.host, args.port))
+    server.listen(5)
+    print("Emulating a Piksi on %s:%d" % (args.host, args.port))
+    try:
+        while True:
+            conn, address = server.accept()
+            thread = threading.Thread(target=serve_connection, args=(conn, address, args))
+            thread.daemon = True
+            thread.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,38 +13,63 @@
 from __future__ import absolute_import, print_function
 from future.builtins import bytes  # makes python 2 `bytes()` more similar to python 3
 
-from collections import defaultdict
+from collections import deque
+from contextlib import ExitStack, contextmanager
 
+import binascii
+import bisect
+import hashlib
+import heapq
 import itertools
+import json
+import mmap
+import os
 import random
-import time
+import struct
 import threading
 import sys
-
-from six.moves.queue import Queue
+import warnings
 
 from sbp.client import Framer, Handler
-from sbp.file_io import (SBP_MSG_FILEIO_READ_DIR_RESP, SBP_MSG_FILEIO_READ_RESP,
+from sbp.file_io import (SBP_MSG_FILEIO_READ_DIR_RESP, SBP_MSG_FILEIO_READ_REQ,
+                         SBP_MSG_FILEIO_READ_RESP, SBP_MSG_FILEIO_WRITE_REQ,
                          SBP_MSG_FILEIO_WRITE_RESP, SBP_MSG_FILEIO_CONFIG_RESP,
-                         MsgFileioReadDirReq, MsgFileioReadDirResp,
-                         MsgFileioReadReq, MsgFileioRemove, MsgFileioWriteReq,
+                         MsgFileioReadDirReq, MsgFileioRemove,
                          MsgFileioConfigReq, MsgFileioConfigResp)
+from sbp.msg import SBP_PREAMBLE, SENDER_ID
 
 from piksi_tools import serial_link
 from piksi_tools import __version__ as VERSION
-from piksi_tools.utils import Time
+from piksi_tools.utils import FRAME_CRC, FRAME_HEADER, FRAME_OVERHEAD_LEN, Time, mkdir_p
 
 MAX_PAYLOAD_SIZE = 255
 SBP_FILEIO_WINDOW_SIZE = 100
 SBP_FILEIO_BATCH_SIZE = 1
+SBP_FILEIO_INITIAL_WINDOW = 4
 SBP_FILEIO_TIMEOUT = 3
+SBP_FILEIO_MIN_TIMEOUT = 0.25
+SBP_FILEIO_MAX_TIMEOUT = 10
 MAXIMUM_RETRIES = 20
 PROGRESS_CB_REDUCTION_FACTOR = 100
 TEXT_ENCODING = 'utf-8'  # used for printing out directory listings and files
 WAIT_SLEEP_S = 0.001
 CONFIG_REQ_RETRY_MS = 100
 CONFIG_REQ_TIMEOUT_MS = 1000
-READDIR_WAIT_S = 5.0
+READDIR_LOOKAHEAD = 32
+EXPIRE_HEAP_COMPACT_FACTOR = 2
+READ_RESP_OVERHEAD_LEN = 4  # sequence field preceding the contents of a read response
+READ_BUFFER_INITIAL_SIZE = 64 * 1024
+READ_ITER_CHUNK_BYTES = 64 * 1024
+CHECKPOINT_SUFFIX = '.checkpoint'
+CHECKPOINT_INTERVAL_BYTES = 64 * 1024
+SYNC_MANIFEST_NAME = '.fileio-sync.json'
+READ_REQ_HEADER = struct.Struct('<IIB')  # sequence, offset, chunk size
+WRITE_REQ_HEADER = struct.Struct('<II')  # sequence, offset
+STATS_RTT_BUCKETS_MS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+STATS_OFFSET_BUCKET_BYTES = 64 * 1024
+STATS_SAMPLE_INTERVAL_S = 0.05
+STATS_MAX_SAMPLES = 1000
+DIGEST_BLOCK_SIZE = 1024 * 1024
 
 
 class PendingRequest(object):
@@ -65,9 +90,12 @@ class PendingRequest(object):
       The index of this object into the pending write map
     completed : bool
       If the request is already completed
+    expire_token : int
+      Token of the live entry for this request in the expiration heap,
+      older entries carrying a different token are stale
     """
 
-    __slots__ = ["message", "time", "time_expire", "tries", "index", "completed"]
+    __slots__ = ["message", "time", "time_expire", "tries", "index", "completed", "expire_token"]
 
     def __init__(self, index):
         self.index = index
@@ -100,6 +128,234 @@ class PendingRequest(object):
         return self
 
 
+class CongestionWindow(object):
+    """
+    AIMD (additive increase, multiplicative decrease) controller for the
+    number of requests kept in flight.
+
+    The window starts small and doubles every round trip (slow start)
+    until it reaches the slow start threshold, after which it grows by
+    about one request per round trip.  A timeout halves the window, at
+    most once per round trip.  The window never exceeds the limit
+    advertised by the device.
+
+    Fields
+    ----------
+    limit : int
+      Maximum window size (as reported by the device config)
+    size : float
+      The current congestion window, in requests
+    ssthresh : float
+      Slow start threshold, in requests
+    _last_decrease : Time
+      The last time the window was shrunk
+    """
+
+    def __init__(self, limit, initial=SBP_FILEIO_INITIAL_WINDOW):
+        self.limit = limit
+        self.size = float(max(1, min(initial, limit)))
+        self.ssthresh = float(limit)
+        self._last_decrease = None
+
+    @property
+    def window(self):
+        return int(self.size)
+
+    def on_ack(self):
+        """
+        Record a clean (never retried) completion.
+        """
+        if self.size < self.ssthresh:
+            self.size += 1
+        else:
+            self.size += 1 / self.size
+        self.size = min(self.size, float(self.limit))
+
+    def on_timeout(self, sent_time):
+        """
+        Record a request timing out.  Losses of requests sent before the
+        last decrease belong to the same congestion event and are ignored.
+        """
+        if self._last_decrease is not None and sent_time < self._last_decrease:
+            return
+        self.ssthresh = max(self.size / 2, 1.0)
+        self.size = self.ssthresh
+        self._last_decrease = Time.now()
+
+
+class RttEstimator(object):
+    """
+    Estimates the retransmission timeout for SBP file I/O requests from
+    observed round trip times, after RFC 6298.
+
+    Only requests that were never retried are sampled (Karn's rule), since
+    the response to a retried request can't be matched to a particular
+    send.  Each retry of a request doubles its timeout.
+
+    Fields
+    ----------
+    srtt : float
+      Smoothed round trip time in seconds, None until the first sample
+    rttvar : float
+      Round trip time variation in seconds
+    rto : float
+      Current retransmission timeout in seconds
+    """
+
+    ALPHA = 1 / 8.0
+    BETA = 1 / 4.0
+    K = 4
+
+    def __init__(self, initial=SBP_FILEIO_TIMEOUT):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = float(initial)
+
+    def sample(self, rtt):
+        """
+        Update the estimate with a round trip time measured in seconds.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        rto = self.srtt + self.K * self.rttvar
+        self.rto = min(max(rto, SBP_FILEIO_MIN_TIMEOUT), SBP_FILEIO_MAX_TIMEOUT)
+
+    def timeout(self, tries=0):
+        """
+        Timeout for a request that has already been retried `tries` times.
+        """
+        return Time.from_float(min(self.rto * (2 ** tries), SBP_FILEIO_MAX_TIMEOUT))
+
+
+class TransferStats(object):
+    """
+    Telemetry recorded by a SelectiveRepeater over one transfer.  It is
+    updated from both the sending and the callback threads and may be read
+    while the transfer runs, `to_dict` takes a consistent snapshot.
+
+    Fields
+    ----------
+    name : str
+      Description of the transfer, e.g. the operation and file name
+    requests : int
+      Requests sent, not counting retries
+    retries : int
+      Requests sent again after timing out
+    rtt_histogram : list(int)
+      Counts of round trip times up to each bound in STATS_RTT_BUCKETS_MS,
+      and beyond the last one
+    retries_by_offset : dict(int, int)
+      Retries keyed by the start of the STATS_OFFSET_BUCKET_BYTES range
+      their request's offset falls in
+    window_samples : list(tuple(float, int, int))
+      Seconds since the start, requests in flight and the congestion
+      window, sampled as requests are sent.  The sampling interval doubles
+      each time STATS_MAX_SAMPLES is reached.
+    window_blocked_s : float
+      Time spent waiting for room in the window
+    raw_bytes : int
+      Bytes of every frame sent or received, retries included
+    goodput_bytes : int
+      File data (or directory listing) bytes delivered, once per request
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.requests = 0
+        self.retries = 0
+        self.rtt_histogram = [0] * (len(STATS_RTT_BUCKETS_MS) + 1)
+        self.retries_by_offset = {}
+        self.window_samples = []
+        self.window_blocked_s = 0.0
+        self.raw_bytes = 0
+        self.goodput_bytes = 0
+        self._sample_interval = STATS_SAMPLE_INTERVAL_S
+        self._start = Time.now()
+        self._last_activity = self._start
+        self._lock = threading.Lock()
+
+    def on_send(self, msgs, time_now, in_flight, window):
+        with self._lock:
+            self.requests += len(msgs)
+            self.raw_bytes += sum(_frame_len(msg) for msg in msgs)
+            self._last_activity = time_now
+            elapsed = (time_now - self._start).to_float()
+            if self.window_samples and elapsed - self.window_samples[-1][0] < self._sample_interval:
+                return
+            if len(self.window_samples) >= STATS_MAX_SAMPLES:
+                del self.window_samples[1::2]
+                self._sample_interval *= 2
+            self.window_samples.append((elapsed, in_flight, window))
+
+    def on_retry(self, msg, time_now):
+        with self._lock:
+            self.retries += 1
+            self.raw_bytes += _frame_len(msg)
+            self._last_activity = time_now
+            offset = getattr(msg, 'offset', None)
+            if offset is not None:
+                bucket = offset - offset % STATS_OFFSET_BUCKET_BYTES
+                self.retries_by_offset[bucket] = self.retries_by_offset.get(bucket, 0) + 1
+
+    def on_receive(self, resp):
+        with self._lock:
+            self.raw_bytes += _frame_len(resp)
+            self._last_activity = Time.now()
+
+    def on_complete(self, req, resp, rtt=None):
+        """
+        Record a request's first response, and its round trip time in
+        seconds if it can be measured.
+        """
+        if isinstance(req, FramedWriteReq):
+            delivered = req.end - req.offset
+        elif resp.msg_type in (SBP_MSG_FILEIO_READ_RESP, SBP_MSG_FILEIO_READ_DIR_RESP):
+            delivered = max(0, (resp.length or 0) - READ_RESP_OVERHEAD_LEN)
+        else:
+            delivered = 0
+        with self._lock:
+            self.goodput_bytes += delivered
+            if rtt is not None:
+                self.rtt_histogram[bisect.bisect_left(STATS_RTT_BUCKETS_MS, rtt * 1000)] += 1
+
+    def on_blocked(self, seconds):
+        with self._lock:
+            self.window_blocked_s += seconds
+
+    def to_dict(self):
+        with self._lock:
+            elapsed = (self._last_activity - self._start).to_float()
+            labels = ['<=%d' % X for X in STATS_RTT_BUCKETS_MS] + ['>%d' % STATS_RTT_BUCKETS_MS[-1]]
+            return {
+                'name': self.name,
+                'elapsed_s': elapsed,
+                'requests': self.requests,
+                'retries': self.retries,
+                'rtt_ms_histogram': dict(zip(labels, self.rtt_histogram)),
+                'retries_by_offset': dict(('%d-%d' % (start, start + STATS_OFFSET_BUCKET_BYTES - 1), count)
+                                          for start, count in sorted(self.retries_by_offset.items())),
+                'window_samples': [list(X) for X in self.window_samples],
+                'window_blocked_s': self.window_blocked_s,
+                'raw_bytes': self.raw_bytes,
+                'goodput_bytes': self.goodput_bytes,
+                'raw_bytes_per_s': self.raw_bytes / elapsed if elapsed > 0 else None,
+                'goodput_bytes_per_s': self.goodput_bytes / elapsed if elapsed > 0 else None,
+            }
+
+
+def _transfer_name(operation, filename):
+    return operation + ' ' + bytes(filename).decode(TEXT_ENCODING, 'replace')
+
+
+def _frame_len(msg):
+    """Length on the wire of a framed (sent or received) message."""
+    return FRAME_OVERHEAD_LEN + (getattr(msg, 'length', None) or 0)
+
+
 class SelectiveRepeater(object):
     """
     Selective repeater for SBP file I/O requests
@@ -109,19 +365,30 @@ class SelectiveRepeater(object):
     _pending_map : list(PendingRequest)
       List (used as a map) of PendingRequest objects, used to track
       outstanding requests.
-    _request_pool : Queue
-      Queue of available requests (recorded by index number)
+    _request_pool : deque(PendingRequest)
+      Pool of available requests
+    _cwnd : CongestionWindow
+      Controls how much of the pool may be in flight at once
+    _rtt : RttEstimator
+      Provides request timeouts from measured round trip times
+    _stats : TransferStats
+      Telemetry for the transfer
+    _cond : threading.Condition
+      Guards the request pool and config state, signalled whenever a
+      request completes or the config response arrives so that waiters
+      wake up immediately instead of polling.
     _seqmap : dict(int,int)
       Dictionary mapping SBP request sequence IDs to their corresponding
       request index.
     _batch_msgs : list
       Collector for a batch of messages to be sent in one
       buffer via the link
-    _last_check_time : Time
-      The last time we checked if any packets had expired
-    _expire_map : dict(Time, dict(PendingRequest, PendingRequest))
-      Dictionary which records the future time at which a request
-      will expire.
+    _expire_heap : list(tuple(Time, int, PendingRequest))
+      Min-heap which records the future time at which a request
+      will expire.  Entries are invalidated lazily: an entry is stale
+      once its request completes or is re-armed with a new token.
+    _expire_tokens : iterator(int)
+      Source of unique tokens for expiration heap entries.
 
     _msg_type : int
       The message type we're currently sending
@@ -134,7 +401,7 @@ class SelectiveRepeater(object):
       ID of the thread that handles link writes
     """
 
-    def __init__(self, link, msg_type, cb=None, skip_config=False):
+    def __init__(self, link, msg_type, cb=None, skip_config=False, stats=None):
         """
         Args
         ---
@@ -144,6 +411,8 @@ class SelectiveRepeater(object):
           The type of message being sent
         cb :
           Invoked when SBP message with type `msg_type` is received
+        stats : TransferStats
+          Where to record telemetry, a new object if not given
         """
 
         self._link = link
@@ -152,8 +421,10 @@ class SelectiveRepeater(object):
 
         self._seqmap = {}
         self._batch_msgs = []
-        self._last_check_time = Time.now()
-        self._expire_map = defaultdict(dict)
+        self._expire_tokens = itertools.count()
+        self._cond = threading.Condition()
+        self._rtt = RttEstimator()
+        self._stats = stats if stats is not None else TransferStats()
 
         self._init_fileio_config(SBP_FILEIO_WINDOW_SIZE, SBP_FILEIO_BATCH_SIZE, PROGRESS_CB_REDUCTION_FACTOR)
 
@@ -164,13 +435,14 @@ class SelectiveRepeater(object):
         self._total_retries = 0
 
         self._config_retry_time = None
+        self._config_msg = None
         self._skip_config = skip_config
 
     def _init_fileio_config(self, window_size, batch_size, progress_cb_reduction_factor):
         self._pending_map = [PendingRequest(X) for X in range(window_size)]
-        self._request_pool = Queue(window_size)
-        for pending_req in self._pending_map:
-            self._request_pool.put(pending_req)
+        self._request_pool = deque(self._pending_map)
+        self._expire_heap = []
+        self._cwnd = CongestionWindow(window_size)
         self._batch_size = batch_size
         self._progress_cb_reduction_factor = progress_cb_reduction_factor
 
@@ -201,8 +473,9 @@ class SelectiveRepeater(object):
 
     def _return_pending_req(self, pending_req):
         """
-        Return a pending request to the write pool and clean any
-        entries in the expiration map.
+        Return a pending request to the write pool.  Any entries left
+        in the expiration heap become stale and are dropped when they
+        reach the top of the heap.
         """
         self._verify_cb_thread()
         pending_req.completed = True
@@ -211,10 +484,19 @@ class SelectiveRepeater(object):
         except AttributeError:
             # Got a completion for something that was never requested
             return
-        self._try_remove_keys(self._seqmap, msg.sequence)
-        if self._try_remove_keys(self._expire_map[pending_req.time_expire], pending_req):
-            # Only put the request back if it was successfully removed
-            self._request_pool.put(pending_req)
+        time_now = Time.now()
+        with self._cond:
+            if self._try_remove_keys(self._seqmap, msg.sequence):
+                # Only put the request back if it was successfully removed
+                self._request_pool.append(pending_req)
+                if pending_req.tries == 0:
+                    rtt = (time_now - pending_req.time).to_float()
+                    self._rtt.sample(rtt)
+                    self._cwnd.on_ack()
+                else:
+                    rtt = None
+                self._cond.notify_all()
+                return rtt
 
     def _record_pending_req(self, msg, time_now, expiration_time):
         """
@@ -222,46 +504,81 @@ class SelectiveRepeater(object):
         expiration time in a map.
         """
         self._verify_link_thread()
-        # Queue.get will block if no requests are available
-        pending_req = self._request_pool.get(True)
+        # The caller has already waited for the window to be available
+        with self._cond:
+            pending_req = self._request_pool.popleft()
         assert self._pending_map[pending_req.index].index == pending_req.index
         self._seqmap[msg.sequence] = pending_req.index
         self._pending_map[pending_req.index].track(msg, time_now, expiration_time)
-        self._expire_map[expiration_time][pending_req] = pending_req
+        self._schedule_expire(pending_req)
+
+    def _schedule_expire(self, pending_req):
+        """
+        Push the current expiration time of a request onto the expiration
+        heap, superseding any entry previously pushed for it.
+        """
+        token = next(self._expire_tokens)
+        pending_req.expire_token = token
+        heapq.heappush(self._expire_heap, (pending_req.time_expire, token, pending_req))
+        if len(self._expire_heap) > EXPIRE_HEAP_COMPACT_FACTOR * len(self._pending_map):
+            self._compact_expire_heap()
+
+    def _expire_entry_stale(self, entry):
+        _, token, pending_req = entry
+        return pending_req.completed or pending_req.expire_token != token
+
+    def _compact_expire_heap(self):
+        """
+        Drop stale entries so the heap never holds much more than one
+        entry per outstanding request.
+        """
+        self._expire_heap[:] = [entry for entry in self._expire_heap
+                                if not self._expire_entry_stale(entry)]
+        heapq.heapify(self._expire_heap)
 
     def _config_cb(self, msg, **metadata):
-        self._config_msg = msg
-        self._init_fileio_config(msg.window_size, msg.batch_size, PROGRESS_CB_REDUCTION_FACTOR * 2)
+        with self._cond:
+            if self._config_msg is not None:
+                # Duplicate response to a retried request, the window may
+                #   already be in use so it must not be re-initialized.
+                return
+            self._config_msg = msg
+            self._init_fileio_config(msg.window_size, msg.batch_size, PROGRESS_CB_REDUCTION_FACTOR * 2)
+            self._cond.notify_all()
 
     def _request_cb(self, msg, **metadata):
         """
         Process request completions.
         """
+        self._stats.on_receive(msg)
         index = self._seqmap.get(msg.sequence)
         if index is None:
             return
         pending_req = self._pending_map[index]
+        req = pending_req.message
         if self._callback:
-            self._callback(pending_req.message, msg)
-        self._return_pending_req(pending_req)
+            self._callback(req, msg)
+        rtt = self._return_pending_req(pending_req)
+        self._stats.on_complete(req, msg, rtt)
 
     def _has_pending(self):
-        return self._request_pool.qsize() != len(self._pending_map)
+        return len(self._request_pool) != len(self._pending_map)
 
-    def _retry_send(self, check_time, pending_req, delete_keys):
+    def _retry_send(self, pending_req):
         """
         Retry a request by updating it's expire time on the object
-        itself and in the expiration map.
+        itself and in the expiration heap.
         """
         self._total_retries += 1
         self._total_sends += 1
-        timeout_delta = Time(SBP_FILEIO_TIMEOUT)
+        with self._cond:
+            timeout_delta = self._rtt.timeout(pending_req.tries + 1)
         send_time = Time.now()
         new_expire = send_time + timeout_delta
         pending_req.record_retry(send_time, new_expire)
-        self._expire_map[new_expire][pending_req] = pending_req
+        self._schedule_expire(pending_req)
         self._link(pending_req.message)
-        delete_keys.append(pending_req)
+        self._stats.on_retry(pending_req.message, send_time)
 
     def _try_remove_keys(self, d, *keys):
         success = True
@@ -274,35 +591,58 @@ class SelectiveRepeater(object):
 
     def _check_pending(self):
         """
-        Scans from the last check time to the current time looking
-        for requests that are due to expire and retries them if
-        necessary.
+        Pops requests that are due to expire off the expiration heap
+        and retries them if necessary.  The cost depends on the number
+        of expired entries, not on the time elapsed since the last check.
         """
         time_now = Time.now()
-        timeout_delta = Time(SBP_FILEIO_TIMEOUT)
-        for check_time in Time.iter_since(self._last_check_time, time_now):
-            pending_reqs = self._expire_map[check_time]
-            retried_writes = []
-            for pending_req in list(pending_reqs):
-                time_expire = pending_req.time + timeout_delta
-                if time_now >= time_expire:
-                    if pending_req.tries >= MAXIMUM_RETRIES:
-                        raise Exception('Timed out')
-                    # If the completion map becomes inconsistent (because
-                    #   things are completing at the same time they're
-                    #   being re-tried) then the `completed` field should
-                    #   prevent us from re-sending a write in this case.
-                    if not pending_req.completed:
-                        self._retry_send(check_time, pending_req, retried_writes)
-            # Pending writes can be marked completed while this function
-            #   is running, so a key error means is was marked completed
-            #   after we sent a retry (therefore _try_remove_keys ignores
-            #   key errors).
-            self._try_remove_keys(self._expire_map[check_time], *retried_writes)
-        self._last_check_time = time_now
+        expire_heap = self._expire_heap
+        while expire_heap and time_now >= expire_heap[0][0]:
+            entry = heapq.heappop(expire_heap)
+            # Requests can be marked completed while this function is
+            #   running (or after being re-armed), the `completed` field
+            #   and the token prevent us from re-sending in this case.
+            if self._expire_entry_stale(entry):
+                continue
+            pending_req = entry[2]
+            if pending_req.tries >= MAXIMUM_RETRIES:
+                raise Exception('Timed out')
+            with self._cond:
+                self._cwnd.on_timeout(pending_req.time)
+            self._retry_send(pending_req)
+
+    def _in_flight(self):
+        return len(self._pending_map) - len(self._request_pool)
 
     def _window_available(self, batch_size):
-        return self._request_pool.qsize() >= batch_size
+        if len(self._request_pool) < batch_size:
+            return False
+        # Always let a batch out onto an idle link, even if it's larger
+        #   than the congestion window, so we can't stall.
+        in_flight = self._in_flight()
+        return in_flight == 0 or in_flight + batch_size <= self._cwnd.window
+
+    def _wait_timeout(self, deadline):
+        """
+        Seconds until `deadline` (or None to wait indefinitely), never
+        shorter than the timer resolution so we don't spin.
+        """
+        if deadline is None:
+            return None
+        return max(WAIT_SLEEP_S, (deadline - Time.now()).to_float())
+
+    def _wait_until(self, ready):
+        """
+        Block until `ready()` holds, retrying requests as their
+        expiration deadlines pass.  Completions wake us up via `_cond`.
+        """
+        while True:
+            self._check_pending()
+            with self._cond:
+                if ready():
+                    return
+                next_expire = self._expire_heap[0][0] if self._expire_heap else None
+                self._cond.wait(self._wait_timeout(next_expire))
 
     def _ensure_config_req_sent(self):
         if self._config_retry_time is not None:
@@ -311,7 +651,6 @@ class SelectiveRepeater(object):
         self._config_retry_time = now + Time(0, CONFIG_REQ_RETRY_MS)
         self._config_timeout = now + Time(0, CONFIG_REQ_TIMEOUT_MS)
         self._config_seq = random.randint(0, 0xffffffff)
-        self._config_msg = None
         self._link(MsgFileioConfigReq(sequence=self._config_seq))
 
     def _config_received(self):
@@ -333,14 +672,23 @@ class SelectiveRepeater(object):
         if self._skip_config:
             return
         while not self._config_received():
-            time.sleep(WAIT_SLEEP_S)
+            with self._cond:
+                if self._config_msg is None:
+                    deadline = min(self._config_retry_time, self._config_timeout)
+                    self._cond.wait(self._wait_timeout(deadline))
 
     def _wait_window_available(self, batch_size):
         self._wait_config_received()
-        while not self._window_available(batch_size):
-            self._check_pending()
-            if not self._window_available(batch_size):
-                time.sleep(WAIT_SLEEP_S)
+        with self._cond:
+            if self._window_available(batch_size):
+                return
+        blocked_since = Time.now()
+        self._wait_until(lambda: self._window_available(batch_size))
+        self._stats.on_blocked((Time.now() - blocked_since).to_float())
+
+    @property
+    def stats(self):
+        return self._stats
 
     @property
     def total_retries(self):
@@ -354,11 +702,21 @@ class SelectiveRepeater(object):
     def progress_cb_reduction_factor(self):
         return self._progress_cb_reduction_factor
 
+    @property
+    def window_size(self):
+        """The current congestion window, in requests."""
+        return self._cwnd.window
+
+    @property
+    def batch_size(self):
+        """The current batch size, never larger than the window."""
+        return max(1, min(self._batch_size, self._cwnd.window))
+
     def send(self, msg, batch_size=None):
         if batch_size is not None:
             self._send(msg, batch_size)
         else:
-            self._send(msg, self._batch_size)
+            self._send(msg, self.batch_size)
 
     def _send(self, msg, batch_size):
         """
@@ -376,11 +734,13 @@ class SelectiveRepeater(object):
         if len(self._batch_msgs) >= batch_size:
             self._wait_window_available(max(len(self._batch_msgs), batch_size))
             time_now = Time.now()
-            expiration_time = time_now + Time(SBP_FILEIO_TIMEOUT)
+            with self._cond:
+                expiration_time = time_now + self._rtt.timeout()
             for msg in self._batch_msgs:
                 self._record_pending_req(msg, time_now, expiration_time)
             self._link(*self._batch_msgs)
             self._total_sends += len(self._batch_msgs)
+            self._stats.on_send(self._batch_msgs, time_now, self._in_flight(), self._cwnd.window)
             del self._batch_msgs[:]
 
     def flush(self):
@@ -389,99 +749,726 @@ class SelectiveRepeater(object):
         pending requests to complete.
         """
         self.send(None, batch_size=0)
-        while self._has_pending():
-            self._check_pending()
-            time.sleep(WAIT_SLEEP_S)
+        self._wait_until(lambda: not self._has_pending())
+
+
+class WriteCheckpoint(object):
+    """
+    Journal of how much of a write has been acknowledged by the device,
+    persisted to a sidecar file so that an interrupted write can be
+    resumed instead of restarted.
+
+    Fields
+    ----------
+    path : str
+      Path of the sidecar file
+    offset : int
+      All data before this offset has been acknowledged
+    _ident : dict
+      Identifies the write: remote file name, data size and digest
+    _acked : dict(int, int)
+      Acknowledged chunks past `offset`, mapping start to end offset
+    _saved_offset : int
+      The offset last persisted to the sidecar file
+    """
+
+    def __init__(self, path, filename, data):
+        self.path = path
+        self.offset = 0
+        self._ident = {
+            'filename': bytes(filename).decode('latin-1'),
+            'size': len(data),
+            'sha1': hashlib.sha1(data).hexdigest(),
+        }
+        self._acked = {}
+        self._saved_offset = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Returns the offset recorded by a previous run of the same write,
+        or 0 if there is no usable journal.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                journal = json.load(f)
+        except (IOError, OSError, ValueError):
+            return 0
+        if any(journal.get(key) != value for key, value in self._ident.items()):
+            return 0
+        return int(journal.get('offset', 0))
+
+    def start(self, offset):
+        self.offset = offset
+        self._saved_offset = offset
+        self._acked.clear()
+
+    def ack(self, start, end):
+        """
+        Record that the data in [start, end) was acknowledged, persisting
+        the contiguous offset every CHECKPOINT_INTERVAL_BYTES.
+        """
+        with self._lock:
+            if start < self.offset:
+                return
+            self._acked[start] = end
+            while self.offset in self._acked:
+                self.offset = self._acked.pop(self.offset)
+            if self.offset - self._saved_offset >= CHECKPOINT_INTERVAL_BYTES:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        journal = dict(self._ident, offset=self.offset)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(journal, f)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as exc:
+            # Runs from the link's callbacks, losing the journal only
+            #   costs the ability to resume, not the write itself
+            warnings.warn("Unable to save write checkpoint: %s" % (exc,))
+        self._saved_offset = self.offset
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def positional_writer(fileobj):
+    """
+    Returns a function writing data at a given offset of a binary file
+    without disturbing other writes, using `os.pwrite` where available.
+    """
+    if not hasattr(os, 'pwrite'):
+        def write_at(offset, data):
+            fileobj.seek(offset)
+            fileobj.write(data)
+        return write_at
+    fd = fileobj.fileno()
+
+    def pwrite_at(offset, data):
+        while len(data) > 0:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    return pwrite_at
+
+
+@contextmanager
+def source_view(source):
+    """
+    Context manager providing a read-only memoryview of the data to upload.
+
+    `source` may be any bytes-like object or a readable binary file.  Files
+    are memory-mapped where possible so that their contents don't have to
+    be read into memory up front.
+    """
+    if not hasattr(source, 'read'):
+        with memoryview(source) as view:
+            yield view
+        return
+    try:
+        mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, IOError, OSError, ValueError):
+        # Not backed by a regular file (or empty), fall back to reading it
+        with memoryview(source.read()) as view:
+            yield view
+        return
+    try:
+        with memoryview(mapped) as view:
+            yield view
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # A slice of the view is still alive (e.g. referenced from a
+            #   traceback), the mapping goes away with it instead.
+            pass
+
+
+def checkpoint_path(local_path):
+    """Sidecar journal path used when resuming a write of `local_path`."""
+    return local_path + CHECKPOINT_SUFFIX
+
+
+class FramedRequest(object):
+    """
+    A FILEIO request that frames itself, writing the SBP header, payload
+    and CRC straight into the buffer the Framer sends from.  Requests (and
+    their retries) skip the generic message classes entirely, and a batch
+    is framed into the Framer's preallocated buffer for a single driver
+    write.
+
+    Fields
+    ----------
+    sequence : int
+      Sequence number of the request
+    offset : int
+      Offset into the file
+    filename : bytes
+      Name of the file
+    """
+    __slots__ = ('sequence', 'offset', 'filename')
+    msg_type = None
+    sender = SENDER_ID
+
+    def _pack_payload(self, buf, index):
+        """Write the payload at `index`, returning its length."""
+        raise NotImplementedError
+
+    def into_buffer(self, buf, index):
+        payload_index = index + FRAME_HEADER.size
+        payload_len = self._pack_payload(buf, payload_index)
+        FRAME_HEADER.pack_into(buf, index, SBP_PREAMBLE, self.msg_type, self.sender, payload_len)
+        crc_index = payload_index + payload_len
+        with memoryview(buf) as view:
+            crc = binascii.crc_hqx(view[index + 1:crc_index], 0)
+        FRAME_CRC.pack_into(buf, crc_index, crc)
+        return crc_index + FRAME_CRC.size - index
+
+    def to_binary(self):
+        buf = bytearray(FRAME_HEADER.size + MAX_PAYLOAD_SIZE + FRAME_CRC.size)
+        return bytes(buf[:self.into_buffer(buf, 0)])
+
+
+class FramedReadReq(FramedRequest):
+    """
+    MsgFileioReadReq framed directly, see `FramedRequest`.
+
+    Fields
+    ----------
+    chunk_size : int
+      Number of bytes to read
+    """
+    __slots__ = ('chunk_size',)
+    msg_type = SBP_MSG_FILEIO_READ_REQ
+
+    def __init__(self, sequence, offset, chunk_size, filename):
+        self.sequence = sequence
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.filename = filename
+
+    @property
+    def length(self):
+        return READ_REQ_HEADER.size + len(self.filename)
+
+    def _pack_payload(self, buf, index):
+        READ_REQ_HEADER.pack_into(buf, index, self.sequence, self.offset, self.chunk_size)
+        name_index = index + READ_REQ_HEADER.size
+        buf[name_index:name_index + len(self.filename)] = self.filename
+        return READ_REQ_HEADER.size + len(self.filename)
+
+
+class FramedWriteReq(FramedRequest):
+    """
+    MsgFileioWriteReq framed directly, see `FramedRequest`.  The chunk is
+    copied from the source view into the frame each time the request is
+    sent, so no per-request copy of the data is kept.
+
+    Fields
+    ----------
+    end : int
+      Offset just past the chunk
+    _source : memoryview
+      View of the data being written, indexed by file offset
+    """
+    __slots__ = ('end', '_source')
+    msg_type = SBP_MSG_FILEIO_WRITE_REQ
+
+    def __init__(self, sequence, offset, filename, source, end):
+        self.sequence = sequence
+        self.offset = offset
+        self.filename = filename
+        self.end = end
+        self._source = source
+
+    @property
+    def data(self):
+        return self._source[self.offset:self.end]
+
+    @property
+    def length(self):
+        return WRITE_REQ_HEADER.size + len(self.filename) + 1 + self.end - self.offset
+
+    def _pack_payload(self, buf, index):
+        WRITE_REQ_HEADER.pack_into(buf, index, self.sequence, self.offset)
+        name_index = index + WRITE_REQ_HEADER.size
+        data_index = name_index + len(self.filename) + 1
+        buf[name_index:data_index - 1] = self.filename
+        buf[data_index - 1] = 0
+        data_end = data_index + self.end - self.offset
+        buf[data_index:data_end] = self._source[self.offset:self.end]
+        return data_end - index
+
+
+class _ReadTransfer(object):
+    """
+    State of one file being read through a SelectiveRepeater.  Each chunk
+    is stored at its offset as soon as it arrives, either in a growable
+    buffer or directly in a destination file.
+
+    Fields
+    ----------
+    filename : bytes
+      Name of the file being read
+    chunk_size : int
+      Bytes requested at a time, as many as fit in a response
+    offset : int
+      Offset of the next chunk to request
+    mostly_done : bool
+      Set once a short read shows where the file ends, no further
+      requests are needed after that
+    size : int
+      Highest offset received so far
+    _pending : set(int)
+      Offsets that were requested but not yet received
+    """
+
+    def __init__(self, filename, dest=None):
+        self.filename = filename
+        self.chunk_size = MAX_PAYLOAD_SIZE - READ_RESP_OVERHEAD_LEN
+        self.offset = 0
+        self.mostly_done = False
+        self.size = 0
+        self._dest = dest
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._store = self._open_store(dest)
+
+    def _open_store(self, dest):
+        """
+        Returns the function storing each chunk's contents at its offset,
+        it's called with the lock held.
+        """
+        if dest is not None:
+            dest.flush()
+            return positional_writer(dest)
+        self._buf = bytearray(READ_BUFFER_INITIAL_SIZE)
+        return self._store_in_buffer
+
+    def _store_in_buffer(self, offset, contents):
+        buf = self._buf
+        end_offset = offset + len(contents)
+        if end_offset > len(buf):
+            buf.extend(bytearray(max(end_offset, 2 * len(buf)) - len(buf)))
+        buf[offset:end_offset] = contents
+
+    def next_request(self, seq):
+        msg = FramedReadReq(
+            sequence=seq,
+            offset=self.offset,
+            chunk_size=self.chunk_size,
+            filename=self.filename)
+        with self._lock:
+            self._pending.add(self.offset)
+        self.offset += self.chunk_size
+        return msg
+
+    def on_response(self, req, resp):
+        with self._lock:
+            if req.offset not in self._pending:
+                return
+            self._pending.remove(req.offset)
+            contents = memoryview(resp.payload)[READ_RESP_OVERHEAD_LEN:]
+            if len(contents) > 0:
+                self._store(req.offset, contents)
+                self.size = max(self.size, req.offset + len(contents))
+            if req.chunk_size != len(contents):
+                self.mostly_done = True
+
+    def result(self):
+        if self._dest is not None:
+            self._dest.truncate(self.size)
+            return self.size
+        del self._buf[self.size:]
+        return self._buf
+
+
+class _OrderedReadTransfer(_ReadTransfer):
+    """
+    A `_ReadTransfer` releasing the file's contents in order.  Chunks are
+    held in a reorder buffer, bounded by the request window, until the
+    chunks before them arrive.
+
+    Fields
+    ----------
+    _reorder : dict(int, bytes)
+      Chunks received ahead of the next offset, keyed by their offset
+    _ready : bytearray
+      Contiguous data not yet taken
+    _next_offset : int
+      Offset just past the contiguous data
+    """
+
+    def _open_store(self, dest):
+        self._reorder = {}
+        self._ready = bytearray()
+        self._next_offset = 0
+        return self._store_in_order
+
+    def _store_in_order(self, offset, contents):
+        self._reorder[offset] = bytes(contents)
+        while self._next_offset in self._reorder:
+            contents = self._reorder.pop(self._next_offset)
+            self._ready.extend(contents)
+            self._next_offset += len(contents)
+            if len(contents) < self.chunk_size:
+                # Anything still buffered lies past the end of the file
+                self._reorder.clear()
+
+    def take_ready(self, min_len=1):
+        """
+        Take the contiguous data received so far, None if there is less
+        than `min_len` bytes of it (or none at all).
+        """
+        with self._lock:
+            if len(self._ready) < max(min_len, 1):
+                return None
+            out = bytes(self._ready)
+            del self._ready[:]
+            return out
+
+
+class _DirListing(object):
+    """
+    State of one directory being listed through a SelectiveRepeater.
+    Replies are merged by the entry offset they were requested at, so
+    requests can be sent ahead of the replies they depend on.
+
+    Fields
+    ----------
+    dirname : bytes
+      Name of the directory being listed
+    entries : dict(int, bytes)
+      Names received so far, keyed by their offset in the listing
+    end : int
+      Lowest offset that got an empty reply, None until one does
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.entries = {}
+        self.end = None
+        self._replies = 0
+        self._ahead = 1
+
+    def on_response(self, req, resp):
+        names = bytes(resp.contents).rstrip(b'\0')
+        if len(names) == 0:
+            self.end = req.offset if self.end is None else min(self.end, req.offset)
+            return
+        self._replies += 1
+        for index, name in enumerate(names.split(b'\0')):
+            self.entries[req.offset + index] = name
+
+    @property
+    def done(self):
+        return self.end is not None and all(X in self.entries for X in range(self.end))
+
+    def next_offsets(self, limit):
+        """
+        Offsets to request in the next round: the start of every hole left
+        by the replies so far, then guesses at where the following replies
+        will start, spaced by the average number of entries per reply.
+        The number of guesses doubles each round, so a short listing
+        doesn't pay for requests far past its end.
+        """
+        if self._replies == 0:
+            return [0] if self.end is None else []
+        top = max(self.entries) + 1
+        bound = top if self.end is None else self.end
+        offsets = [X for X in range(bound)
+                   if X not in self.entries and (X == 0 or X - 1 in self.entries)]
+        if self.end is None:
+            step = max(1, len(self.entries) // self._replies)
+            ahead = min(limit, self._ahead)
+            self._ahead *= 2
+            offsets += range(top, top + step * ahead, step)
+        return offsets[:limit]
+
+    def result(self):
+        return [self.entries[X] for X in range(self.end)]
+
+
+class _TreeListing(object):
+    """
+    State of a recursive directory listing, made one level of the tree at
+    a time: the directories of each level are listed together, and the
+    subdirectories found make up the next level.
+
+    Fields
+    ----------
+    dirname : bytes
+      Name of the directory at the top of the tree
+    files : [bytes]
+      Paths found so far relative to `dirname`, directories before their
+      contents
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.files = []
+        self._level = [b'']
+
+    @property
+    def done(self):
+        return not self._level
+
+    def dirnames(self):
+        """Names of the directories to list next."""
+        return [remote_join(self.dirname, X) if X else self.dirname for X in self._level]
+
+    def on_listings(self, listings):
+        """Record the listings of the directories given by `dirnames`."""
+        subdirs = []
+        for prefix, names in zip(self._level, listings):
+            for name in names:
+                if name in (b'.', b'..', b'./', b'../'):
+                    continue
+                path = prefix + name
+                self.files.append(path)
+                if name.endswith(b'/'):
+                    subdirs.append(path)
+        self._level = subdirs
+
+
+def _readdir_requests(listings):
+    """
+    The (listing, offset) requests of the next round of listing several
+    directories, empty once every listing is complete.
+    """
+    return [(listing, offset) for listing in listings
+            for offset in listing.next_offsets(READDIR_LOOKAHEAD)]
 
 
 class FileIO(object):
     def __init__(self, link):
         self.link = link
         self._seq = random.randint(0, 0xffffffff)
+        # Telemetry of every transfer made so far, in order
+        self.transfer_stats = []
 
     def next_seq(self):
         self._seq += 1
         return self._seq
 
-    def read(self, filename):
+    def _repeater(self, name, msg_type, cb=None, skip_config=True):
+        """
+        SelectiveRepeater for one transfer, its telemetry is appended to
+        `transfer_stats`.
+        """
+        stats = TransferStats(name)
+        self.transfer_stats.append(stats)
+        return SelectiveRepeater(self.link, msg_type, cb, skip_config=skip_config, stats=stats)
+
+    def read(self, filename, dest=None):
         """
         Read the contents of a file.
 
+        Each chunk is stored at its offset as soon as it arrives, either in a
+        growable buffer or directly in `dest`, so there is no reassembly step
+        once the transfer completes.
+
         Parameters
         ----------
         filename : bytes
             Name of the file to read.
+        dest : file (optional)
+            Binary file to stream the contents into instead of returning them,
+            memory use then stays bounded regardless of the file size.
 
         Returns
         -------
-        out : bytearray
-            Contents of the file.
+        out : bytearray or int
+            Contents of the file, or the number of bytes written to `dest`.
+        """
+        transfer = _ReadTransfer(filename, dest)
+        with self._repeater(_transfer_name('read', filename), SBP_MSG_FILEIO_READ_RESP, transfer.on_response) as sr:
+            while not transfer.mostly_done:
+                sr.send(transfer.next_request(self.next_seq()))
+            sr.flush()
+        return transfer.result()
+
+    def read_many(self, filenames, dests=None):
         """
-        offset = 0
-        chunksize = MAX_PAYLOAD_SIZE - 4
-        lock = threading.Lock()
-        closure = {'mostly_done': False, 'done': False, 'buf': {}, 'pending': set()}
+        Read several files, sharing one request window between them.
+
+        Requests for the next file go out as soon as the end of the previous
+        one has been found, while its last requests are still in flight, so
+        the link stays busy across file boundaries.  Responses are routed
+        back to their file by sequence number.
+
+        Parameters
+        ----------
+        filenames : [bytes]
+            Names of the files to read.
+        dests : [file] (optional)
+            Binary files to stream each file's contents into, see `read`.
+
+        Returns
+        -------
+        out : [bytearray or int]
+            Contents of each file, or the number of bytes written to its
+            destination.
+        """
+        if dests is None:
+            dests = [None] * len(filenames)
+        transfers = [_ReadTransfer(filename, dest) for filename, dest in zip(filenames, dests)]
+        routes = {}
 
         def cb(req, resp):
-            with lock:
-                if req.offset not in closure['pending']:
-                    return
-                closure['pending'].remove(req.offset)
-                closure['buf'][req.offset] = resp.contents
-                if req.chunk_size != len(resp.contents):
-                    closure['mostly_done'] = True
-                if closure['mostly_done'] and len(closure['pending']) == 0:
-                    closure['done'] = True
-
-        with SelectiveRepeater(self.link, SBP_MSG_FILEIO_READ_RESP, cb, skip_config=True) as sr:
-            while not closure['mostly_done']:
+            transfer = routes.pop(req.sequence, None)
+            if transfer is not None:
+                transfer.on_response(req, resp)
+
+        with self._repeater('read %d files' % len(transfers), SBP_MSG_FILEIO_READ_RESP, cb) as sr:
+            for transfer in transfers:
+                while not transfer.mostly_done:
+                    seq = self.next_seq()
+                    routes[seq] = transfer
+                    sr.send(transfer.next_request(seq))
+            sr.flush()
+        return [transfer.result() for transfer in transfers]
+
+    def read_iter(self, filename, chunk_bytes=READ_ITER_CHUNK_BYTES):
+        """
+        Read the contents of a file, yielding them in order while the
+        transfer is still in progress.
+
+        Responses arrive out of order within the request window, they are
+        held in a reorder buffer (bounded by the window size) until the
+        chunks before them complete.  No further requests are sent while
+        the consumer holds on to a yielded piece, so the amount of data
+        buffered stays bounded as well.
+
+        Parameters
+        ----------
+        filename : bytes
+            Name of the file to read.
+        chunk_bytes : int (optional)
+            Yield contiguous data once at least this many bytes are ready.
+
+        Yields
+        ------
+        out : bytes
+            Consecutive pieces of the file, all but the last at least
+            `chunk_bytes` long.
+        """
+        transfer = _OrderedReadTransfer(filename)
+        with self._repeater(_transfer_name('read', filename), SBP_MSG_FILEIO_READ_RESP, transfer.on_response) as sr:
+            while not transfer.mostly_done:
+                sr.send(transfer.next_request(self.next_seq()))
+                out = transfer.take_ready(chunk_bytes)
+                if out is not None:
+                    yield out
+            sr.flush()
+            out = transfer.take_ready()
+            if out is not None:
+                yield out
+
+    def _read_chunk(self, filename, offset, chunk_size):
+        """
+        Read a single chunk of at most one message payload from a file.
+        """
+        return self._read_chunks([(filename, offset, chunk_size)])[0]
+
+    def _read_chunks(self, chunks):
+        """
+        Read several single chunks, given as (filename, offset, chunk_size)
+        tuples, sharing one request window.
+        """
+        contents = [bytearray() for _ in chunks]
+        routes = {}
+
+        def cb(req, resp):
+            index = routes.pop(req.sequence, None)
+            if index is not None:
+                contents[index] = bytearray(resp.contents)
+
+        with self._repeater('read %d chunks' % len(chunks), SBP_MSG_FILEIO_READ_RESP, cb) as sr:
+            for index, (filename, offset, chunk_size) in enumerate(chunks):
                 seq = self.next_seq()
-                msg = MsgFileioReadReq(
+                routes[seq] = index
+                sr.send(FramedReadReq(
                     sequence=seq,
                     offset=offset,
-                    chunk_size=chunksize,
-                    filename=filename)
-                closure['pending'].add(offset)
-                sr.send(msg)
-                offset += chunksize
+                    chunk_size=chunk_size,
+                    filename=filename))
             sr.flush()
-            while not closure['done']:
-                time.sleep(WAIT_SLEEP_S)
-            sorted_buffers = sorted(closure['buf'].items(), key=lambda kv: kv[0])
-            return bytearray(itertools.chain.from_iterable(kv[1] for kv in sorted_buffers))
+        return contents
+
+    def _verify_written(self, filename, data, end_offset):
+        """
+        Check that the device holds `data` just before `end_offset`, by
+        reading back the last chunk.
+        """
+        length = min(MAX_PAYLOAD_SIZE - READ_RESP_OVERHEAD_LEN, end_offset)
+        contents = self._read_chunk(filename, end_offset - length, length)
+        return contents == data[end_offset - length:end_offset]
 
-    def readdir(self, dirname=b'.'):
+    def readdir(self, dirname=b'.', recursive=False):
         """
         List the files in a directory.
 
+        Several offsets into the listing are requested ahead of the
+        replies, so a large directory takes a few round trips rather than
+        one per reply.
+
         Parameters
         ----------
         dirname : bytes (optional)
             Name of the directory to list. Defaults to the root directory.
+        recursive : bool (optional)
+            Also list the contents of subdirectories, the directories at
+            each level of the tree are listed together.
 
         Returns
         -------
         out : [bytes]
-            List of file names.
+            List of file names.  With `recursive`, these are paths relative
+            to `dirname` and directories are listed before their contents.
         """
-        files = []
-        while True:
-            seq = self.next_seq()
-            msg = MsgFileioReadDirReq(
-                sequence=seq, offset=len(files), dirname=dirname)
-            self.link(msg)
-            reply = self.link.wait(SBP_MSG_FILEIO_READ_DIR_RESP, timeout=READDIR_WAIT_S)
-            if not reply:
-                raise Exception("Timeout waiting for FILEIO_READ_DIR reply")
-            # Why isn't this already decoded?
-            reply = MsgFileioReadDirResp(reply)
-            if reply.sequence != seq:
-                raise Exception("Reply FILEIO_READ_DIR doesn't match request (%d vs %d)" % (reply.sequence, seq))
-            chunk = bytes(reply.contents).rstrip(b'\0')
-
-            if len(chunk) == 0:
-                return files
-            files += chunk.split(b'\0')
+        if not recursive:
+            return self._readdir_many([dirname])[0]
+        tree = _TreeListing(dirname)
+        while not tree.done:
+            tree.on_listings(self._readdir_many(tree.dirnames()))
+        return tree.files
+
+    def _readdir_many(self, dirnames):
+        """
+        List several directories, sharing one request window.  Each round
+        fills the holes left by the previous one and speculates past the
+        end of what's been received, until every listing has been read up
+        to its first empty reply.
+        """
+        listings = [_DirListing(dirname) for dirname in dirnames]
+        routes = {}
+
+        def cb(req, resp):
+            listing = routes.pop(req.sequence, None)
+            if listing is not None:
+                listing.on_response(req, resp)
+
+        with self._repeater(_transfer_name('list', b', '.join(dirnames)), SBP_MSG_FILEIO_READ_DIR_RESP, cb) as sr:
+            while True:
+                requests = _readdir_requests(listings)
+                if not requests:
+                    break
+                for listing, offset in requests:
+                    seq = self.next_seq()
+                    routes[seq] = listing
+                    sr.send(MsgFileioReadDirReq(sequence=seq, offset=offset, dirname=listing.dirname))
+                sr.flush()
+        return [listing.result() for listing in listings]
 
     def remove(self, filename):
         """
@@ -495,7 +1482,7 @@ class FileIO(object):
         msg = MsgFileioRemove(filename=filename)
         self.link(msg)
 
-    def write(self, filename, data, offset=0, trunc=True, progress_cb=None):
+    def write(self, filename, data, offset=0, trunc=True, progress_cb=None, checkpoint=None):
         """
         Write to a file.
 
@@ -503,8 +1490,9 @@ class FileIO(object):
         ----------
         filename : bytes
             Name of the file to write to.
-        data : bytearray
-            Data to write
+        data : bytes-like or file
+            Data to write, or a readable binary file to upload (which is
+            memory-mapped rather than read into memory).
         offset : int (optional)
             Offset into the file at which to start writing in bytes.
         trunc : bool (optional)
@@ -512,70 +1500,293 @@ class FileIO(object):
             this option is not specified and the existing file is longer than the
             current write then the contents of the file beyond the write will
             remain. If offset is non-zero then this flag is ignored.
+        checkpoint : str (optional)
+            Path of a sidecar journal recording how much of the write has been
+            acknowledged. If the journal was left by an interrupted write of the
+            same data, and the tail of the acknowledged data reads back correctly,
+            the write resumes from there without truncating the file. The
+            journal is removed once the write completes.
 
         Returns
         -------
         out : str
             Contents of the file.
         """
+        with source_view(data) as view:
+            self._write(filename, view, offset, trunc, progress_cb, checkpoint)
+
+    def _write(self, filename, data, offset, trunc, progress_cb, checkpoint):
+        journal = None
+        if checkpoint is not None:
+            journal = WriteCheckpoint(checkpoint, filename, data)
+            resume_offset = journal.load()
+            if resume_offset > offset and self._verify_written(filename, data, resume_offset):
+                offset = resume_offset
+                trunc = False
+            journal.start(offset)
+
         if trunc and offset == 0:
             self.remove(filename)
 
-        filename_len = len(filename)
-        data_len = len(data)
+        def cb(req, resp):
+            journal.ack(req.offset, req.end)
 
-        sequence_len = 4
-        offset_len = 4
-        null_sep_len = 1
+        try:
+            with self._repeater(_transfer_name('write', filename), SBP_MSG_FILEIO_WRITE_RESP,
+                                cb if journal else None, skip_config=False) as sr:
+                if progress_cb is not None:
+                    progress_cb(offset, sr)
+                for msg, offset in self._write_requests(filename, data, offset):
+                    sr.send(msg)
+                    if (progress_cb is not None and msg.sequence % sr.progress_cb_reduction_factor == 0):
+                        progress_cb(offset, sr)
+
+                if progress_cb is not None:
+                    progress_cb(len(data), sr)
+                sr.flush()
+        except BaseException:
+            if journal is not None:
+                journal.save()
+            raise
+        if journal is not None:
+            journal.remove()
+
+    def _write_requests(self, filename, data, offset):
+        """
+        Generate the write requests covering `data` from `offset` onwards,
+        along with the offset just past each request's chunk.
+        """
+        # Sequence and offset, then the file name and its NUL terminator
+        chunksize = MAX_PAYLOAD_SIZE - WRITE_REQ_HEADER.size - len(filename) - 1
+        filename = bytes(filename)
+
+        if len(data) == 0:
+            # An empty write still creates the file
+            yield FramedWriteReq(sequence=self.next_seq(), offset=offset, filename=filename, source=data,
+                                 end=offset), offset
+            return
+        while offset < len(data):
+            end_offset = min(offset + chunksize, len(data))
+            msg = FramedWriteReq(
+                sequence=self.next_seq(),
+                offset=offset,
+                filename=filename,
+                source=data,
+                end=end_offset)
+            offset = end_offset
+            yield msg, offset
+
+    def write_many(self, files, trunc=True, progress_cb=None):
+        """
+        Write several files, sharing one request window between them.
 
-        write_req_overhead_len = sequence_len + offset_len + null_sep_len
+        Requests for the next file go out while the last requests of the
+        previous one are still in flight, so the link stays busy across
+        file boundaries.
 
-        # How do we calculate this from the MsgFileioWriteReq class?
-        chunksize = MAX_PAYLOAD_SIZE - filename_len - write_req_overhead_len
+        Parameters
+        ----------
+        files : [(bytes, bytes-like or file)]
+            Pairs of the name of the file to write to and the data to write,
+            see `write`.
+        trunc : bool (optional)
+            Overwrite the files, i.e. delete any existing files before writing.
+        progress_cb : callable (optional)
+            Invoked with the total number of bytes sent across all files and
+            the SelectiveRepeater.
+        """
+        with ExitStack() as stack:
+            views = [(filename, stack.enter_context(source_view(data))) for filename, data in files]
+            if trunc:
+                for filename, _ in views:
+                    self.remove(filename)
+            sent = 0
+            with self._repeater('write %d files' % len(views), SBP_MSG_FILEIO_WRITE_RESP, skip_config=False) as sr:
+                for filename, view in views:
+                    for msg, offset in self._write_requests(filename, view, 0):
+                        sr.send(msg)
+                        if (progress_cb is not None and msg.sequence % sr.progress_cb_reduction_factor == 0):
+                            progress_cb(sent + offset, sr)
+                    sent += len(view)
+                if progress_cb is not None:
+                    progress_cb(sent, sr)
+                sr.flush()
+
+
+class SyncManifest(object):
+    """
+    Record of the files transferred by a previous directory sync, used to
+    decide which files have changed since.
 
-        chunk_buf = bytearray(filename_len + null_sep_len + chunksize)
+    Fields
+    ----------
+    path : str
+      Path of the manifest file
+    entries : dict(str, dict)
+      Size and SHA-1 digest of each file, keyed by remote path
+    """
 
-        chunk_buf[0:filename_len] = filename
-        chunk_buf[filename_len] = ord(b'\x00')
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f).get('files', {})
+        except (IOError, OSError, ValueError):
+            self.entries = {}
 
-        chunk_offset = filename_len + null_sep_len
+    @staticmethod
+    def _key(remote_path):
+        return bytes(remote_path).decode(TEXT_ENCODING, 'surrogateescape')
 
-        with SelectiveRepeater(self.link, SBP_MSG_FILEIO_WRITE_RESP) as sr:
-            while offset < data_len:
+    def matches(self, remote_path, size, digest):
+        entry = self.entries.get(self._key(remote_path))
+        return entry is not None and entry['size'] == size and entry['sha1'] == digest
 
-                seq = self.next_seq()
+    def size(self, remote_path):
+        entry = self.entries.get(self._key(remote_path))
+        return None if entry is None else entry['size']
 
-                end_offset = min(offset + chunksize, data_len)
-                chunk_len = min(chunksize, data_len - offset)
-                chunk_end = (chunk_offset + chunk_len)
+    def record(self, remote_path, size, digest):
+        self.entries[self._key(remote_path)] = {'size': size, 'sha1': digest}
 
-                chunk = data[offset:end_offset]
-                chunk_buf[chunk_offset:chunk_end] = chunk
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
 
-                if chunk_len < len(chunk_buf):
-                    write_buf = chunk_buf[:chunk_end]
-                else:
-                    write_buf = chunk_buf
 
-                msg = MsgFileioWriteReq(
-                    sequence=seq,
-                    offset=offset,
-                    filename=write_buf,  # Note: We put "write_buf" into the name because
-                                         #   putting in the correct place (the data
-                                         #   field) results in a huge slowdown
-                                         #   (presumably because an issue in the
-                                         #   construct library).
-                    data=b'')
+def file_digest(path):
+    """SHA-1 hex digest of a local file, read in blocks."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DIGEST_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-                sr.send(msg)
-                offset += chunk_len
 
-                if (progress_cb is not None and seq % sr.progress_cb_reduction_factor == 0):
-                    progress_cb(offset, sr)
+def remote_join(dirname, name):
+    if dirname in (b'', b'.'):
+        return name
+    return dirname.rstrip(b'/') + b'/' + name
+
+
+def _is_listed_file(name):
+    return name.split(b'/')[-1] not in (b'.', b'..') and not name.endswith(b'/')
+
+
+def _local_files(local_dir, exclude):
+    """
+    Paths of the regular files under `local_dir`, relative to it and with
+    '/' separators, skipping `exclude`.
+    """
+    exclude = os.path.abspath(exclude)
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            local_path = os.path.join(dirpath, name)
+            if os.path.isfile(local_path) and os.path.abspath(local_path) != exclude:
+                yield os.path.relpath(local_path, local_dir).replace(os.sep, '/')
 
-            if progress_cb is not None:
-                progress_cb(offset, sr)
-            sr.flush()
+
+def sync_push(fio, local_dir, remote_dir, manifest_path=None):
+    """
+    Upload the files under `local_dir` that are new or have changed since
+    the last sync to `remote_dir`, in one pipelined batch.  Subdirectories
+    are synced recursively.
+
+    A file is skipped when it is still listed in the remote directory and
+    its size and digest match the manifest entry recorded when it was last
+    uploaded.
+
+    Returns
+    -------
+    out : [bytes]
+        Remote paths of the files that were uploaded.
+    """
+    if manifest_path is None:
+        manifest_path = os.path.join(local_dir, SYNC_MANIFEST_NAME)
+    manifest = SyncManifest(manifest_path)
+    remote_files = set(fio.readdir(remote_dir, recursive=True))
+    changed = []
+    for name in _local_files(local_dir, manifest_path):
+        local_path = os.path.join(local_dir, *name.split('/'))
+        raw_name = os.fsencode(name)
+        remote_path = remote_join(remote_dir, raw_name)
+        size, digest = os.path.getsize(local_path), file_digest(local_path)
+        if raw_name in remote_files and manifest.matches(remote_path, size, digest):
+            continue
+        changed.append((local_path, remote_path, size, digest))
+    with ExitStack() as stack:
+        fio.write_many([(remote_path, stack.enter_context(open(local_path, 'rb')))
+                        for local_path, remote_path, _, _ in changed])
+    for _, remote_path, size, digest in changed:
+        manifest.record(remote_path, size, digest)
+    manifest.save()
+    return [remote_path for _, remote_path, _, _ in changed]
+
+
+def sync_pull(fio, remote_dir, local_dir, manifest_path=None):
+    """
+    Download the files under `remote_dir` that are new or have changed
+    since the last sync to `local_dir`, in one pipelined batch.
+    Subdirectories are synced recursively.
+
+    Directory listings carry no sizes, so a file recorded in the manifest
+    is considered unchanged when its local copy still matches the manifest
+    and its size on the device is still the recorded one: the byte before
+    that size reads back, and a read at that size returns no data.  A file
+    rewritten with different contents of the same size isn't detected.
+
+    Returns
+    -------
+    out : [bytes]
+        Remote paths of the files that were downloaded.
+    """
+    mkdir_p(local_dir)
+    if manifest_path is None:
+        manifest_path = os.path.join(local_dir, SYNC_MANIFEST_NAME)
+    manifest = SyncManifest(manifest_path)
+    changed, probes = [], []
+    for name in sorted(filter(_is_listed_file, fio.readdir(remote_dir, recursive=True))):
+        remote_path = remote_join(remote_dir, name)
+        local_path = os.path.join(local_dir, *os.fsdecode(name).split('/'))
+        size = manifest.size(remote_path)
+        unchanged = size is not None and os.path.isfile(local_path) and manifest.matches(
+            remote_path, os.path.getsize(local_path), file_digest(local_path))
+        if unchanged:
+            probes.append((remote_path, local_path, size))
+        else:
+            changed.append((remote_path, local_path))
+    # Two single byte reads per file: one past the recorded end catches
+    #   growth, one just before it catches truncation.
+    tails = iter(fio._read_chunks([(remote_path, offset, 1)
+                                   for remote_path, _, size in probes
+                                   for offset in (size, size - 1) if offset >= 0]))
+    for remote_path, local_path, size in probes:
+        grown = next(tails)
+        truncated = size > 0 and not next(tails)
+        if grown or truncated:
+            changed.append((remote_path, local_path))
+    with ExitStack() as stack:
+        dests = []
+        for _, local_path in changed:
+            mkdir_p(os.path.dirname(local_path))
+            dests.append(stack.enter_context(open(local_path, 'wb')))
+        fio.read_many([remote_path for remote_path, _ in changed], dests)
+    for remote_path, local_path in changed:
+        manifest.record(remote_path, os.path.getsize(local_path), file_digest(local_path))
+    manifest.save()
+    return [remote_path for remote_path, _ in changed]
+
+
+def dump_transfer_stats(fio, path):
+    """
+    Write the telemetry of every transfer made through `fio` to `path`
+    as JSON.
+    """
+    with open(path, 'w') as f:
+        json.dump([stats.to_dict() for stats in fio.transfer_stats], f, indent=2)
 
 
 def hexdump(data):
@@ -638,7 +1849,36 @@ def get_args():
         nargs='+',
         help='read a file from remote SOURCE to local DEST. If no DEST is provided, file is read to stdout.',
         metavar=('SOURCE', 'DEST'))
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='keep a checkpoint next to the write SOURCE and resume an interrupted write from it.')
+    parser.add_argument(
+        '--sync',
+        nargs=2,
+        help='upload the files under LOCAL_DIR that changed since the last sync to REMOTE_DIR, '
+             'including subdirectories',
+        metavar=('LOCAL_DIR', 'REMOTE_DIR'))
+    parser.add_argument(
+        '--sync-pull',
+        nargs=2,
+        help='download the files under REMOTE_DIR that changed since the last sync to LOCAL_DIR, '
+             'including subdirectories',
+        metavar=('REMOTE_DIR', 'LOCAL_DIR'))
+    parser.add_argument(
+        '--manifest',
+        default=None,
+        help='manifest recording what was last synced (default: %s in LOCAL_DIR)' % SYNC_MANIFEST_NAME)
     parser.add_argument('-l', '--list', default=None, nargs=1, help='list a directory')
+    parser.add_argument(
+        '--stats-json',
+        default=None,
+        help='write transfer telemetry (RTT histogram, retries, window use, throughput) to this JSON file')
+    parser.add_argument(
+        '-R',
+        '--recursive',
+        action='store_true',
+        help='with --list, also list the contents of subdirectories')
     parser.add_argument('-d', '--delete', nargs=1, help='delete a file')
     parser.add_argument(
         '-p',
@@ -730,15 +1970,16 @@ def mk_progress_cb(file_length):
         else:
             speed_kbs = 0
         rolling_avg = compute_rolling_average(speed_kbs)
-        fmt_str = "\r[{:02.02f}% ({:.02f}/{:.02f} MB) at {:.02f} kB/s ({:0.02f}% retried)]"
+        fmt_str = ("\r[{:02.02f}% ({:.02f}/{:.02f} MB) at {:.02f} kB/s ({:0.02f}% retried)"
+                   " window {} batch {}]")
         percent_retried = 100 * (repeater.total_retries / repeater.total_sends)
         status_str = fmt_str.format(percent_done,
                                     mb_confirmed,
                                     file_mb,
                                     rolling_avg,
                                     percent_retried,
-                                    repeater.total_retries,
-                                    repeater.total_sends)
+                                    repeater.window_size,
+                                    repeater.batch_size)
         sys.stdout.write(status_str)
         sys.stdout.flush()
         time_last[0] = time_current
@@ -759,31 +2000,49 @@ def main():
             f = FileIO(link)
             try:
                 if args.write:
-                    file_data = bytearray(open(args.write[0], 'rb').read())
-                    f.write(raw_filename(args.write[1]), file_data, progress_cb=mk_progress_cb(len(file_data)))
+                    checkpoint = checkpoint_path(args.write[0]) if args.resume else None
+                    with open(args.write[0], 'rb') as source:
+                        source_len = os.fstat(source.fileno()).st_size
+                        f.write(raw_filename(args.write[1]), source,
+                                progress_cb=mk_progress_cb(source_len), checkpoint=checkpoint)
                     sys.stdout.write("\n")
                     sys.stdout.flush()
                 elif args.read:
                     if len(args.read) not in [1, 2]:
                         sys.stderr.write("Error: fileio read requires either 1 or 2 arguments, SOURCE and optionally DEST.")
                         sys.exit(1)
-                    data = f.read(raw_filename(args.read[0]))
-                    if len(args.read) == 2:
-                        with open(args.read[1], ('w' if args.hex else 'wb')) as fd:
-                            fd.write(hexdump(data) if args.hex else data)
+                    if len(args.read) == 2 and not args.hex:
+                        # Stream straight to disk
+                        with open(args.read[1], 'wb') as fd:
+                            f.read(raw_filename(args.read[0]), dest=fd)
+                    elif len(args.read) == 2:
+                        data = f.read(raw_filename(args.read[0]))
+                        with open(args.read[1], 'w') as fd:
+                            fd.write(hexdump(data))
                     elif args.hex:
+                        data = f.read(raw_filename(args.read[0]))
                         print(hexdump(data))
                     else:
+                        data = f.read(raw_filename(args.read[0]))
                         print(printable_text_from_device(data))
+                elif args.sync:
+                    synced = sync_push(f, args.sync[0], raw_filename(args.sync[1]), args.manifest)
+                    print("Uploaded %d changed file(s)" % len(synced))
+                elif args.sync_pull:
+                    synced = sync_pull(f, raw_filename(args.sync_pull[0]), args.sync_pull[1], args.manifest)
+                    print("Downloaded %d changed file(s)" % len(synced))
                 elif args.delete:
                     f.remove(raw_filename(args.delete[0]))
                 elif args.list is not None:
-                    print_dir_listing(f.readdir(raw_filename(args.list[0])))
+                    print_dir_listing(f.readdir(raw_filename(args.list[0]), args.recursive))
                 else:
                     print("No command given, listing root directory:")
                     print_dir_listing(f.readdir())
             except KeyboardInterrupt:
                 pass
+            finally:
+                if args.stats_json:
+                    dump_transfer_stats(f, args.stats_json)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,244 @@
+# Copyright (C) 2019 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+Background writer for SBP logs.
+
+Messages handed to the writer are queued and formatted and written by a
+background thread, in large batches, so a slow disk never holds up the
+thread reading from the device.  When the queue is full, messages are
+dropped and counted instead.  The log can be split into segments by size
+or age, and finished segments compressed.
+"""
+
+from __future__ import absolute_import, print_function
+
+import gzip
+import lzma
+import os
+import queue
+import shutil
+import threading
+
+from monotonic import monotonic
+
+LOG_QUEUE_SIZE = 100000
+LOG_BATCH_SIZE = 4096
+LOG_FILE_BUFFER_SIZE = 1024 * 1024
+LOG_FLUSH_INTERVAL_S = 1.0
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+COMPRESSORS = {
+    'gzip': ('.gz', gzip.open),
+    'lzma': ('.xz', lzma.open),
+}
+
+_CLOSE = object()
+
+
+def segment_filename(filename, index):
+    """
+    Name of segment `index` of a log, the first segment has the log's own
+    name and later ones are numbered before the extension.
+    """
+    if index == 0:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return '%s.%d%s' % (root, index, ext)
+
+
+def compress_file(filename, compress):
+    """
+    Compress a file with `compress`, one of COMPRESSORS, replacing it.
+
+    Returns
+    -------
+    out : str
+        Name of the compressed file.
+    """
+    ext, opener = COMPRESSORS[compress]
+    with open(filename, 'rb') as src, opener(filename + ext, 'wb') as dst:
+        shutil.copyfileobj(src, dst, COMPRESS_BLOCK_SIZE)
+    os.remove(filename)
+    return filename + ext
+
+
+class BatchedLogWriter(object):
+    """
+    Log sink, called like a logger with each message and its metadata.
+
+    Parameters
+    ----------
+    filename : str
+        Log file, or the name of its first segment.
+    formatter : callable
+        Returns the log line of a message and its metadata, or None to
+        skip the message.  The `dump` method of an sbp JSON logger.
+    rotate_bytes : int (optional)
+        Start a new segment once this many bytes have been written.
+    rotate_interval : float (optional)
+        Start a new segment after this many seconds.
+    compress : str (optional)
+        Compress finished segments, one of COMPRESSORS.
+    queue_size : int (optional)
+        Messages queued before new messages are dropped.
+
+    Fields
+    ----------
+    dropped : int
+      Messages dropped because the queue was full, or they couldn't be
+      formatted
+    written : int
+      Messages written
+    segments : [str]
+      Finished segments, compressed if enabled
+    """
+
+    def __init__(self, filename, formatter, rotate_bytes=None, rotate_interval=None, compress=None,
+                 queue_size=LOG_QUEUE_SIZE):
+        if compress is not None and compress not in COMPRESSORS:
+            raise ValueError("Unknown compression %s, use one of %s" % (compress, ', '.join(sorted(COMPRESSORS))))
+        self.filename = filename
+        self.formatter = formatter
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.written = 0
+        self.segments = []
+        self._queue = queue.Queue(queue_size)
+        self._segment_index = 0
+        self._segment_bytes = 0
+        self._segment_start = None
+        self._last_flush = None
+        self._file = None
+        self._compressor = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='log-writer')
+        self._thread.daemon = True
+        self._open_segment()
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __call__(self, msg, **metadata):
+        try:
+            self._queue.put_nowait((msg, metadata))
+        except queue.Full:
+            self._count_dropped()
+
+    def _count_dropped(self):
+        # Counted from the producers and the writer thread alike
+        with self._dropped_lock:
+            self.dropped += 1
+
+    @property
+    def queue_depth(self):
+        """Messages waiting to be written."""
+        return self._queue.qsize()
+
+    def flush(self):
+        """Wait for the queued messages to be written out."""
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """Write out the queued messages and finish the last segment."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread.is_alive():
+            self._queue.put(_CLOSE)
+            self._thread.join()
+        self._finish_segment()
+        if self._compressor is not None:
+            self._compressor.join()
+
+    def _open_segment(self):
+        self._file = open(segment_filename(self.filename, self._segment_index), 'w',
+                          buffering=LOG_FILE_BUFFER_SIZE)
+        self._segment_bytes = 0
+        self._segment_start = self._last_flush = monotonic()
+
+    def _finish_segment(self):
+        self._file.close()
+        filename = self._file.name
+        self.segments.append(filename)
+        if self.compress is None:
+            return
+        # Segments are compressed one after the other, off the writer thread
+        previous = self._compressor
+        index = len(self.segments) - 1
+
+        def compress():
+            if previous is not None:
+                previous.join()
+            self.segments[index] = compress_file(filename, self.compress)
+
+        self._compressor = threading.Thread(target=compress, name='log-compressor')
+        self._compressor.daemon = True
+        self._compressor.start()
+
+    def _should_rotate(self, now):
+        if self._segment_bytes == 0:
+            return False
+        if self.rotate_bytes is not None and self._segment_bytes >= self.rotate_bytes:
+            return True
+        return self.rotate_interval is not None and now - self._segment_start >= self.rotate_interval
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=LOG_FLUSH_INTERVAL_S)]
+        except queue.Empty:
+            return []
+        try:
+            while len(batch) < LOG_BATCH_SIZE and batch[-1] is not _CLOSE:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            closing = batch and batch[-1] is _CLOSE
+            lines = []
+            for item in batch:
+                if item is _CLOSE:
+                    continue
+                try:
+                    line = self.formatter(item[0], **item[1])
+                except Exception:
+                    self._count_dropped()
+                    continue
+                if line:
+                    lines.append(line + "\n")
+            if lines:
+                text = ''.join(lines)
+                self._file.write(text)
+                self._segment_bytes += len(text)
+                self.written += len(lines)
+            for _ in batch:
+                self._queue.task_done()
+            if closing:
+                return
+            now = monotonic()
+            if self._should_rotate(now):
+                self._finish_segment()
+                self._segment_index += 1
+                self._open_segment()
+            elif now - self._last_flush >= LOG_FLUSH_INTERVAL_S:
+                self._file.flush()
+                self._last_flush = now
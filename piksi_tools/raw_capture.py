@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+Raw capture of the bytes received from a device, without decoding them.
+
+The capture file is exactly the byte stream the device sent, so it can be
+played back with `--file` like any binary SBP log.  Host timestamps are
+kept next to it, in a `.times` file of fixed size records each giving the
+host time at which the capture reached a byte offset.
+
+Decoding is left to a separate pass, which indexes the frames in a
+capture:
+
+    $ python -m piksi_tools.raw_capture serial-link-20190101-000000.sbp
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import bisect
+import csv
+import mmap
+import os
+import struct
+import threading
+import time
+
+from sbp.msg import SBP_PREAMBLE, crc16
+
+from piksi_tools.utils import FRAME_CRC, FRAME_HEADER, FRAME_OVERHEAD_LEN, MSG_HEADER, mkdir_p
+
+RAW_BUFFER_SIZE = 1024 * 1024
+RAW_ALIGNMENT = 4096
+RAW_READ_SIZE = 64 * 1024
+RAW_MARKER_INTERVAL_S = 1.0
+RAW_JOIN_TIMEOUT_S = 1.0
+
+TIMES_SUFFIX = '.times'
+INDEX_SUFFIX = '.index.csv'
+TIME_MARKER = struct.Struct('<dQ')  # host time in seconds since the epoch, byte offset
+
+
+def rawlogfilename():
+    return time.strftime("serial-link-%Y%m%d-%H%M%S.sbp")
+
+
+def read_size(driver):
+    """
+    Bytes to ask the driver for in one raw read.  Serial ports block until
+    the whole read is filled, so only what's already there is read.
+    """
+    in_waiting = getattr(driver.handle, 'in_waiting', None)
+    if in_waiting is None:
+        return RAW_READ_SIZE
+    return max(1, min(RAW_READ_SIZE, in_waiting))
+
+
+class RawCapture(object):
+    """
+    Copies everything read from a driver to a file, through a large
+    buffer which is written out in multiples of RAW_ALIGNMENT bytes, and
+    records a time marker every RAW_MARKER_INTERVAL_S.  It can stand in
+    for a `Handler` in `serial_link.run`: messages sent through it are
+    written to the driver.
+
+    Parameters
+    ----------
+    driver : BaseDriver
+        Where the bytes come from.
+    filename : str
+        Capture file to create.
+    buffer_size : int (optional)
+        Bytes buffered before writing them out.
+    marker_interval : float (optional)
+        Seconds between time markers.
+    """
+
+    def __init__(self, driver, filename, buffer_size=RAW_BUFFER_SIZE, marker_interval=RAW_MARKER_INTERVAL_S):
+        self.driver = driver
+        self.filename = filename
+        self.marker_interval = marker_interval
+        self.bytes_captured = 0
+        self._buffer = bytearray(buffer_size)
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='raw-capture')
+        self._thread.daemon = True
+        self._file = None
+        self._times = None
+        self._last_marker = None
+
+    def __enter__(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            mkdir_p(dirname)
+        print("Starting raw capture at %s" % self.filename)
+        self._file = open(self.filename, 'wb', buffering=0)
+        self._times = open(self.filename + TIMES_SUFFIX, 'wb')
+        self._mark(time.time())
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        with self._lock:
+            self._write_out(self._buffered)
+            self._file.close()
+            self._times.close()
+
+    def __call__(self, *msgs, **metadata):
+        self.driver.write(b''.join(msg.to_binary() for msg in msgs))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            # A blocking read can't be interrupted, the thread is abandoned
+            #   if it doesn't return soon.
+            self._thread.join(RAW_JOIN_TIMEOUT_S)
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                data = self.driver.read(read_size(self.driver))
+            except (IOError, OSError):
+                break
+            if not data:
+                break
+            now = time.time()
+            with self._lock:
+                if self._file.closed:
+                    break
+                self._capture(data)
+                if now - self._last_marker >= self.marker_interval:
+                    self._write_out(self._buffered - self._buffered % RAW_ALIGNMENT)
+                    self._mark(now)
+
+    def _capture(self, data):
+        data = memoryview(data)
+        while data:
+            count = min(len(data), len(self._buffer) - self._buffered)
+            self._buffer[self._buffered:self._buffered + count] = data[:count]
+            self._buffered += count
+            self.bytes_captured += count
+            data = data[count:]
+            if self._buffered == len(self._buffer):
+                self._write_out(self._buffered)
+
+    def _write_out(self, count):
+        """Write the first `count` buffered bytes to the file."""
+        if count == 0:
+            return
+        with memoryview(self._buffer) as view:
+            self._file.write(view[:count])
+            view[:self._buffered - count] = view[count:self._buffered]
+        self._buffered -= count
+
+    def _mark(self, now):
+        self._times.write(TIME_MARKER.pack(now, self.bytes_captured))
+        self._times.flush()
+        self._last_marker = now
+
+
+def read_time_markers(filename):
+    """
+    Read the time markers of a capture.
+
+    Returns
+    -------
+    out : [(float, int)]
+        Host time and byte offset of each marker.
+    """
+    with open(filename + TIMES_SUFFIX, 'rb') as f:
+        data = f.read()
+    usable = len(data) - len(data) % TIME_MARKER.size
+    return list(TIME_MARKER.iter_unpack(data[:usable]))
+
+
+def host_time(markers, offsets, offset):
+    """
+    Host time at which `offset` was captured, interpolated between the
+    surrounding markers.  `offsets` is the list of marker offsets.
+    """
+    index = bisect.bisect_left(offsets, offset)
+    if index == 0:
+        return markers[0][0]
+    if index == len(markers):
+        return markers[-1][0]
+    (time0, offset0), (time1, offset1) = markers[index - 1], markers[index]
+    return time0 + (time1 - time0) * (offset - offset0) / float(offset1 - offset0)
+
+
+def iter_frames(data):
+    """
+    Find the SBP frames in a capture, resynchronizing after corrupt data.
+
+    Yields
+    ------
+    out : (int, int, int, int)
+        Offset, message type, sender and payload length of each frame.
+    """
+    preamble = bytes([SBP_PREAMBLE])
+    offset = data.find(preamble)
+    end = len(data)
+    while 0 <= offset and offset + FRAME_OVERHEAD_LEN <= end:
+        msg_type, sender, length = MSG_HEADER.unpack_from(data, offset + 1)
+        crc_offset = offset + FRAME_HEADER.size + length
+        if crc_offset + FRAME_CRC.size <= end:
+            crc, = FRAME_CRC.unpack_from(data, crc_offset)
+            if crc == crc16(data[offset + 1:crc_offset]):
+                yield offset, msg_type, sender, length
+                offset = data.find(preamble, crc_offset + FRAME_CRC.size)
+                continue
+        offset = data.find(preamble, offset + 1)
+
+
+def index_capture(filename, index_filename=None):
+    """
+    Index the frames in a capture as CSV, one row per frame with its
+    offset, message type, sender, payload length and host time.
+
+    Returns
+    -------
+    out : int
+        Number of frames indexed.
+    """
+    if index_filename is None:
+        index_filename = filename + INDEX_SUFFIX
+    try:
+        markers = read_time_markers(filename)
+    except (IOError, OSError):
+        markers = []
+    offsets = [X[1] for X in markers]
+    count = 0
+    with open(filename, 'rb') as f, open(index_filename, 'w') as out:
+        writer = csv.writer(out)
+        writer.writerow(['offset', 'msg_type', 'sender', 'length', 'host_time'])
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, msg_type, sender, length in iter_frames(data):
+                stamp = '%.6f' % host_time(markers, offsets, offset) if markers else ''
+                writer.writerow([offset, msg_type, sender, length, stamp])
+                count += 1
+    return count
+
+
+def get_args():
+    """
+    Get and parse arguments.
+    """
+    parser = argparse.ArgumentParser(description='Index the SBP frames in raw captures.')
+    parser.add_argument('captures', nargs='+', help='raw capture files to index.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    for filename in args.captures:
+        count = index_capture(filename)
+        print("Indexed %d frames of %s in %s" % (count, filename, filename + INDEX_SUFFIX))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,9 +14,13 @@ setting up and running SBP message handling.
 """
 from __future__ import print_function
 
+import argparse
+import importlib
 import os
+import re
 import sys
 import time
+from contextlib import ExitStack
 from monotonic import monotonic
 
 import serial.tools.list_ports
@@ -30,11 +34,19 @@ from sbp.client.loggers.null_logger import NullLogger
 from sbp.logging import SBP_MSG_LOG, SBP_MSG_PRINT_DEP, MsgLog
 from sbp.piksi import MsgReset
 
+from piksi_tools.log_writer import COMPRESSORS, BatchedLogWriter
+from piksi_tools.raw_capture import RawCapture, rawlogfilename
+from piksi_tools.tcp_hub import TcpHub, parse_address
 from piksi_tools.utils import mkdir_p, get_tcp_driver, call_repeatedly
 from piksi_tools import __version__ as VERSION
 
 SERIAL_PORT = "/dev/ttyUSB0"
 SERIAL_BAUD = 115200
+# sbp modules defining messages, each listing its classes in `msg_classes`
+SBP_MSG_MODULES = ('acquisition', 'bootload', 'ext_events', 'file_io', 'flash', 'imu', 'integrity',
+                   'linux', 'logging', 'mag', 'navigation', 'ndb', 'observation', 'orientation',
+                   'piksi', 'profiling', 'sbas', 'settings', 'signing', 'solution_meta', 'ssr',
+                   'system', 'telemetry', 'tracking', 'user', 'vehicle')
 
 
 def logfilename():
@@ -50,17 +62,68 @@ def get_ports():
     ]
 
 
+def sbp_msg_classes():
+    """
+    Message classes of the installed sbp package, keyed by message type.
+    Modules missing from older sbp releases are skipped.
+    """
+    msg_classes = {}
+    for name in SBP_MSG_MODULES:
+        try:
+            module = importlib.import_module('sbp.' + name)
+        except ImportError:
+            continue
+        msg_classes.update(module.msg_classes)
+    return msg_classes
+
+
+def parse_msg_types(text):
+    """
+    Parse a comma separated list of message types, given as numbers in
+    any base or as message class names.
+
+    Returns
+    -------
+    out : set(int)
+    """
+    msg_types = set()
+    names = dict((cls.__name__, msg_type) for msg_type, cls in sbp_msg_classes().items())
+    for item in text.split(','):
+        item = item.strip()
+        if item in names:
+            msg_types.add(names[item])
+            continue
+        try:
+            msg_types.add(int(item, 0))
+        except ValueError:
+            raise ValueError("Unknown message type %s" % item)
+    return msg_types
+
+
+class PortAction(argparse.Action):
+    """
+    Stores the last port given as `port`, and every port given, in order,
+    as `ports`.
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, values)
+        ports = list(getattr(namespace, 'ports', None) or [])
+        ports.append(values)
+        setattr(namespace, 'ports', ports)
+
+
 def base_cl_options(override_arg_parse=None, add_help=True,
-                    add_log_args=False, add_reset_arg=False):
-    import argparse
+                    add_log_args=False, add_reset_arg=False, add_port_arg=True):
     if override_arg_parse:
         parserclass = override_arg_parse
     else:
         parserclass = argparse.ArgumentParser
     parser = parserclass(
         description="Swift Navigation SBP Client version " + VERSION, add_help=add_help)
-    parser.add_argument(
-        "-p", "--port", default=None, help="specify the serial port to use.")
+    if add_port_arg:
+        parser.add_argument(
+            "-p", "--port", default=None, help="specify the serial port to use.")
     parser.add_argument(
         "-b",
         "--baud",
@@ -148,7 +211,10 @@ def get_args():
     """
     Get and parse arguments.
     """
-    parser = base_cl_options(add_log_args=True, add_reset_arg=True)
+    parser = base_cl_options(add_log_args=True, add_reset_arg=True, add_port_arg=False)
+    parser.add_argument(
+        "-p", "--port", default=None, action=PortAction,
+        help="specify the serial port to use, may be given several times to capture from every port given.")
     parser.add_argument(
         "--timeout",
         default=None,
@@ -158,7 +224,57 @@ def get_args():
         default=False,
         action="store_true",
         help="print periodic data rate to stdout.")
-    return parser.parse_args()
+    parser.add_argument(
+        "--raw",
+        default=False,
+        action="store_true",
+        help="capture the raw bytes received to a binary log, without decoding them.")
+    parser.add_argument(
+        "--serve",
+        type=parse_address,
+        default=None,
+        metavar="[HOST]:PORT",
+        help="serve the raw stream of the port to TCP clients, e.g. :55555, "
+             "and write the messages they send to it.")
+    parser.add_argument(
+        "--log-rotate-size",
+        type=float,
+        default=None,
+        help="start a new log file after this many megabytes.")
+    parser.add_argument(
+        "--log-rotate-interval",
+        type=float,
+        default=None,
+        help="start a new log file after this many seconds.")
+    parser.add_argument(
+        "--log-compress",
+        choices=sorted(COMPRESSORS),
+        default=None,
+        help="compress finished log files.")
+    parser.add_argument(
+        "--msg-types",
+        type=parse_msg_types,
+        default=None,
+        help="comma separated message types to handle, at the exclusion of all others, "
+             "as numbers or names: e.g: MsgPosLLH,0x4a")
+    parser.add_argument(
+        "--exclude-msg-types",
+        type=parse_msg_types,
+        default=None,
+        help="comma separated message types to discard, as numbers or names: e.g: MsgTrackingState. "
+             "Message types unknown to the installed sbp package are discarded as well.")
+    parser.add_argument(
+        "--merge-logs",
+        default=False,
+        action="store_true",
+        help="log every port given to one file, tagging messages with their source, "
+             "instead of one file per port.")
+    args = parser.parse_args()
+    if args.serve is not None and (args.log or args.raw):
+        parser.error("--serve passes the stream through undecoded and can't be combined with --log or --raw")
+    if get_msg_type_filter(args) == set():
+        parser.error("--msg-types and --exclude-msg-types leave no message types to handle")
+    return args
 
 
 def get_driver(use_ftdi=False,
@@ -200,9 +316,33 @@ def get_driver(use_ftdi=False,
         sys.exit(1)
 
 
-def get_logger(use_log=False, filename=logfilename(), expand_json=False, sort_keys=False):
+def get_msg_type_filter(args):
     """
-    Get a logger based on configuration options.
+    Message types for Framer's `message_type_filter`, from the --msg-types
+    and --exclude-msg-types options.  Framer checks each frame against it
+    before decoding the payload, so filtered messages aren't decoded,
+    logged or dispatched to callbacks.
+
+    Returns
+    -------
+    out : set(int)
+        The message types to handle, an empty list if neither option was
+        given, which Framer takes as no filter.
+    """
+    include = getattr(args, 'msg_types', None)
+    exclude = getattr(args, 'exclude_msg_types', None)
+    if include is None and exclude is None:
+        return []
+    if include is None:
+        include = set(sbp_msg_classes())
+    return include - (exclude or set())
+
+
+def get_logger(use_log=False, filename=logfilename(), expand_json=False, sort_keys=False,
+               rotate_bytes=None, rotate_interval=None, compress=None):
+    """
+    Get a logger based on configuration options.  Messages are written by
+    a background thread, see `BatchedLogWriter`.
 
     Parameters
     ----------
@@ -210,6 +350,12 @@ def get_logger(use_log=False, filename=logfilename(), expand_json=False, sort_ke
       Whether to log or not.
     filename : string
       File to log to.
+    rotate_bytes : int
+      Start a new log file after this many bytes.
+    rotate_interval : float
+      Start a new log file after this many seconds.
+    compress : string
+      Compress finished log files, 'gzip' or 'lzma'.
     """
     if not use_log:
         return NullLogger()
@@ -217,12 +363,12 @@ def get_logger(use_log=False, filename=logfilename(), expand_json=False, sort_ke
     if dirname:
         mkdir_p(dirname)
     print("Starting JSON logging at %s" % filename)
-    infile = open(filename, 'w')
     if expand_json:
         logger = JSONLogger
     else:
         logger = JSONBinLogger
-    return logger(infile, sort_keys=sort_keys)
+    return BatchedLogWriter(filename, logger(None, sort_keys=sort_keys).dump,
+                            rotate_bytes=rotate_bytes, rotate_interval=rotate_interval, compress=compress)
 
 
 def printer(sbp_msg, **metadata):
@@ -351,9 +497,57 @@ def get_base_args_driver(args):
     return driver
 
 
+def device_label(port):
+    """
+    Short name for a device in file names and log records, e.g. ttyUSB0
+    or 192.168.0.222_55555.
+    """
+    return re.sub(r'[^A-Za-z0-9.-]+', '_', os.path.basename(port.rstrip('/\\'))) or 'device'
+
+
+def device_filename(filename, label):
+    """Log file name of one device, the label is added before the extension."""
+    for ext in ('.log.json', '.sbp', '.json'):
+        if filename.endswith(ext):
+            return '%s-%s%s' % (filename[:-len(ext)], label, ext)
+    return '%s-%s' % (filename, label)
+
+
+class MultiLink(object):
+    """
+    Stands in for a single `Handler` in `run` when capturing from several
+    devices: starts them all, sends messages to all of them and stays
+    alive while any of them is.
+    """
+
+    def __init__(self, links):
+        self.links = links
+
+    def start(self):
+        for link in self.links:
+            link.start()
+
+    def is_alive(self):
+        return any(link.is_alive() for link in self.links)
+
+    def __call__(self, *msgs, **metadata):
+        for link in self.links:
+            if link.is_alive():
+                link(*msgs, **metadata)
+
+
+def tagged(sink, label):
+    """Sink adding the source device to the metadata of each message."""
+    def tag(msg, **metadata):
+        metadata['source'] = label
+        sink(msg, **metadata)
+    return tag
+
+
 def main(args):
     """
     Get configuration, get driver, get logger, and build handler and start it.
+    One handler is built for each device given with -p.
     """
     log_filename = args.logfilename
     log_dirname = args.log_dirname
@@ -361,37 +555,105 @@ def main(args):
     stop_function = lambda: None # noqa
 
     if not log_filename:
-        log_filename = logfilename()
+        log_filename = rawlogfilename() if getattr(args, 'raw', False) else logfilename()
     if log_dirname:
         log_filename = os.path.join(log_dirname, log_filename)
-    driver = get_base_args_driver(args)
+    ports = getattr(args, 'ports', None) or [args.port]
+    labels = [device_label(port) for port in ports] if len(ports) > 1 else [None]
+    drivers = [get_base_args_driver(argparse.Namespace(**dict(vars(args), port=port))) for port in ports]
     sender_id_filter = []
     if args.sender_id_filter is not None:
         sender_id_filter = [int(x) for x in args.sender_id_filter.split(",")]
-    if args.json:
-        source = JSONLogIterator(driver, conventional=True)
-    else:
-        source = Framer(driver.read,
-                        driver.write,
-                        args.verbose,
-                        skip_metadata=args.skip_metadata,
-                        sender_id_filter_list=sender_id_filter)
-    last_bytes_read = [0]
+    sources = []
+    for driver in drivers:
+        if args.json:
+            sources.append(JSONLogIterator(driver, conventional=True))
+        else:
+            sources.append(Framer(driver.read,
+                                  driver.write,
+                                  args.verbose,
+                                  skip_metadata=args.skip_metadata,
+                                  sender_id_filter_list=sender_id_filter,
+                                  message_type_filter=get_msg_type_filter(args)))
+    last_bytes_read = [0] * len(drivers)
     if args.status:
         def print_io_data(last_bytes_read):
-            # bitrate is will be kilobytes per second. 2 second period, 1024 bytes per kilobyte
-            kbs_avg = driver.bytes_read_since(last_bytes_read[0]) / (2 * 1024.0)
-            print("{0:.2f} KB/s average data rate (2 second period).".format(kbs_avg))
-            last_bytes_read[0] = driver.total_bytes_read
+            for index, (label, driver) in enumerate(zip(labels, drivers)):
+                # bitrate is will be kilobytes per second. 2 second period, 1024 bytes per kilobyte
+                kbs_avg = driver.bytes_read_since(last_bytes_read[index]) / (2 * 1024.0)
+                print("{0}{1:.2f} KB/s average data rate (2 second period).".format(
+                    label + ': ' if label else '', kbs_avg))
+                last_bytes_read[index] = driver.total_bytes_read
         stop_function = call_repeatedly(2, print_io_data, last_bytes_read)
-    with Handler(source, autostart=False) as link, get_logger(args.log,
-                                                              log_filename,
-                                                              args.expand_json,
-                                                              args.sort_keys) as logger:
-        link.add_callback(printer, SBP_MSG_PRINT_DEP)
-        link.add_callback(log_printer, SBP_MSG_LOG)
-        Forwarder(link, logger).start()
-        run(args, link, stop_function=stop_function)
+    with ExitStack() as stack:
+        if getattr(args, 'serve', None):
+            if len(drivers) != 1:
+                raise ValueError("--serve takes a single port")
+            hub = stack.enter_context(TcpHub(drivers[0], *args.serve))
+            print("Serving on %s:%d" % hub.address[:2])
+            if args.status:
+                stop_io_status = stop_function
+
+                def print_hub_status():
+                    for line in hub.status():
+                        print(line)
+
+                stop_hub_status = call_repeatedly(2, print_hub_status)
+
+                def stop_function():
+                    stop_io_status()
+                    stop_hub_status()
+            run(args, hub, stop_function=stop_function)
+            return
+        if getattr(args, 'raw', False):
+            captures = [stack.enter_context(RawCapture(driver, device_filename(log_filename, label)
+                                                       if label else log_filename))
+                        for label, driver in zip(labels, drivers)]
+            run(args, captures[0] if len(captures) == 1 else MultiLink(captures), stop_function=stop_function)
+            return
+        rotate_size = getattr(args, 'log_rotate_size', None)
+        rotate_bytes = int(rotate_size * 1024 * 1024) if rotate_size else None
+        merge_logs = getattr(args, 'merge_logs', False)
+
+        def open_logger(filename):
+            return stack.enter_context(get_logger(args.log,
+                                                  filename,
+                                                  args.expand_json,
+                                                  args.sort_keys,
+                                                  rotate_bytes,
+                                                  getattr(args, 'log_rotate_interval', None),
+                                                  getattr(args, 'log_compress', None)))
+
+        merged_logger = open_logger(log_filename) if merge_logs or labels == [None] else None
+        links = []
+        loggers = []
+        for label, source in zip(labels, sources):
+            link = stack.enter_context(Handler(source, autostart=False))
+            link.add_callback(printer, SBP_MSG_PRINT_DEP)
+            link.add_callback(log_printer, SBP_MSG_LOG)
+            if merged_logger is not None:
+                logger = merged_logger
+                sink = tagged(logger, label) if label else logger
+            else:
+                logger = sink = open_logger(device_filename(log_filename, label))
+            if logger not in loggers:
+                loggers.append(logger)
+            Forwarder(link, sink).start()
+            links.append(link)
+        if args.status and args.log:
+            stop_io_status = stop_function
+
+            def print_log_status():
+                for logger in loggers:
+                    print("{0}{1} messages queued for the log, {2} dropped.".format(
+                        logger.filename + ': ' if len(loggers) > 1 else '', logger.queue_depth, logger.dropped))
+
+            stop_log_status = call_repeatedly(2, print_log_status)
+
+            def stop_function():
+                stop_io_status()
+                stop_log_status()
+        run(args, links[0] if len(links) == 1 else MultiLink(links), stop_function=stop_function)
 
 
 if __name__ == "__main__":
@@ -63,6 +63,11 @@ DEFAULT_TIMEOUT_SECS = 0.5
 KEY_ENCODING = 'ascii'    # encoding for settings sections and keys
 VALUE_ENCODING = 'ascii'  # encoding for settings values
 
+# Status of a settings write response
+SETTINGS_WRITE_OK = 0
+SETTINGS_WRITE_REJECTED = 1
+SETTINGS_WRITE_UNKNOWN = 2
+
 
 class Settings(object):
     """
@@ -185,7 +190,7 @@ class Settings(object):
             if verbose:
                 print("Attempting to write:section={}|setting={}|value={}".format(section, setting, value))
             attempts += 1
-            reply = {'status': 0}
+            reply = {'status': SETTINGS_WRITE_OK}
 
             def cb(msg, **metadata):
                 reply['status'] = msg.status
@@ -197,14 +202,14 @@ class Settings(object):
             if self._confirm_write(section, setting, value, verbose=verbose, retries=confirm_retries):
                 self.link.remove_callback(cb, SBP_MSG_SETTINGS_WRITE_RESP)
                 return
-            if reply['status'] == 1:
+            if reply['status'] == SETTINGS_WRITE_REJECTED:
                 raise RuntimeError("Unable to write setting \"{}\" in section \"{}\" "
                                    "with value \"{}\": Setting value rejected.".format(setting, section,
                                                                                        value))
-            elif reply['status'] == 2:
+            elif reply['status'] == SETTINGS_WRITE_UNKNOWN:
                 raise RuntimeError("Unable to write setting \"{}\" in section \"{}\"."
                                    "Setting does not exist.".format(setting, section))
-            elif reply['status'] > 0:
+            elif reply['status'] > SETTINGS_WRITE_OK:
                 raise RuntimeError("Unknown setting write status response")
             else:
                 continue
@@ -0,0 +1,306 @@
+# Copyright (C) 2019 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+TCP fan-out of one device connection.
+
+Every SBP frame read from the device is sent, undecoded, to every
+connected TCP client.  Each client has its own bounded send queue: when a
+client can't keep up, whole frames for it are dropped and counted instead
+of holding up the device or the other clients, so a slow client misses
+messages but never receives a torn one.  SBP frames sent by clients are
+written to the device whole, so messages from different clients never
+interleave.
+"""
+
+from __future__ import absolute_import, print_function
+
+import collections
+import socket
+import threading
+
+from piksi_tools.raw_capture import iter_frames, read_size
+from piksi_tools.utils import FRAME_OVERHEAD_LEN, split_host_port
+
+HUB_CLIENT_QUEUE_BYTES = 1024 * 1024
+HUB_RECV_SIZE = 4096
+HUB_BACKLOG = 16
+MAX_FRAME_LEN = FRAME_OVERHEAD_LEN + 255
+
+
+def parse_address(text, default_host=''):
+    """
+    Parse a [host]:port address, e.g. ':55555' to listen on every
+    interface.  IPv6 hosts are written in brackets, e.g. '[::1]:55555'.
+
+    Returns
+    -------
+    out : (str, int)
+    """
+    try:
+        host, port = split_host_port(text)
+    except ValueError:
+        port = None
+    if port is None:
+        raise ValueError('Invalid address (use [host]:port): {}'.format(text))
+    return (host or default_host), port
+
+
+def split_frames(buf):
+    """
+    Take the complete SBP frames off the front of a buffer of received
+    bytes, discarding anything that isn't part of a valid frame.
+
+    Returns
+    -------
+    out : ([bytes], int)
+        The frames, and how many bytes of the buffer were consumed.
+    """
+    frames = []
+    consumed = 0
+    for offset, _, _, length in iter_frames(buf):
+        consumed = offset + FRAME_OVERHEAD_LEN + length
+        frames.append(bytes(buf[offset:consumed]))
+    # Nothing before the last possible frame start can still become a frame
+    consumed = max(consumed, len(buf) - MAX_FRAME_LEN)
+    return frames, consumed
+
+
+class HubClient(object):
+    """
+    One TCP client of the hub, with its own send queue and thread.
+
+    Fields
+    ----------
+    address : (str, int)
+      Peer address of the client
+    sent_bytes : int
+      Bytes sent to the client
+    dropped_bytes : int
+      Bytes of the frames dropped because the client's queue was full
+    queued_bytes : int
+      Bytes waiting to be sent, i.e. how far the client lags behind
+    max_queued_bytes : int
+      Largest lag seen
+    """
+
+    def __init__(self, hub, sock, address, queue_bytes=HUB_CLIENT_QUEUE_BYTES):
+        self.hub = hub
+        self.sock = sock
+        self.address = address
+        self.queue_bytes = queue_bytes
+        self.sent_bytes = 0
+        self.dropped_bytes = 0
+        self.queued_bytes = 0
+        self.max_queued_bytes = 0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._sender = threading.Thread(target=self._send_loop, name='hub-send %s:%d' % address[:2])
+        self._sender.daemon = True
+        self._receiver = threading.Thread(target=self._receive_loop, name='hub-receive %s:%d' % address[:2])
+        self._receiver.daemon = True
+
+    @property
+    def name(self):
+        return '%s:%d' % self.address[:2]
+
+    def start(self):
+        self._sender.start()
+        self._receiver.start()
+
+    def offer(self, frames):
+        """
+        Queue frames for the client, dropping each frame that doesn't fit
+        in the queue whole.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            queued = []
+            queued_bytes = self.queued_bytes
+            for frame in frames:
+                if queued_bytes + len(frame) > self.queue_bytes:
+                    self.dropped_bytes += len(frame)
+                    continue
+                queued.append(frame)
+                queued_bytes += len(frame)
+            if not queued:
+                return
+            self._queue.append(b''.join(queued))
+            self.queued_bytes = queued_bytes
+            self.max_queued_bytes = max(self.max_queued_bytes, self.queued_bytes)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self.sock.close()
+        self.hub._remove(self)
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                data = self._queue.popleft()
+            try:
+                self.sock.sendall(data)
+            except (OSError, socket.error):
+                self.close()
+                return
+            with self._cond:
+                self.queued_bytes -= len(data)
+                self.sent_bytes += len(data)
+
+    def _receive_loop(self):
+        buf = bytearray()
+        while True:
+            try:
+                data = self.sock.recv(HUB_RECV_SIZE)
+            except (OSError, socket.error):
+                data = b''
+            if not data:
+                self.close()
+                return
+            buf += data
+            frames, consumed = split_frames(buf)
+            del buf[:consumed]
+            if frames:
+                self.hub.write(b''.join(frames))
+
+
+class TcpHub(object):
+    """
+    Serves the raw stream of a driver to TCP clients, and writes the
+    frames they send to the driver.  It can stand in for a `Handler` in
+    `serial_link.run`.
+
+    Parameters
+    ----------
+    driver : BaseDriver
+        Connection to the device.
+    host : str
+        Address to listen on, IPv4 or IPv6, '' for every interface.
+    port : int
+        Port to listen on, 0 for any free port.
+    queue_bytes : int (optional)
+        Bytes queued for each client before data for it is dropped.
+
+    Fields
+    ----------
+    address : (str, int)
+      Address the hub listens on
+    clients : [HubClient]
+      Connected clients
+    """
+
+    def __init__(self, driver, host, port, queue_bytes=HUB_CLIENT_QUEUE_BYTES):
+        self.driver = driver
+        self.queue_bytes = queue_bytes
+        self.clients = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stopped = threading.Event()
+        family, _, _, _, sockaddr = socket.getaddrinfo(host or None, port, socket.AF_UNSPEC,
+                                                       socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+        self._server = socket.socket(family, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(sockaddr)
+        self._server.listen(HUB_BACKLOG)
+        self.address = self._server.getsockname()
+        self._reader = threading.Thread(target=self._read_loop, name='hub-reader')
+        self._reader.daemon = True
+        self._acceptor = threading.Thread(target=self._accept_loop, name='hub-acceptor')
+        self._acceptor.daemon = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __call__(self, *msgs, **metadata):
+        self.write(b''.join(msg.to_binary() for msg in msgs))
+
+    def start(self):
+        self._reader.start()
+        self._acceptor.start()
+
+    def stop(self):
+        self._stopped.set()
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self._server.close()
+        for client in list(self.clients):
+            client.close()
+
+    def is_alive(self):
+        return self._reader.is_alive()
+
+    def write(self, data):
+        """Write whole frames to the device."""
+        with self._write_lock:
+            self.driver.write(data)
+
+    def _remove(self, client):
+        with self._lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def _accept_loop(self):
+        while not self._stopped.is_set():
+            try:
+                sock, address = self._server.accept()
+            except (OSError, socket.error):
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = HubClient(self, sock, address, self.queue_bytes)
+            with self._lock:
+                self.clients.append(client)
+            client.start()
+
+    def _read_loop(self):
+        buf = bytearray()
+        while not self._stopped.is_set():
+            try:
+                data = self.driver.read(read_size(self.driver))
+            except (IOError, OSError):
+                return
+            if not data:
+                return
+            buf += data
+            frames, consumed = split_frames(buf)
+            del buf[:consumed]
+            if not frames:
+                continue
+            with self._lock:
+                clients = list(self.clients)
+            for client in clients:
+                client.offer(frames)
+
+    def status(self):
+        """One line per client, giving its lag and what it was sent and dropped."""
+        with self._lock:
+            clients = list(self.clients)
+        return ["{0}: {1} bytes sent, {2} dropped, {3} queued (max {4})".format(
+            client.name, client.sent_bytes, client.dropped_bytes, client.queued_bytes, client.max_queued_bytes)
+            for client in clients]
@@ -15,6 +15,7 @@ import errno
 import monotonic
 import os
 import socket
+import struct
 import sys
 import time
 
@@ -22,6 +23,12 @@ from threading import Event, Thread
 
 from sbp.client.drivers.network_drivers import TCPDriver
 
+# SBP framing shared by the tools that build or parse frames themselves
+FRAME_HEADER = struct.Struct('<BHHB')  # preamble, message type, sender, payload length
+MSG_HEADER = struct.Struct('<HHB')  # message type, sender, payload length, after the preamble
+FRAME_CRC = struct.Struct('<H')
+FRAME_OVERHEAD_LEN = FRAME_HEADER.size + FRAME_CRC.size
+
 
 def wrap_sbp_dict(data_dict, timestamp):
     return {'data': data_dict, 'time': timestamp}
@@ -67,6 +74,29 @@ def get_tcp_driver(host, port=None):
         raise Exception('Invalid host and/or port: {}'.format(str(e)))
 
 
+def split_host_port(text):
+    """
+    Split a 'host:port' address, where an IPv6 host is written in brackets,
+    e.g. '[fe80::1]:55555'.  The port is optional, and a bare IPv6 address
+    is taken as a host.
+
+    Returns
+    -------
+    out : (str, int)
+        Host and port, the port is None if not given.
+    """
+    if text.startswith('['):
+        host, bracket, rest = text[1:].partition(']')
+        if not bracket or (rest and not rest.startswith(':')):
+            raise ValueError('Invalid address: {}'.format(text))
+        port = rest[1:]
+    elif text.count(':') == 1:
+        host, _, port = text.partition(':')
+    else:
+        host, port = text, ''
+    return host, int(port) if port else None
+
+
 def call_repeatedly(interval, func, *args):
     stopped = Event()
 
@@ -0,0 +1,128 @@
+# -*- python -*-
+
+import asyncio
+import os
+import socket
+
+import pytest
+from sbp.file_io import SBP_MSG_FILEIO_READ_RESP
+from sbp.msg import SBP
+from sbp.system import SBP_MSG_HEARTBEAT, MsgHeartbeat
+
+from piksi_tools.aio import AsyncFileIO, AsyncLink, AsyncSelectiveRepeater, AsyncSettings
+from piksi_tools.emulator import DeviceEmulator
+from piksi_tools.fileio import FramedReadReq
+
+
+def run_with_link(device, body):
+    async def run():
+        reader, writer = await asyncio.open_connection(sock=device.driver.handle)
+        async with AsyncLink(reader, writer) as link:
+            return await asyncio.wait_for(body(link), 30)
+    return asyncio.run(run())
+
+
+def test_fileio_round_trip_over_lossy_link():
+    data = os.urandom(20000)
+
+    async def body(link):
+        fio = AsyncFileIO(link)
+        await fio.write(b'/logs/a.bin', data)
+        await fio.write(b'logs/b.bin', data[:100])
+        assert device.files[b'logs/a.bin'] == data
+        assert await fio.read(b'logs/a.bin') == data
+        assert await fio.readdir(b'logs') == [b'a.bin', b'b.bin']
+        assert await fio.readdir(b'/', recursive=True) == [b'logs/', b'logs/a.bin', b'logs/b.bin']
+        assert sum(X.goodput_bytes for X in fio.transfer_stats) > 2 * len(data)
+
+    with DeviceEmulator(loss=0.02, latency=0.002, jitter=0.002, seed=7) as device:
+        run_with_link(device, body)
+
+
+def test_settings():
+    async def body(link):
+        async with AsyncSettings(link, timeout=0.05) as settings:
+            assert await settings.read('system_info', 'firmware_version') == 'v2.3.17'
+            await settings.write('solution', 'soln_freq', '5')
+            assert device.settings['solution']['soln_freq'] == '5'
+            assert (await settings.read_all())['uart0']['baudrate'] == '115200'
+            with pytest.raises(RuntimeError):
+                await settings.write('solution', 'no_such_setting', '1')
+
+    with DeviceEmulator(latency=0.001, heartbeat_interval=0.05, seed=0) as device:
+        run_with_link(device, body)
+
+
+def test_repeater_exit_after_failed_send():
+    class FailingLink(object):
+        closed = asyncio.Event()
+
+        def add_close_callback(self, callback):
+            pass
+
+        def remove_close_callback(self, callback):
+            pass
+
+        def add_callback(self, callback, msg_type=None):
+            pass
+
+        def remove_callback(self, callback, msg_type=None):
+            pass
+
+        def __call__(self, *msgs):
+            raise ConnectionError('link down')
+
+    async def body():
+        with pytest.raises(ConnectionError):
+            async with AsyncSelectiveRepeater(FailingLink(), SBP_MSG_FILEIO_READ_RESP, skip_config=True) as sr:
+                await sr.send(FramedReadReq(sequence=1, offset=0, chunk_size=251, filename=b'a.bin'))
+
+    asyncio.run(body())
+
+
+def test_link_survives_bad_messages_and_callbacks():
+    host, device = socket.socketpair()
+
+    async def body():
+        reader, writer = await asyncio.open_connection(sock=host)
+        async with AsyncLink(reader, writer) as link:
+            def failing_cb(msg):
+                raise ValueError('callback failed')
+            link.add_callback(failing_cb, SBP_MSG_HEARTBEAT)
+            # A valid frame whose payload is too short to parse
+            device.sendall(SBP(SBP_MSG_FILEIO_READ_RESP, 1, 1, b'\x01').to_binary())
+            device.sendall(MsgHeartbeat(flags=1).to_binary())
+            assert (await link.wait(SBP_MSG_HEARTBEAT, 5)).flags == 1
+            # Still receiving after the failing callback
+            device.sendall(MsgHeartbeat(flags=2).to_binary())
+            assert (await link.wait(SBP_MSG_HEARTBEAT, 5)).flags == 2
+            assert not link.closed.is_set()
+
+    with pytest.warns(UserWarning) as record:
+        asyncio.run(body())
+    messages = [str(warning.message) for warning in record]
+    assert any(message.startswith('SBP dispatch error') for message in messages)
+    assert 'SBP callback error: callback failed' in messages
+    device.close()
+
+
+def test_closed_link_fails_waiters_immediately():
+    host, device = socket.socketpair()
+
+    async def body():
+        reader, writer = await asyncio.open_connection(sock=host)
+        async with AsyncLink(reader, writer) as link:
+            loop = asyncio.get_event_loop()
+            loop.call_later(0.1, device.close)
+            started = loop.time()
+            async with AsyncSettings(link, timeout=10) as settings:
+                with pytest.raises(ConnectionError):
+                    await settings.read('system_info', 'firmware_version')
+            async with AsyncSelectiveRepeater(link, SBP_MSG_FILEIO_READ_RESP, skip_config=True) as sr:
+                with pytest.raises(ConnectionError):
+                    await sr.send(FramedReadReq(sequence=1, offset=0, chunk_size=251, filename=b'a.bin'))
+            with pytest.raises(ConnectionError):
+                await link.wait(SBP_MSG_HEARTBEAT, 10)
+            assert loop.time() - started < 5
+
+    asyncio.run(body())
@@ -0,0 +1,22 @@
+# -*- python -*-
+
+import json
+
+from piksi_tools.bench import fileio as bench
+
+
+def test_percentiles():
+    assert bench.percentile([3, 1, 2, 4], 0.5) == 2
+    assert bench.percentile([3, 1, 2, 4], 0.95) == 4
+    assert bench.histogram_percentile([0, 3, 1] + [0] * 8, 0.5) == 10
+    assert bench.histogram_percentile([0] * 11, 0.5) is None
+
+
+def test_fileio_benchmark_report(tmp_path):
+    output = str(tmp_path / 'report.json')
+    bench.main(['--size', '5000', '--files', '20', '--repeat', '1', '--window', '10,50', '-o', output])
+    with open(output) as f:
+        results = json.load(f)['results']
+    assert [(X['window'], X['op']) for X in results] == [
+        (10, 'write'), (10, 'read'), (10, 'readdir'), (50, 'write'), (50, 'read'), (50, 'readdir')]
+    assert all(X['goodput_bytes_per_s'] > 0 and X['retry_ratio'] == 0 for X in results)
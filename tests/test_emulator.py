@@ -0,0 +1,232 @@
+# -*- python -*-
+
+import copy
+import io
+import os
+import time
+
+import pytest
+from sbp.client import Framer, Handler
+from sbp.piksi import SBP_MSG_COMMAND_RESP
+
+from piksi_tools import bootload_v3
+from piksi_tools.diagnostics import Diagnostics
+from piksi_tools.emulator import DEFAULT_SETTINGS, DeviceEmulator
+from piksi_tools.fileio import FileIO, TransferStats
+from piksi_tools.settings import Settings
+from piksi_tools.stm_unique_id import STMUniqueID
+
+
+@pytest.fixture
+def device():
+    with DeviceEmulator(latency=0.001, heartbeat_interval=0.05, seed=0,
+                        command_handler=lambda command: (7, [b'flashing'])) as device:
+        yield device
+
+
+@pytest.fixture
+def link(device):
+    with Handler(Framer(device.driver.read, device.driver.write)) as link:
+        yield link
+
+
+def test_fileio_round_trip_over_lossy_link():
+    data = os.urandom(20000)
+    with DeviceEmulator(loss=0.02, latency=0.002, jitter=0.002, seed=7) as device:
+        with Handler(Framer(device.driver.read, device.driver.write)) as link:
+            fio = FileIO(link)
+            fio.write(b'/logs/a.bin', data)
+            fio.write(b'logs/b.bin', data[:100])
+            assert device.files[b'logs/a.bin'] == data
+            assert fio.read(b'logs/a.bin') == data
+            assert fio.readdir(b'logs') == [b'a.bin', b'b.bin']
+            assert fio.readdir(b'/', recursive=True) == [b'logs/', b'logs/a.bin', b'logs/b.bin']
+    assert device.inbound.dropped + device.outbound.dropped > 0
+
+
+def test_settings(device, link):
+    with Settings(link, timeout=0.05) as settings:
+        assert settings.read('system_info', 'firmware_version') == 'v2.3.17'
+        settings.write('solution', 'soln_freq', '5')
+        assert device.settings['solution']['soln_freq'] == '5'
+        assert settings.read_all()['uart0']['baudrate'] == '115200'
+
+
+def test_diagnostics(device, link):
+    diagnostics = Diagnostics(link, timeout=10).diagnostics
+    assert diagnostics['settings']['system_info']['firmware_version'] == 'v2.3.17'
+    assert diagnostics['settings']['uart0'] == dict(DEFAULT_SETTINGS['uart0'])
+    assert diagnostics['versions']['bootloader'] == 'v1.2'
+    assert device.resets == 1
+
+
+def test_unique_id_and_commands(device, link):
+    with STMUniqueID(link) as stm_unique_id:
+        assert stm_unique_id.get_id() == tuple(range(12))
+    assert bootload_v3.shell_command(link, b'upgrade_tool upgrade.image_set.bin', 5) == 7
+    assert device.commands == [b'upgrade_tool upgrade.image_set.bin']
+
+
+def test_concurrent_commands():
+    def handler(command):
+        return int(command.split()[-1]), [command + b' running', command + b' finished']
+
+    with DeviceEmulator(command_handler=handler, command_duration=0.2) as device:
+        with Handler(Framer(device.driver.read, device.driver.write)) as link:
+            with bootload_v3.CommandRunner(link) as runner:
+                output = {1: [], 2: []}
+                seqs = [runner.start(b'exit %d' % X, output[X].append) for X in (1, 2)]
+                start = time.monotonic()
+                progress = []
+                assert runner.wait(seqs[1], 5, progress.append) == 2
+                assert runner.wait(seqs[0], 5) == 1
+                assert time.monotonic() - start < 1
+                assert output[2] == [b'exit 2 running', b'exit 2 finished']
+                assert output[1] == [b'exit 1 running', b'exit 1 finished']
+                assert progress == []
+                assert runner.run(b'exit 3', 0.05, progress.append) is None
+            assert not link._callbacks[SBP_MSG_COMMAND_RESP]
+
+
+def test_fleet_upgrade(tmpdir):
+    # Nothing is read from the image set itself, any contents will do
+    image = os.urandom(30000)
+    firmware = str(tmpdir.join('image_set.bin'))
+    with open(firmware, 'wb') as f:
+        f.write(image)
+    hosts = tmpdir.join('hosts.txt')
+    hosts.write('# lab bench\n10.0.0.1\n10.0.0.2:1234\n')
+    failed_connects = []
+    out = io.StringIO()
+    devices = {}
+    reported_versions = {}
+
+    def connect(host, port):
+        if host == '10.0.0.2' and not failed_connects:
+            failed_connects.append(host)
+            raise IOError('connection refused')
+        settings = copy.deepcopy(DEFAULT_SETTINGS)
+        settings['system_info']['firmware_version'] = reported_versions.get(host, 'v2.3.17')
+        devices[host] = DeviceEmulator(latency=0.001, command_handler=lambda command: (0, []),
+                                       unique_id=host.encode('ascii').ljust(12, b'\0'), settings=settings)
+        devices[host].start()
+        return devices[host].driver
+
+    cache = bootload_v3.UpgradeCache(str(tmpdir.join('cache', 'upgrade_cache.json')))
+    checkpoint_dir = str(tmpdir.join('checkpoints'))
+    fleet = bootload_v3.FleetUpgrade(bootload_v3.read_fleet(str(hosts)), firmware, jobs=2, retry_delay=0.2,
+                                     checkpoint_dir=checkpoint_dir, cache=cache, connect=connect, out=out)
+    start = time.monotonic()
+    try:
+        assert fleet.run()
+    finally:
+        for device in devices.values():
+            device.stop()
+    # The failed connect is retried after a delay
+    assert time.monotonic() - start >= 0.2
+    assert all(X.sent == X.size for X in fleet.devices)
+    assert [(X.name, X.state, X.attempts) for X in fleet.devices] == [
+        ('10.0.0.1:55555', 'done', 1), ('10.0.0.2:1234', 'done', 2)]
+    for device in devices.values():
+        assert device.files[b'upgrade.image_set.bin'] == image
+        assert device.commands == [b'upgrade_tool upgrade.image_set.bin']
+        assert device.resets
+    assert '2 of 2 receivers upgraded, 0 already current' in out.getvalue()
+    assert sorted(X.basename for X in tmpdir.listdir()) == ['cache', 'checkpoints', 'hosts.txt', 'image_set.bin']
+    assert not os.listdir(checkpoint_dir)
+
+    # Rerunning skips receivers that now run the new firmware
+    devices.clear()
+    reported_versions.update({'10.0.0.1': 'v2.4.0', '10.0.0.2': 'v2.4.0'})
+    cache = bootload_v3.UpgradeCache(cache.path)
+    fleet = bootload_v3.FleetUpgrade(bootload_v3.read_fleet(str(hosts)), firmware, checkpoint_dir=checkpoint_dir,
+                                     cache=cache, connect=connect, out=out)
+    try:
+        assert fleet.run()
+    finally:
+        for device in devices.values():
+            device.stop()
+    assert [X.state for X in fleet.devices] == ['skipped', 'skipped']
+    assert all(not X.files and not X.commands for X in devices.values())
+    assert all(X['previous_version'] == 'v2.3.17' for X in cache.entries.values())
+
+    # A receiver that fell back to its old firmware is upgraded again
+    devices.clear()
+    reported_versions['10.0.0.1'] = 'v2.3.17'
+    fleet = bootload_v3.FleetUpgrade(bootload_v3.read_fleet(str(hosts)), firmware, checkpoint_dir=checkpoint_dir,
+                                     cache=cache, connect=connect, out=out)
+    try:
+        assert fleet.run()
+    finally:
+        for device in devices.values():
+            device.stop()
+    assert [X.state for X in fleet.devices] == ['done', 'skipped']
+
+
+def test_fleet_upgrade_retries_timeouts(tmpdir):
+    firmware = str(tmpdir.join('image_set.bin'))
+    with open(firmware, 'wb') as f:
+        f.write(os.urandom(5000))
+    hosts = tmpdir.join('hosts.txt')
+    hosts.write('[::1]:1234\nfe80::2\n')
+    assert bootload_v3.read_fleet(str(hosts)) == [('::1', 1234), ('fe80::2', 55555)]
+    devices = []
+
+    def connect(host, port):
+        # The first flash of ::1 outlasts the upgrade timeout
+        slow = host == '::1' and not devices
+        devices.append(DeviceEmulator(latency=0.001, command_duration=1.0 if slow else 0.0,
+                                      command_handler=lambda command: (0, [])))
+        devices[-1].start()
+        return devices[-1].driver
+
+    checkpoint_dir = str(tmpdir.join('checkpoints'))
+    fleet = bootload_v3.FleetUpgrade(bootload_v3.read_fleet(str(hosts)), firmware, jobs=1, retry_delay=0,
+                                     checkpoint_dir=checkpoint_dir, upgrade_timeout=0.2, connect=connect,
+                                     out=io.StringIO())
+    assert os.path.dirname(fleet.checkpoint_path(fleet.devices[0])) == checkpoint_dir
+    try:
+        assert fleet.run()
+    finally:
+        for device in devices:
+            device.stop()
+    assert [(X.state, X.attempts) for X in fleet.devices] == [('done', 2), ('done', 1)]
+    assert [len(X.commands) for X in devices] == [1, 1, 1]
+
+
+def test_upgrade_cache(tmpdir):
+    cache = bootload_v3.UpgradeCache(str(tmpdir.join('cache.json')))
+    # Nothing to record without the version from before the upgrade
+    cache.record('00ff', 'abc', None)
+    cache.record(None, 'abc', 'v2.3.17')
+    assert not os.path.exists(cache.path)
+    assert not cache.is_current('00ff', 'abc', 'v2.4.0')
+    cache.record('00ff', 'abc', 'v2.3.17')
+    assert not cache.is_current('00ff', 'def', 'v2.4.0')
+    assert not cache.is_current('00ff', 'abc', None)
+    assert cache.is_current('00ff', 'abc', 'v2.4.0')
+    cache = bootload_v3.UpgradeCache(cache.path)
+    assert cache.is_current('00ff', 'abc', 'v2.4.0')
+    # Still, or again, reporting the version from before the upgrade
+    assert not cache.is_current('00ff', 'abc', 'v2.3.17')
+    assert not cache.is_current('0100', 'abc', 'v2.4.0')
+
+
+def test_device_upgrade_reports_acknowledged_progress():
+    class Repeater(object):
+        stats = TransferStats()
+
+    device = bootload_v3.DeviceUpgrade('10.0.0.1', 55555, 10000)
+    device.start_attempt()
+    repeater = Repeater()
+    device.on_progress(4000, repeater)
+    assert (device.resumed_from, device.sent) == (4000, 4000)
+    # Sent but not yet acknowledged data doesn't count
+    device.on_progress(6000, repeater)
+    assert device.sent == 4000
+    repeater.stats.goodput_bytes = 1500
+    device.on_progress(6500, repeater)
+    assert device.sent == 5500
+    assert device.retry_delay(1.0) == 1.0
+    device.start_attempt()
+    assert device.retry_delay(1.0) == 2.0
@@ -0,0 +1,444 @@
+# -*- python -*-
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+from sbp.client import Framer, Handler
+from sbp.file_io import (SBP_MSG_FILEIO_CONFIG_REQ, SBP_MSG_FILEIO_WRITE_RESP,
+                         MsgFileioConfigResp, MsgFileioWriteReq,
+                         MsgFileioWriteResp)
+
+import piksi_tools.fileio as fileio
+from piksi_tools.emulator import DeviceEmulator
+from piksi_tools.utils import Time
+
+
+class FakeLink(object):
+    """Records sent messages instead of writing them to a device."""
+
+    def __init__(self):
+        self.sent = []
+
+    def __call__(self, *msgs, **metadata):
+        self.sent.extend(msgs)
+
+    def add_callback(self, callback, msg_type=None):
+        pass
+
+    def remove_callback(self, callback, msg_type=None):
+        pass
+
+
+def mk_write_req(seq, offset=0):
+    return MsgFileioWriteReq(sequence=seq, offset=offset, filename=b'f\0', data=b'')
+
+
+def test_check_pending_retries_expired():
+    link = FakeLink()
+    sr = fileio.SelectiveRepeater(link, SBP_MSG_FILEIO_WRITE_RESP, skip_config=True)
+    long_ago = Time.now() - Time(10)
+    sr._record_pending_req(mk_write_req(1), long_ago, long_ago + Time(1))
+    sr._record_pending_req(mk_write_req(2), Time.now(), Time.now() + Time(60))
+    sr._check_pending()
+    assert [msg.sequence for msg in link.sent] == [1]
+    assert sr.total_retries == 1
+    # The retried request is re-armed in the future, so nothing more to do
+    sr._check_pending()
+    assert len(link.sent) == 1
+
+
+def test_completed_requests_are_not_retried():
+    link = FakeLink()
+    sr = fileio.SelectiveRepeater(link, SBP_MSG_FILEIO_WRITE_RESP, skip_config=True)
+    long_ago = Time.now() - Time(10)
+    sr._record_pending_req(mk_write_req(1), long_ago, long_ago + Time(1))
+    sr._request_cb(MsgFileioWriteResp(sequence=1))
+    sr._check_pending()
+    assert link.sent == []
+    assert not sr._has_pending()
+
+
+def test_expire_heap_stays_bounded():
+    link = FakeLink()
+    sr = fileio.SelectiveRepeater(link, SBP_MSG_FILEIO_WRITE_RESP, skip_config=True)
+    window = len(sr._pending_map)
+    for seq in range(20 * window):
+        sr._record_pending_req(mk_write_req(seq), Time.now(), Time.now() + Time(60))
+        sr._request_cb(MsgFileioWriteResp(sequence=seq))
+    assert len(sr._expire_heap) <= fileio.EXPIRE_HEAP_COMPACT_FACTOR * window + 1
+
+
+def test_congestion_window_slow_start_and_cap():
+    cwnd = fileio.CongestionWindow(limit=10, initial=2)
+    assert cwnd.window == 2
+    for _ in range(4):
+        cwnd.on_ack()
+    assert cwnd.window == 6
+    for _ in range(100):
+        cwnd.on_ack()
+    assert cwnd.window == 10
+
+
+def test_congestion_window_halves_once_per_event():
+    cwnd = fileio.CongestionWindow(limit=100, initial=40)
+    sent = Time.now() - Time(1)
+    cwnd.on_timeout(sent)
+    assert cwnd.window == 20
+    # Other requests from the same flight don't shrink it again
+    cwnd.on_timeout(sent)
+    assert cwnd.window == 20
+    # Past the threshold growth is additive
+    for _ in range(20):
+        cwnd.on_ack()
+    assert cwnd.window in (20, 21)
+    cwnd.on_timeout(Time.now() + Time(1))
+    assert cwnd.window == 10
+
+
+def test_window_never_stalls_an_idle_link():
+    link = FakeLink()
+    sr = fileio.SelectiveRepeater(link, SBP_MSG_FILEIO_WRITE_RESP, skip_config=True)
+    sr._cwnd.size = 1.0
+    assert sr._window_available(3)
+    sr._record_pending_req(mk_write_req(1), Time.now(), Time.now() + Time(60))
+    assert not sr._window_available(1)
+
+
+def test_rtt_estimator_converges_and_backs_off():
+    rtt = fileio.RttEstimator()
+    assert rtt.timeout() == Time(fileio.SBP_FILEIO_TIMEOUT)
+    for _ in range(50):
+        rtt.sample(0.1)
+    # Clamped to the minimum once the variation has decayed
+    assert rtt.timeout() == Time.from_float(fileio.SBP_FILEIO_MIN_TIMEOUT)
+    assert rtt.timeout(1) == Time.from_float(2 * fileio.SBP_FILEIO_MIN_TIMEOUT)
+    assert rtt.timeout(30) == Time(fileio.SBP_FILEIO_MAX_TIMEOUT)
+
+
+def test_retried_requests_are_not_sampled():
+    link = FakeLink()
+    sr = fileio.SelectiveRepeater(link, SBP_MSG_FILEIO_WRITE_RESP, skip_config=True)
+    long_ago = Time.now() - Time(10)
+    sr._record_pending_req(mk_write_req(1), long_ago, long_ago + Time(1))
+    sr._check_pending()
+    sr._request_cb(MsgFileioWriteResp(sequence=1))
+    assert sr._rtt.srtt is None
+    sr._record_pending_req(mk_write_req(2), Time.now(), Time.now() + Time(60))
+    sr._request_cb(MsgFileioWriteResp(sequence=2))
+    assert sr._rtt.srtt is not None
+
+
+def test_write_checkpoint_tracks_contiguous_offset(tmp_path, monkeypatch):
+    monkeypatch.setattr(fileio, 'CHECKPOINT_INTERVAL_BYTES', 10)
+    path = str(tmp_path / 'image.bin.checkpoint')
+    data = bytearray(range(100))
+    journal = fileio.WriteCheckpoint(path, b'image.bin', data)
+    assert journal.load() == 0
+    journal.start(0)
+    journal.ack(20, 40)
+    assert journal.offset == 0
+    journal.ack(0, 20)
+    assert journal.offset == 40
+    # Persisted, and only usable for the same data
+    assert fileio.WriteCheckpoint(path, b'image.bin', data).load() == 40
+    assert fileio.WriteCheckpoint(path, b'image.bin', data[:-1]).load() == 0
+    assert fileio.WriteCheckpoint(path, b'other.bin', data).load() == 0
+    journal.remove()
+    assert journal.load() == 0
+
+
+def test_positional_writer_out_of_order(tmp_path):
+    path = tmp_path / 'out.bin'
+    with open(str(path), 'wb') as f:
+        write_at = fileio.positional_writer(f)
+        write_at(4, memoryview(b'world'))
+        write_at(0, b'hey ')
+    assert path.read_bytes() == b'hey world'
+
+
+def test_source_view_accepts_buffers_and_files(tmp_path):
+    import io
+    path = tmp_path / 'image.bin'
+    path.write_bytes(b'firmware')
+    with open(str(path), 'rb') as f, fileio.source_view(f) as view:
+        assert view[4:] == b'ware'
+    with fileio.source_view(io.BytesIO(b'stream')) as view:
+        assert bytes(view) == b'stream'
+    with fileio.source_view(bytearray(b'bytes')) as view:
+        assert len(view) == 5
+    path.write_bytes(b'')
+    with open(str(path), 'rb') as f, fileio.source_view(f) as view:
+        assert len(view) == 0
+
+
+def test_sync_manifest_round_trip(tmp_path):
+    path = str(tmp_path / fileio.SYNC_MANIFEST_NAME)
+    data = tmp_path / 'log.bin'
+    data.write_bytes(b'log data')
+    digest = fileio.file_digest(str(data))
+    manifest = fileio.SyncManifest(path)
+    assert manifest.size(b'logs/log.bin') is None
+    manifest.record(b'logs/log.bin', 8, digest)
+    manifest.save()
+    manifest = fileio.SyncManifest(path)
+    assert manifest.matches(b'logs/log.bin', 8, digest)
+    assert not manifest.matches(b'logs/log.bin', 9, digest)
+    assert fileio.remote_join(b'logs/', b'log.bin') == b'logs/log.bin'
+    assert fileio.remote_join(b'.', b'log.bin') == b'log.bin'
+
+
+def test_dir_listing_merges_speculative_replies():
+    from sbp.file_io import MsgFileioReadDirReq, MsgFileioReadDirResp
+
+    def reply(listing, offset, names):
+        req = MsgFileioReadDirReq(sequence=0, offset=offset, dirname=b'logs')
+        listing.on_response(req, MsgFileioReadDirResp(sequence=0, contents=b''.join(n + b'\0' for n in names)))
+
+    listing = fileio._DirListing(b'logs')
+    assert listing.next_offsets(8) == [0]
+    reply(listing, 0, [b'a', b'b', b'c'])
+    assert listing.next_offsets(8) == [3]
+    reply(listing, 3, [b'd', b'e'])
+    # Guesses are spaced by the average reply length, and double each round
+    assert listing.next_offsets(8) == [5, 7]
+    reply(listing, 5, [])
+    reply(listing, 7, [])
+    assert listing.done
+    assert listing.result() == [b'a', b'b', b'c', b'd', b'e']
+
+    listing = fileio._DirListing(b'logs')
+    reply(listing, 0, [b'a', b'b'])
+    reply(listing, 4, [b'e'])
+    reply(listing, 6, [])
+    # The hole left by a reply shorter than guessed is requested again
+    assert not listing.done
+    assert listing.next_offsets(8) == [2, 5]
+
+
+def test_framed_requests_match_sbp_encoding():
+    from sbp.file_io import MsgFileioReadReq
+    read_req = fileio.FramedReadReq(sequence=7, offset=1024, chunk_size=251, filename=b'log.sbp')
+    assert read_req.to_binary() == MsgFileioReadReq(
+        sequence=7, offset=1024, chunk_size=251, filename=b'log.sbp').to_binary()
+    source = memoryview(bytes(range(256)) * 4)
+    write_req = fileio.FramedWriteReq(sequence=8, offset=300, filename=b'image.bin', source=source, end=520)
+    assert bytes(write_req.data) == bytes(source[300:520])
+    expected = MsgFileioWriteReq(sequence=8, offset=300, filename=b'image.bin\0', data=bytes(source[300:520]))
+    assert write_req.to_binary() == expected.to_binary()
+    # Batches are framed back to back into one buffer
+    buf = bytearray(1024)
+    length = read_req.into_buffer(buf, 0)
+    length += write_req.into_buffer(buf, length)
+    assert bytes(buf[:length]) == read_req.to_binary() + expected.to_binary()
+
+
+def test_transfer_stats_record_sends_retries_and_goodput():
+    link = FakeLink()
+    sr = fileio.SelectiveRepeater(link, SBP_MSG_FILEIO_WRITE_RESP, skip_config=True)
+    source = memoryview(bytes(200000))
+    sr.send(fileio.FramedWriteReq(sequence=1, offset=0, filename=b'f', source=source, end=200))
+    sr.send(fileio.FramedWriteReq(sequence=2, offset=70000, filename=b'f', source=source, end=70200))
+    sr._pending_map[sr._seqmap[2]].time_expire = Time.now() - Time(1)
+    sr._schedule_expire(sr._pending_map[sr._seqmap[2]])
+    sr._check_pending()
+    sr._request_cb(MsgFileioWriteResp(sequence=1))
+    sr._request_cb(MsgFileioWriteResp(sequence=2))
+    stats = sr.stats.to_dict()
+    assert stats['requests'] == 2
+    assert stats['retries'] == 1
+    assert stats['retries_by_offset'] == {'65536-131071': 1}
+    # Only the request that wasn't retried gives an RTT sample
+    assert sum(stats['rtt_ms_histogram'].values()) == 1
+    assert stats['goodput_bytes'] == 400
+    assert stats['raw_bytes'] > 3 * 200
+    assert stats['window_samples'][0][1:] == [1, fileio.SBP_FILEIO_INITIAL_WINDOW]
+
+
+@contextmanager
+def emulated_fileio(**kwargs):
+    with DeviceEmulator(**kwargs) as device:
+        with Handler(Framer(device.driver.read, device.driver.write)) as link:
+            yield device, fileio.FileIO(link)
+
+
+def test_read_into_dest_over_reordering_link(tmp_path):
+    data = os.urandom(30000)
+    path = tmp_path / 'out.bin'
+    # Longer than the file read, the excess must be truncated
+    path.write_bytes(b'\xff' * 40000)
+    with emulated_fileio(files={b'log.bin': data}, latency=0.001, jitter=0.005, seed=3) as (device, fio):
+        with open(str(path), 'r+b') as dest:
+            assert fio.read(b'log.bin', dest=dest) == len(data)
+    assert path.read_bytes() == data
+
+
+def test_read_iter_over_lossy_reordering_link():
+    data = os.urandom(50000)
+    with emulated_fileio(files={b'log.bin': data}, loss=0.02, latency=0.001, jitter=0.005, seed=5) as (device, fio):
+        pieces = list(fio.read_iter(b'log.bin', chunk_bytes=4096))
+    assert b''.join(pieces) == data
+    assert all(len(piece) >= 4096 for piece in pieces[:-1])
+    assert device.inbound.dropped + device.outbound.dropped > 0
+
+
+def test_read_iter_chunk_multiple_and_empty_file():
+    chunk_size = fileio.MAX_PAYLOAD_SIZE - fileio.READ_RESP_OVERHEAD_LEN
+    data = os.urandom(8 * chunk_size)
+    with emulated_fileio(files={b'exact.bin': data, b'empty.bin': b''}, jitter=0.002, seed=1) as (device, fio):
+        assert b''.join(fio.read_iter(b'exact.bin', chunk_bytes=2 * chunk_size)) == data
+        assert list(fio.read_iter(b'empty.bin')) == []
+        assert list(fio.read_iter(b'missing.bin')) == []
+
+
+def test_write_many_read_many_round_trip(tmp_path):
+    files = [(b'logs/a.bin', os.urandom(5000)), (b'logs/empty.bin', b''), (b'b.bin', os.urandom(300))]
+    with emulated_fileio(latency=0.001, jitter=0.002, seed=2) as (device, fio):
+        fio.write_many(files)
+        assert dict((name, bytes(data)) for name, data in device.files.items()) == dict(files)
+        names = [name for name, _ in files]
+        assert fio.read_many(names) == [data for _, data in files]
+        paths = [str(tmp_path / ('%d.bin' % X)) for X in range(len(files))]
+        dests = [open(path, 'wb') for path in paths]
+        try:
+            assert fio.read_many(names, dests) == [len(data) for _, data in files]
+        finally:
+            for dest in dests:
+                dest.close()
+    for path, (_, data) in zip(paths, files):
+        with open(path, 'rb') as f:
+            assert f.read() == data
+
+
+def test_write_creates_empty_file():
+    with emulated_fileio(files={b'old.bin': b'stale'}) as (device, fio):
+        fio.write(b'old.bin', b'')
+        assert device.files[b'old.bin'] == b''
+
+
+def test_sync_push_and_pull(tmp_path):
+    local = tmp_path / 'local'
+    (local / 'sub').mkdir(parents=True)
+    (local / 'a.log').write_bytes(b'a' * 1000)
+    (local / 'empty.log').write_bytes(b'')
+    (local / 'sub' / 'b.log').write_bytes(b'b' * 300)
+    pulled = tmp_path / 'pulled'
+    with emulated_fileio(latency=0.001, jitter=0.002, seed=4) as (device, fio):
+        assert fileio.sync_push(fio, str(local), b'logs') == [b'logs/a.log', b'logs/empty.log', b'logs/sub/b.log']
+        assert device.files[b'logs/sub/b.log'] == b'b' * 300
+        assert device.files[b'logs/empty.log'] == b''
+        # Nothing changed, nothing is uploaded
+        assert fileio.sync_push(fio, str(local), b'logs') == []
+        (local / 'a.log').write_bytes(b'A' * 1000)
+        assert fileio.sync_push(fio, str(local), b'logs') == [b'logs/a.log']
+
+        assert fileio.sync_pull(fio, b'logs', str(pulled)) == [b'logs/a.log', b'logs/empty.log', b'logs/sub/b.log']
+        assert (pulled / 'sub' / 'b.log').read_bytes() == b'b' * 300
+        assert fileio.sync_pull(fio, b'logs', str(pulled)) == []
+        # Growth and truncation on the device are both caught
+        device.files[b'logs/a.log'] += b'more'
+        device.files[b'logs/sub/b.log'] = bytearray(b'b' * 100)
+        assert fileio.sync_pull(fio, b'logs', str(pulled)) == [b'logs/a.log', b'logs/sub/b.log']
+        assert (pulled / 'a.log').read_bytes() == b'A' * 1000 + b'more'
+        assert (pulled / 'sub' / 'b.log').read_bytes() == b'b' * 100
+        assert fileio.sync_pull(fio, b'logs', str(pulled)) == []
+
+
+def run_blocked(target):
+    """Run `target` in a thread, returning the thread and when it finished."""
+    finished = []
+    thread = threading.Thread(target=lambda: finished.append((target(), time.monotonic())))
+    thread.daemon = True
+    thread.start()
+    return thread, finished
+
+
+def test_ack_wakes_flush_and_window_wait():
+    link = FakeLink()
+    sr = fileio.SelectiveRepeater(link, SBP_MSG_FILEIO_WRITE_RESP, skip_config=True)
+    sr._cwnd.size = 1.0
+    # Nothing expires for a minute, only the ACK can wake the waiters
+    sr._record_pending_req(mk_write_req(1), Time.now(), Time.now() + Time(60))
+    window_thread, window_done = run_blocked(lambda: sr._wait_window_available(1))
+    time.sleep(0.1)
+    assert not window_done
+    acked = time.monotonic()
+    sr._request_cb(MsgFileioWriteResp(sequence=1))
+    window_thread.join(5)
+    assert window_done and window_done[0][1] - acked < 0.05
+
+    sr._record_pending_req(mk_write_req(2), Time.now(), Time.now() + Time(60))
+    flush_thread, flush_done = run_blocked(sr.flush)
+    time.sleep(0.1)
+    assert not flush_done
+    acked = time.monotonic()
+    sr._request_cb(MsgFileioWriteResp(sequence=2))
+    flush_thread.join(5)
+    assert flush_done and flush_done[0][1] - acked < 0.05
+
+
+def test_config_response_wakes_config_wait(monkeypatch):
+    # Neither a retry nor the fallback timeout can wake the waiter
+    monkeypatch.setattr(fileio, 'CONFIG_REQ_RETRY_MS', 60000)
+    monkeypatch.setattr(fileio, 'CONFIG_REQ_TIMEOUT_MS', 60000)
+    link = FakeLink()
+    sr = fileio.SelectiveRepeater(link, SBP_MSG_FILEIO_WRITE_RESP)
+    thread, done = run_blocked(sr._wait_config_received)
+    time.sleep(0.1)
+    assert not done
+    assert [msg.msg_type for msg in link.sent] == [SBP_MSG_FILEIO_CONFIG_REQ]
+    received = time.monotonic()
+    sr._config_cb(MsgFileioConfigResp(sequence=0, window_size=7, batch_size=1, fileio_version=0))
+    thread.join(5)
+    assert done and done[0][1] - received < 0.05
+    assert len(sr._pending_map) == 7
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_write_resumes_from_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(fileio, 'CHECKPOINT_INTERVAL_BYTES', 2048)
+    data = os.urandom(40000)
+    journal = str(tmp_path / 'data.bin.checkpoint')
+
+    def interrupt(offset, sr):
+        if offset >= len(data) // 2:
+            raise Interrupted()
+
+    with emulated_fileio(files={b'data.bin': b'stale'}, latency=0.001, seed=6) as (device, fio):
+        try:
+            fio.write(b'data.bin', data, progress_cb=interrupt, checkpoint=journal)
+        except Interrupted:
+            pass
+        else:
+            assert False, "the write wasn't interrupted"
+        assert os.path.exists(journal)
+        saved = fileio.WriteCheckpoint(journal, b'data.bin', data).load()
+        assert 0 < saved < len(data)
+        assert bytes(device.files[b'data.bin'][:saved]) == data[:saved]
+
+        verified = []
+        verify_written = fio._verify_written
+        monkeypatch.setattr(fio, '_verify_written',
+                            lambda *args: verified.append(args[2]) or verify_written(*args))
+        offsets = []
+        fio.write(b'data.bin', data, progress_cb=lambda offset, sr: offsets.append(offset), checkpoint=journal)
+        assert verified == [saved]
+        # Picked up where the journal left off, without truncating the file first
+        assert offsets[0] == saved
+        assert bytes(device.files[b'data.bin']) == data
+    assert not os.path.exists(journal)
+
+
+def test_write_survives_unwritable_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(fileio, 'CHECKPOINT_INTERVAL_BYTES', 2048)
+    data = os.urandom(10000)
+    journal = str(tmp_path / 'missing' / 'data.bin.checkpoint')
+    with emulated_fileio(latency=0.001, seed=8) as (device, fio):
+        with pytest.warns(UserWarning, match='Unable to save write checkpoint'):
+            fio.write(b'data.bin', data, checkpoint=journal)
+        assert bytes(device.files[b'data.bin']) == data
@@ -0,0 +1,54 @@
+# -*- python -*-
+
+import gzip
+import json
+import threading
+
+from sbp.client.loggers.json_logger import JSONBinLogger
+from sbp.msg import SBP
+from sbp.system import MsgHeartbeat
+
+from piksi_tools.log_writer import BatchedLogWriter
+from piksi_tools.serial_link import get_logger
+
+
+def heartbeat(flags):
+    return SBP.unpack(MsgHeartbeat(flags=flags).to_binary())
+
+
+def test_rotation_and_compression(tmpdir):
+    filename = str(tmpdir.join('logs', 'serial-link.log.json'))
+    with get_logger(True, filename, rotate_bytes=2000, compress='gzip') as logger:
+        for flags in range(100):
+            logger(heartbeat(flags), time=flags)
+            if flags % 10 == 9:
+                logger.flush()
+    assert logger.written == 100 and logger.dropped == 0 and logger.queue_depth == 0
+    assert len(logger.segments) > 2
+    assert logger.segments[1] == str(tmpdir.join('logs', 'serial-link.log.1.json.gz'))
+    records = []
+    for segment in logger.segments:
+        with gzip.open(segment, 'rt') as f:
+            records.extend(json.loads(line) for line in f)
+    assert [X['time'] for X in records] == list(range(100))
+    assert sorted(X.basename for X in tmpdir.join('logs').listdir()) == sorted(
+        X.rsplit('/', 1)[1] for X in logger.segments)
+
+
+def test_full_queue_drops_instead_of_blocking(tmpdir):
+    release = threading.Event()
+    dump = JSONBinLogger(None).dump
+
+    def slow_formatter(msg, **metadata):
+        release.wait()
+        return dump(msg, **metadata)
+
+    logger = BatchedLogWriter(str(tmpdir.join('log.json')), slow_formatter, queue_size=10)
+    for flags in range(50):
+        logger(heartbeat(flags))
+    assert logger.dropped >= 39
+    release.set()
+    logger.close()
+    assert logger.written + logger.dropped == 50
+    with open(str(tmpdir.join('log.json'))) as f:
+        assert len(f.readlines()) == logger.written
@@ -0,0 +1,36 @@
+# -*- python -*-
+
+import csv
+import io
+
+from sbp.client.drivers.file_driver import FileDriver
+from sbp.logging import SBP_MSG_LOG, MsgLog
+from sbp.system import SBP_MSG_HEARTBEAT, MsgHeartbeat
+
+from piksi_tools.raw_capture import (INDEX_SUFFIX, RawCapture, index_capture,
+                                     read_time_markers)
+
+
+def test_capture_and_index(tmpdir):
+    frames = [MsgHeartbeat(flags=X, sender=0x42).to_binary() for X in range(300)]
+    frames[10] = frames[10][:-1] + bytes([frames[10][-1] ^ 1])
+    frames.insert(20, b'\x55\x00garbage')
+    frames.append(MsgLog(level=6, text=b'done').to_binary())
+    stream = b''.join(frames)
+    filename = str(tmpdir.join('logs', 'capture.sbp'))
+    with FileDriver(io.BytesIO(stream)) as driver:
+        with RawCapture(driver, filename, buffer_size=8192, marker_interval=0) as capture:
+            capture.start()
+            capture._thread.join()
+        assert capture.bytes_captured == len(stream)
+    with open(filename, 'rb') as f:
+        assert f.read() == stream
+    markers = read_time_markers(filename)
+    assert markers[0][1] == 0 and markers[-1][1] == len(stream)
+    assert index_capture(filename) == 300
+    with open(filename + INDEX_SUFFIX) as f:
+        rows = list(csv.DictReader(f))
+    assert [int(X['offset']) for X in rows[:2]] == [0, len(frames[0])]
+    assert all(X['msg_type'] == str(SBP_MSG_HEARTBEAT) for X in rows[:-1])
+    assert rows[-1]['msg_type'] == str(SBP_MSG_LOG)
+    assert all(X['host_time'] for X in rows)
@@ -0,0 +1,123 @@
+# -*- python -*-
+
+import io
+import json
+import sys
+
+import pytest
+from sbp.client import Framer
+from sbp.logging import SBP_MSG_LOG, MsgLog
+from sbp.navigation import SBP_MSG_POS_LLH, MsgPosLLH
+from sbp.system import SBP_MSG_HEARTBEAT, MsgHeartbeat
+from sbp.table import dispatch
+
+from piksi_tools import serial_link
+from piksi_tools.serial_link import base_cl_options, get_msg_type_filter
+
+
+def stream_reader():
+    data = io.BytesIO(b''.join([
+        MsgHeartbeat(flags=0).to_binary(),
+        MsgLog(level=6, text=b'hello').to_binary(),
+        MsgPosLLH(tow=1, lat=2, lon=3, height=4, h_accuracy=0, v_accuracy=0, n_sats=5, flags=1).to_binary(),
+    ] * 3))
+
+    def read(size):
+        chunk = data.read(size)
+        if not chunk:
+            raise IOError('end of stream')
+        return chunk
+    return read
+
+
+def parse_args(monkeypatch, options):
+    monkeypatch.setattr(sys, 'argv', ['serial_link', '-p', '/dev/ttyUSB0'] + options)
+    return serial_link.get_args()
+
+
+@pytest.mark.parametrize('options, expected', [
+    ([], [SBP_MSG_HEARTBEAT, SBP_MSG_LOG, SBP_MSG_POS_LLH]),
+    (['--msg-types', 'MsgPosLLH,0x4a'], [SBP_MSG_POS_LLH]),
+    (['--exclude-msg-types', '%d' % SBP_MSG_LOG], [SBP_MSG_HEARTBEAT, SBP_MSG_POS_LLH]),
+    (['--msg-types', 'MsgLog,MsgHeartbeat', '--exclude-msg-types', 'MsgLog'], [SBP_MSG_HEARTBEAT]),
+])
+def test_msg_type_filter(monkeypatch, options, expected):
+    args = parse_args(monkeypatch, options)
+    msg_type_filter = get_msg_type_filter(args)
+    assert isinstance(msg_type_filter, set if options else list)
+    decoded = []
+
+    def dispatcher(msg):
+        decoded.append(msg.msg_type)
+        return dispatch(msg)
+
+    framer = Framer(stream_reader(), None, dispatcher=dispatcher, message_type_filter=msg_type_filter)
+    assert [msg.msg_type for msg, _ in framer] == expected * 3
+    assert decoded == expected * 3
+
+
+@pytest.mark.parametrize('options', [
+    ['--msg-types', 'MsgNoSuchThing'],
+    # Nothing left to handle
+    ['--msg-types', 'MsgLog', '--exclude-msg-types', 'MsgLog'],
+])
+def test_invalid_msg_types(monkeypatch, options):
+    with pytest.raises(SystemExit):
+        parse_args(monkeypatch, options)
+
+
+def test_msg_types_only_in_serial_link():
+    with pytest.raises(SystemExit):
+        base_cl_options(add_log_args=True).parse_args(['--msg-types', 'MsgLog'])
+
+
+def run_main(monkeypatch, argv):
+    monkeypatch.setattr(sys, 'argv', ['serial_link'] + argv)
+    with pytest.raises(SystemExit) as exit_info:
+        serial_link.main(serial_link.get_args())
+    assert exit_info.value.code == 0
+
+
+def read_log(path):
+    with open(str(path)) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_multiple_devices(tmpdir, monkeypatch):
+    for name, count in (('left.sbp', 3), ('right.sbp', 5)):
+        tmpdir.join(name).write_binary(b''.join(MsgHeartbeat(flags=X).to_binary() for X in range(count)))
+    ports = ['-p', str(tmpdir.join('left.sbp')), '-p', str(tmpdir.join('right.sbp'))]
+    options = ['--file', '--log', '-o', str(tmpdir.join('logs')), '--logfilename', 'capture.log.json']
+    run_main(monkeypatch, ports + options)
+    assert len(read_log(tmpdir.join('logs', 'capture-left.sbp.log.json'))) == 3
+    assert len(read_log(tmpdir.join('logs', 'capture-right.sbp.log.json'))) == 5
+
+    run_main(monkeypatch, ports + options + ['--merge-logs'])
+    records = read_log(tmpdir.join('logs', 'capture.log.json'))
+    assert sorted(X['source'] for X in records) == ['left.sbp'] * 3 + ['right.sbp'] * 5
+
+
+@pytest.mark.parametrize('option', ['--log', '--raw'])
+def test_serve_rejects_logging(monkeypatch, option):
+    monkeypatch.setattr(sys, 'argv', ['serial_link', '-p', '/dev/ttyUSB0', '--serve', ':55555', option])
+    with pytest.raises(SystemExit):
+        serial_link.get_args()
+    monkeypatch.setattr(sys, 'argv', ['serial_link', '-p', '/dev/ttyUSB0', '--serve', ':55555'])
+    assert serial_link.get_args().serve == ('', 55555)
+
+
+def test_log_rotation_options_only_in_serial_link(monkeypatch):
+    options = ['--log-rotate-size', '10', '--log-rotate-interval', '60', '--log-compress', 'gzip']
+    monkeypatch.setattr(sys, 'argv', ['serial_link', '-p', '/dev/ttyUSB0'] + options)
+    args = serial_link.get_args()
+    assert (args.log_rotate_size, args.log_rotate_interval, args.log_compress) == (10, 60, 'gzip')
+    # The other tools sharing the logging options don't rotate their logs
+    with pytest.raises(SystemExit):
+        base_cl_options(add_log_args=True).parse_args(options)
+
+
+def test_only_serial_link_takes_several_ports(monkeypatch):
+    args = parse_args(monkeypatch, ['-p', '/dev/ttyUSB1'])
+    assert (args.port, args.ports) == ('/dev/ttyUSB1', ['/dev/ttyUSB0', '/dev/ttyUSB1'])
+    args = base_cl_options().parse_args(['-p', '/dev/ttyUSB0'])
+    assert args.port == '/dev/ttyUSB0' and not hasattr(args, 'ports')
@@ -0,0 +1,111 @@
+# -*- python -*-
+
+import socket
+import threading
+import time
+
+import pytest
+from sbp.system import MsgHeartbeat
+
+from piksi_tools.emulator import EmulatorDriver
+from piksi_tools.tcp_hub import HubClient, TcpHub, parse_address, split_frames
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def read_all(sock, received):
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        received.extend(data)
+
+
+def test_parse_address():
+    assert parse_address(':55555') == ('', 55555)
+    assert parse_address('127.0.0.1:2000') == ('127.0.0.1', 2000)
+    assert parse_address('[::1]:2000') == ('::1', 2000)
+    for text in ('::1', '127.0.0.1', '[::1]2000'):
+        with pytest.raises(ValueError):
+            parse_address(text)
+
+
+def test_split_frames():
+    frames = [MsgHeartbeat(flags=X).to_binary() for X in range(3)]
+    buf = bytearray(b'junk' + frames[0] + frames[1] + frames[2][:5])
+    assert split_frames(buf) == (frames[:2], 4 + len(frames[0]) + len(frames[1]))
+
+
+def test_slow_client_drops():
+    client = HubClient(None, None, ('127.0.0.1', 1234), queue_bytes=100)
+    for _ in range(5):
+        client.offer([b'x' * 30])
+    assert (client.queued_bytes, client.dropped_bytes, client.max_queued_bytes) == (90, 60, 90)
+    # Frames are queued or dropped whole
+    client = HubClient(None, None, ('127.0.0.1', 1234), queue_bytes=100)
+    client.offer([b'a' * 40, b'b' * 70, b'c' * 50])
+    assert list(client._queue) == [b'a' * 40 + b'c' * 50]
+    assert (client.queued_bytes, client.dropped_bytes) == (90, 70)
+
+
+def test_fan_out():
+    device, host = socket.socketpair()
+    with TcpHub(EmulatorDriver(host), '127.0.0.1', 0) as hub:
+        hub.start()
+        clients = [socket.create_connection(hub.address) for _ in range(2)]
+        wait_for(lambda: len(hub.clients) == 2)
+        received = [bytearray(), bytearray()]
+        readers = [threading.Thread(target=read_all, args=X) for X in zip(clients, received)]
+        for reader in readers:
+            reader.start()
+
+        stream = b''.join(MsgHeartbeat(flags=X).to_binary() for X in range(2000))
+        # Bytes that aren't part of a frame aren't passed on
+        device.sendall(b'noise' + stream)
+        wait_for(lambda: all(len(X) == len(stream) for X in received))
+        assert all(X == stream for X in received)
+
+        frames = [MsgHeartbeat(flags=X).to_binary() for X in range(2)]
+        clients[0].sendall(frames[0][:4])
+        clients[1].sendall(b'noise' + frames[1])
+        clients[0].sendall(frames[0][4:])
+        written = bytearray()
+        device.settimeout(5)
+        while len(written) < len(frames[0]) + len(frames[1]):
+            written.extend(device.recv(4096))
+        assert written in (frames[0] + frames[1], frames[1] + frames[0])
+
+        for client in clients:
+            client.shutdown(socket.SHUT_RDWR)
+            client.close()
+        wait_for(lambda: not hub.clients)
+        for reader in readers:
+            reader.join()
+    device.close()
+
+
+def test_ipv6():
+    try:
+        socket.create_server(('::1', 0), family=socket.AF_INET6).close()
+    except OSError:
+        pytest.skip('IPv6 is unavailable')
+    device, host = socket.socketpair()
+    with TcpHub(EmulatorDriver(host), '::1', 0) as hub:
+        hub.start()
+        assert hub.address[0] == '::1'
+        client = socket.create_connection(hub.address[:2])
+        wait_for(lambda: len(hub.clients) == 1)
+        frame = MsgHeartbeat(flags=1).to_binary()
+        device.sendall(frame)
+        client.settimeout(5)
+        received = bytearray()
+        while len(received) < len(frame):
+            received.extend(client.recv(4096))
+        assert received == frame
+        client.close()
+    device.close()